@@ -0,0 +1 @@
+"""Benchmarks for fs-uae-wrapper, not part of the installed package"""
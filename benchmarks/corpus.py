@@ -0,0 +1,103 @@
+"""
+Generators of synthetic game collections: CD32-like ISO and WAV sets,
+WHDLoad trees with the base image, and hard drive trees with many small
+files. Contents are deterministic for the seed, and half of every file is
+compressible, which makes compression ratios roughly similar to real data.
+"""
+import os
+import random
+import struct
+
+# scale of the generated trees
+SIZES = {'small': 1, 'medium': 4, 'large': 16}
+MIB = 2**20
+
+
+def get_data(rng, size):
+    """Return size bytes, half of them random, half repetitive"""
+    random_size = size // 2
+    data = rng.getrandbits(random_size * 8).to_bytes(random_size, 'little')
+    chunk = rng.getrandbits(512 * 8).to_bytes(512, 'little')
+    repeated = size - random_size
+    return data + (chunk * (repeated // len(chunk) + 1))[:repeated]
+
+
+def write_file(path, data):
+    """Write data to the file, creating parent directories"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fobj:
+        fobj.write(data)
+    return len(data)
+
+
+def make_cd32(dest, scale, seed=0):
+    """
+    Create CD32 game: ISO image with data track, audio tracks as WAV files
+    and cue sheet. Return number of bytes written.
+    """
+    rng = random.Random(seed)
+    size = write_file(os.path.join(dest, 'Game.iso'),
+                      get_data(rng, 4 * MIB * scale))
+    cue = 'FILE "Game.iso" BINARY\n  TRACK 01 MODE1/2048\n' \
+          '    INDEX 01 00:00:00\n'
+    for num in range(2, 6):
+        pcm = get_data(rng, MIB * scale)
+        header = (b'RIFF' + struct.pack('<I', 36 + len(pcm)) + b'WAVEfmt ' +
+                  struct.pack('<IHHIIHH', 16, 1, 2, 44100, 176400, 4, 16) +
+                  b'data' + struct.pack('<I', len(pcm)))
+        name = f'Track{num:02d}.wav'
+        size += write_file(os.path.join(dest, name), header + pcm)
+        cue += (f'FILE "{name}" WAVE\n  TRACK {num:02d} AUDIO\n'
+                f'    INDEX 01 00:00:00\n')
+    size += write_file(os.path.join(dest, 'Game.cue'), cue.encode())
+    return size
+
+
+def make_whdload_base(dest, seed=0):
+    """
+    Create WHDLoad base image with system directories and the
+    startup-sequence. Return number of bytes written.
+    """
+    rng = random.Random(seed)
+    size = 0
+    for name, fsize in (('C/Assign', 2000), ('C/WHDLoad', 60000),
+                        ('C/kgiconload', 8000),
+                        ('Libs/icon.library', 12000),
+                        ('Libs/lowlevel.library', 4000),
+                        ('Devs/system-configuration', 232),
+                        ('Fonts/topaz.font', 400)):
+        size += write_file(os.path.join(dest, name), get_data(rng, fsize))
+    size += write_file(os.path.join(dest, 'S', 'startup-sequence'),
+                       b'Execute S:whdload-startup\n')
+    return size
+
+
+def make_whdload_game(dest, scale, seed=0):
+    """
+    Create WHDLoad game directory with the slave, icon and data files.
+    Return number of bytes written.
+    """
+    rng = random.Random(seed)
+    size = write_file(os.path.join(dest, 'Game', 'Game.slave'),
+                      get_data(rng, 2000))
+    size += write_file(os.path.join(dest, 'Game', 'Game.info'),
+                       get_data(rng, 1000))
+    for num in range(50 * scale):
+        size += write_file(os.path.join(dest, 'Game', 'data', f'disk.{num}'),
+                           get_data(rng, rng.randint(4096, 65536)))
+    return size
+
+
+def make_hdd(dest, scale, seed=0):
+    """
+    Create hard drive tree with many small files in nested directories.
+    Return number of bytes written.
+    """
+    rng = random.Random(seed)
+    size = write_file(os.path.join(dest, 'S', 'startup-sequence'),
+                      b'Game\n')
+    for num in range(500 * scale):
+        path = os.path.join(dest, f'dir{num % 20}', f'sub{num % 7}',
+                            f'file{num}.dat')
+        size += write_file(path, get_data(rng, rng.randint(512, 8192)))
+    return size
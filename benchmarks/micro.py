@@ -0,0 +1,228 @@
+"""
+Micro benchmarks of the wrapper code which runs on every launch.
+
+Every benchmark is run repeat times and the median and minimum time is
+reported, followed by one more run under tracemalloc, which reports peak
+memory allocated by Python code.
+
+Usage, from the top directory of the repository:
+
+    python -m benchmarks.micro [--repeat 20] [--filter find_slave]
+                               [--entries 10000,200000] [--json FILE]
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks import corpus
+from fs_uae_wrapper import base, file_archive, path, utils, whdload
+
+PATH_OPTIONS = ('floppy_image_%d', 'cdrom_image_%d')
+
+
+def setup_get_config(workdir, _):
+    """
+    Configuration chain: Default.fs-uae from ~/FS-UAE, Host.fs-uae from the
+    base_dir and game configuration with the same number of options.
+    """
+    home = os.path.join(workdir, 'home')
+    conf_dir = os.path.join(home, 'FS-UAE', 'Configurations')
+    os.makedirs(conf_dir, exist_ok=True)
+    os.environ['HOME'] = home
+    os.environ['XDG_CONFIG_HOME'] = os.path.join(home, '.config')
+    options = ''.join(f'option_{num} = {num}\n' for num in range(200))
+    with open(os.path.join(conf_dir, 'Default.fs-uae'), 'w') as fobj:
+        fobj.write(f'[config]\nbase_dir = {home}/FS-UAE\n{options}')
+    with open(os.path.join(conf_dir, 'Host.fs-uae'), 'w') as fobj:
+        fobj.write(f'[config]\nfullscreen = 1\n{options}')
+    conf_file = os.path.join(workdir, 'Game.fs-uae')
+    with open(conf_file, 'w') as fobj:
+        fobj.write(f'[config]\nwrapper = archive\n{options}')
+    return lambda: utils.get_config(conf_file)
+
+
+def setup_normalize_options(workdir, _):
+    """Base._normalize_options on configuration with 2000 options"""
+    conf_file = os.path.join(workdir, 'Large.fs-uae')
+    with open(conf_file, 'w') as fobj:
+        fobj.write('[config]\nwrapper = plain\n'
+                   'hard_drive_0 = $WRAPPER/DH0\n'
+                   'save_states_dir = $CONFIG/saves\n'
+                   'kickstart_file = kick.rom\n')
+        for num in range(20):
+            for option in PATH_OPTIONS:
+                fobj.write(f'{option % num} = $CONFIG/disk{num}.adf\n')
+        for num in range(2000):
+            fobj.write(f'custom_option_{num} = value {num}\n')
+    configuration = utils.get_config_options(conf_file)
+    runner = base.Base(conf_file, utils.CmdOption(), configuration)
+    runner.dir = workdir
+    return runner._normalize_options
+
+
+def setup_cmd_option(_, __):
+    """CmdOption.add and list for 1000 options"""
+    options = [f'--option_{num}={num}' if num % 2 else f'--switch_{num}'
+               for num in range(1000)]
+
+    def _run():
+        cmd = utils.CmdOption()
+        for option in options:
+            cmd.add(option)
+        return cmd.list()
+    return _run
+
+
+def setup_get_archiver(_, __):
+    """get_archiver for 100 archive names of every known extension"""
+    names = [f'Game {num}.{ext}' for num in range(100)
+             for arch in file_archive.Archivers.archivers
+             for ext in arch['ext']]
+
+    def _run():
+        for name in names:
+            file_archive.get_archiver(name)
+    return _run
+
+
+def setup_which(workdir, _):
+    """
+    path.which with 500 entries in PATH, found at the end and missing.
+    Memoized lookups are dropped on every run, so that PATH is searched.
+    """
+    dirs = []
+    for num in range(500):
+        dirs.append(os.path.join(workdir, 'path', str(num)))
+        os.makedirs(dirs[-1], exist_ok=True)
+    os.environ['PATH'] = os.pathsep.join(dirs + [os.environ['PATH']])
+
+    def _run():
+        path._LOOKUPS.clear()
+        return path.which('sh'), path.which('nonexistent-archiver')
+    return _run
+
+
+def make_whdload_tree(dest, entries):
+    """Create WHDLoad tree with provided number of files"""
+    corpus.make_whdload_base(dest)
+    per_dir = 100
+    for num in range(entries):
+        dirname = os.path.join(dest, 'Games', f'dir{num // per_dir}')
+        if num % per_dir == 0:
+            os.makedirs(dirname)
+        open(os.path.join(dirname, f'file{num}'), 'w').close()
+    game = os.path.join(dest, 'Games', 'zzz')
+    os.makedirs(game)
+    for name in ('Game.Slave', 'Game.info'):
+        open(os.path.join(game, name), 'w').close()
+
+
+def setup_find_slave(workdir, entries):
+    """whdload _find_slave on extracted tree"""
+    tree = os.path.join(workdir, f'whdload-{entries}')
+    if not os.path.exists(tree):
+        make_whdload_tree(tree, entries)
+    runner = whdload.Wrapper('Game.fs-uae', utils.CmdOption(), {})
+    runner.dir = tree
+    return runner._find_slave
+
+
+def setup_search_slave(workdir, entries):
+    """whdload _search_slave on archive listing"""
+    listing = [(f'Games/dir{num // 100}/file{num}', 0)
+               for num in range(entries)]
+    listing.extend([('Games/zzz/Game.Slave', 0), ('Games/zzz/Game.info', 0)])
+    runner = whdload.Wrapper('Game.fs-uae', utils.CmdOption(), {})
+    return lambda: runner._search_slave(listing)
+
+
+BENCHMARKS = (('get_config', setup_get_config, False),
+              ('normalize_options', setup_normalize_options, False),
+              ('cmd_option', setup_cmd_option, False),
+              ('get_archiver', setup_get_archiver, False),
+              ('which', setup_which, False),
+              ('find_slave', setup_find_slave, True),
+              ('search_slave', setup_search_slave, True))
+
+
+def measure(func, repeat):
+    """
+    Return tuple of median and minimal time in seconds, and peak of traced
+    memory in bytes
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    times.sort()
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return times[len(times) // 2], times[0], peak
+
+
+def parse_args(argv=None):
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='number of runs of every benchmark (default: '
+                        '%(default)s)')
+    parser.add_argument('--filter', default='',
+                        help='run only benchmarks which name contains '
+                        'provided string')
+    parser.add_argument('--entries', default='10000,50000',
+                        help='comma separated numbers of entries in WHDLoad '
+                        'trees (default: %(default)s)')
+    parser.add_argument('--json', help='write results to the JSON file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    entries = [int(num) for num in args.entries.split(',')]
+    environ = dict(os.environ)
+    workdir = tempfile.mkdtemp(prefix='fs-uae-micro-')
+    # errors about missing archivers are expected
+    logging.disable(logging.CRITICAL)
+
+    results = []
+    sys.stdout.write('%-26s %12s %12s %13s\n' % ('benchmark', 'median',
+                                                 'min', 'peak memory'))
+    try:
+        for name, setup, scaled in BENCHMARKS:
+            if args.filter not in name:
+                continue
+            for count in entries if scaled else [None]:
+                func = setup(workdir, count)
+                median, best, peak = measure(func, args.repeat)
+                results.append({'name': name + (f'[{count}]' if count
+                                                else ''),
+                                'median': median, 'min': best,
+                                'peak': peak})
+                sys.stdout.write('%-26s %10.3fms %10.3fms %10.1fKiB\n' %
+                                 (results[-1]['name'], median * 1000,
+                                  best * 1000, peak / 1024))
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+        shutil.rmtree(workdir)
+
+    if args.json:
+        with open(args.json, 'w') as fobj:
+            json.dump(results, fobj, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
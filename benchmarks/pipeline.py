@@ -0,0 +1,270 @@
+"""
+End to end benchmark of the wrapper modules.
+
+Synthetic collections are generated for every size and packed in every
+archive format which can be created on this system, and each wrapper module
+is run against them with stub of the fs-uae emulator (benchmarks/bin/fs-uae),
+which writes save states and modifies files. Reported are launch latency
+(wrapper start to emulator start), exit latency (emulator exit to wrapper
+end), and throughput of unpacked data during the launch.
+
+Usage, from the top directory of the repository:
+
+    python -m benchmarks.pipeline [--sizes small,medium] [--formats zip,7z]
+                                  [--wrappers cd32,archive] [--repeat 5]
+                                  [--option wrapper_cache=1] [--json FILE]
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import corpus
+from fs_uae_wrapper import file_archive, metrics, utils
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUB_DIR = os.path.join(ROOT, 'benchmarks', 'bin')
+WRAPPERS = ('cd32', 'whdload', 'archive', 'savestate')
+RUN = 'from fs_uae_wrapper import wrapper; wrapper.run()'
+
+
+def get_formats(names=None):
+    """Return names of the archive formats which can be created"""
+    formats = []
+    for arch in file_archive.Archivers.archivers:
+        if names and arch['name'] not in names:
+            continue
+        if file_archive.Archivers.is_available(arch['name']):
+            formats.append(arch['name'])
+    return formats
+
+
+def get_sources(workdir, size):
+    """
+    Generate (once) source trees for the size. Return dictionary of the tree
+    name and tuple of its path and number of bytes.
+    """
+    scale = corpus.SIZES[size]
+    sources = {}
+    for name, func, args in (('cd32', corpus.make_cd32, (scale,)),
+                             ('base', corpus.make_whdload_base, ()),
+                             ('whdload', corpus.make_whdload_game, (scale,)),
+                             ('hdd', corpus.make_hdd, (scale,))):
+        path = os.path.join(workdir, 'src', f'{name}-{size}')
+        stamp = path + '.size'
+        if not os.path.exists(stamp):
+            shutil.rmtree(path, ignore_errors=True)
+            size_written = func(path, *args)
+            with open(stamp, 'w') as fobj:
+                fobj.write(str(size_written))
+        with open(stamp) as fobj:
+            sources[name] = (path, int(fobj.read()))
+    return sources
+
+
+def pack(src, arch_name):
+    """Create archive out of the source tree. Return True on success"""
+    if os.path.exists(arch_name):
+        os.unlink(arch_name)
+    return utils.create_archive(arch_name, params=sorted(os.listdir(src)),
+                                cwd=src)
+
+
+def setup_case(case_dir, wrapper, arch_format, sources, options):
+    """
+    Create configuration file and archives for the case. Return tuple of
+    the configuration file path and unpacked data size, or None if archives
+    cannot be created in this format.
+    """
+    shutil.rmtree(case_dir, ignore_errors=True)
+    os.makedirs(case_dir)
+    ext = file_archive.Archivers.get_extension_by_name(arch_format)
+    conf = {'wrapper': wrapper,
+            'wrapper_archiver': arch_format,
+            'wrapper_save_state': '1',
+            'save_states_dir': '$WRAPPER/fs-uae-save/'}
+    archives = []
+    if wrapper == 'cd32':
+        archives.append(('Game' + ext, 'cd32'))
+        conf['cdrom_drive_0'] = '$WRAPPER/Game.cue'
+    elif wrapper == 'whdload':
+        archives.extend([('Game' + ext, 'whdload'), ('Base' + ext, 'base')])
+        conf['wrapper_whdload_base'] = '$CONFIG/Base' + ext
+        conf['hard_drive_0'] = '$WRAPPER'
+    elif wrapper == 'archive':
+        archives.append(('Game' + ext, 'hdd'))
+        conf['wrapper_persist_data'] = '1'
+        conf['hard_drive_0'] = '$WRAPPER'
+
+    size = 0
+    for arch_name, source in archives:
+        if not pack(sources[source][0], os.path.join(case_dir, arch_name)):
+            return None
+        size += sources[source][1]
+    if archives:
+        conf['wrapper_archive'] = archives[0][0]
+    conf.update(options)
+
+    conf_file = os.path.join(case_dir, 'Game.fs-uae')
+    with open(conf_file, 'w') as fobj:
+        fobj.write('[config]\n')
+        for key, val in conf.items():
+            fobj.write(f'{key} = {val}\n')
+    return conf_file, size
+
+
+def get_env(workdir):
+    """
+    Return environment for the wrapper, with the stub emulator in the PATH,
+    and user directories isolated in the working directory
+    """
+    env = dict(os.environ)
+    env['PATH'] = STUB_DIR + os.pathsep + env.get('PATH', '')
+    env['PYTHONPATH'] = ROOT
+    for name in ('HOME', 'XDG_CONFIG_HOME', 'XDG_CACHE_HOME',
+                 'XDG_STATE_HOME'):
+        env[name] = os.path.join(workdir, name.lower())
+    return env
+
+
+def run_case(conf_file, db_path, env, repeat):
+    """
+    Run wrapper repeat times. Return dictionary with the results, or None if
+    any of the runs has failed.
+    """
+    walls = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-c', RUN,
+                               f'--wrapper_metrics={db_path}', conf_file],
+                              env=env, cwd=os.path.dirname(conf_file),
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.PIPE)
+        walls.append(time.perf_counter() - start)
+        if proc.returncode != 0:
+            sys.stderr.write(proc.stderr.decode(errors='replace')[-2000:])
+            return None
+
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute('SELECT launch, exit FROM launches WHERE config = ? '
+                        'ORDER BY id DESC LIMIT ?',
+                        (os.path.abspath(conf_file), repeat)).fetchall()
+    conn.close()
+    launches = [row[0] for row in rows]
+    exits = [row[1] for row in rows]
+    return {'wall_p50': metrics.percentile(walls, 50),
+            'launch_p50': metrics.percentile(launches, 50),
+            'launch_p95': metrics.percentile(launches, 95),
+            'exit_p50': metrics.percentile(exits, 50),
+            'exit_p95': metrics.percentile(exits, 95)}
+
+
+def get_packed_size(case_dir):
+    """Return size of the archives in case directory"""
+    return sum(os.path.getsize(os.path.join(case_dir, name))
+               for name in os.listdir(case_dir)
+               if name.startswith(('Game.', 'Base.')) and
+               not name.endswith('.fs-uae'))
+
+
+def write_results(results, out):
+    """Write table of the results"""
+    header = ('wrapper', 'size', 'format', 'packed', 'data', 'launch50',
+              'launch95', 'exit50', 'exit95', 'wall50', 'MiB/s')
+    out.write('%-9s %-6s %-7s %8s %8s %8s %8s %8s %8s %8s %8s\n' % header)
+    for res in results:
+        if res.get('failed'):
+            out.write('%-9s %-6s %-7s FAILED\n' % (res['wrapper'],
+                                                   res['size'],
+                                                   res['format']))
+            continue
+        throughput = 0
+        if res['launch_p50']:
+            throughput = res['data'] / corpus.MIB / res['launch_p50']
+        out.write('%-9s %-6s %-7s %7.1fM %7.1fM %8.3f %8.3f %8.3f %8.3f '
+                  '%8.3f %8.1f\n' % (res['wrapper'], res['size'],
+                                     res['format'],
+                                     res['packed'] / corpus.MIB,
+                                     res['data'] / corpus.MIB,
+                                     res['launch_p50'], res['launch_p95'],
+                                     res['exit_p50'], res['exit_p95'],
+                                     res['wall_p50'], throughput))
+
+
+def parse_args(argv=None):
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='small',
+                        help='comma separated sizes out of: ' +
+                        ', '.join(corpus.SIZES) + ' (default: small)')
+    parser.add_argument('--formats', default='',
+                        help='comma separated archive formats (default: '
+                        'all available)')
+    parser.add_argument('--wrappers', default=','.join(WRAPPERS),
+                        help='comma separated wrapper modules (default: '
+                        '%(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs for every case (default: '
+                        '%(default)s)')
+    parser.add_argument('--option', action='append', default=[],
+                        metavar='KEY=VALUE',
+                        help='additional option for all configurations, '
+                        'e.g. wrapper_cache=1')
+    parser.add_argument('--workdir',
+                        help='directory for generated data, kept between '
+                        'runs (default: temporary directory)')
+    parser.add_argument('--json', help='write results to the JSON file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    options = dict(opt.split('=', 1) for opt in args.option)
+    formats = get_formats([name for name in args.formats.split(',') if name])
+    workdir = args.workdir or tempfile.mkdtemp(prefix='fs-uae-bench-')
+    workdir = os.path.abspath(workdir)
+    env = get_env(workdir)
+    db_path = os.path.join(workdir, 'metrics.sqlite')
+
+    results = []
+    try:
+        for size in args.sizes.split(','):
+            sources = get_sources(workdir, size)
+            for wrapper in args.wrappers.split(','):
+                for arch_format in formats:
+                    case_dir = os.path.join(workdir, 'cases', wrapper, size,
+                                            arch_format)
+                    case = setup_case(case_dir, wrapper, arch_format,
+                                      sources, options)
+                    if case is None:
+                        sys.stderr.write(f'Cannot create {arch_format} '
+                                         f'archives, skipping.\n')
+                        continue
+                    result = {'wrapper': wrapper, 'size': size,
+                              'format': arch_format, 'data': case[1],
+                              'packed': get_packed_size(case_dir)}
+                    res = run_case(case[0], db_path, env, args.repeat)
+                    if res is None:
+                        result['failed'] = True
+                    else:
+                        result.update(res)
+                    results.append(result)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    write_results(results, sys.stdout)
+    if args.json:
+        with open(args.json, 'w') as fobj:
+            json.dump({'options': options, 'results': results}, fobj,
+                      indent=2)
+    return 0 if all(not res.get('failed') for res in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,10 +4,12 @@ Run fs-uae with archived filesystem/adf files
 It will use compressed directories, and optionally replace source archive with
 the temporary one.
 """
+import functools
+import logging
 import os
 import shutil
 
-from fs_uae_wrapper import base, utils
+from fs_uae_wrapper import base, digest, manifest, utils
 
 
 class Wrapper(base.ArchiveBase):
@@ -18,6 +20,7 @@ class Wrapper(base.ArchiveBase):
     def __init__(self, conf_file, fsuae_options, configuration):
         super(Wrapper, self).__init__(conf_file, fsuae_options, configuration)
         self.archive_type = None
+        self.manifest = None
 
     def run(self):
         """
@@ -31,44 +34,112 @@ class Wrapper(base.ArchiveBase):
         if not super(Wrapper, self).run():
             return False
 
-        if not self._extract():
-            return False
-
-        self._load_save()
-
-        if not self._copy_conf():
+        if not self._prepare():
             return False
 
         if not self._run_emulator():
             return False
 
-        if self._get_saves_dir():
-            if not self._save_save():
-                return False
+        return self._finish()
 
-        return self._make_archive()
+    def _get_stages(self):
+        graph = super(Wrapper, self)._get_stages()
+        if self.all_options.get('wrapper_persist_data', '0') == '1':
+            # manifest have to be taken before save state is extracted
+            graph['manifest'] = (self._make_manifest, ('extract',))
+            method, requires = graph['load_save']
+            graph['load_save'] = (method, requires + ('manifest',))
+        return graph
 
-    def _make_archive(self):
+    def _make_manifest(self):
+        """Take manifest of the extracted files"""
+        self.manifest = manifest.get_manifest(self.dir)
+        return True
+
+    def _get_persist_stages(self):
+        graph = super(Wrapper, self)._get_persist_stages()
+        threads = utils.get_threads(self.all_options.get('wrapper_threads'))
+        if (super(Wrapper, self)._get_persist_targets() and
+                self.all_options.get('wrapper_concurrent_stages',
+                                     '1') != '0'):
+            # save state is compressed at the same time using single thread
+            threads = max(threads - 1, 1)
+        graph['data'] = (functools.partial(self._make_archive, threads), ())
+        return graph
+
+    def _get_required_space(self):
+        size = super(Wrapper, self)._get_required_space()
+        # archive is recreated inside temporary directory
+        if (size is not None and
+                self.all_options.get('wrapper_persist_data', '0') == '1' and
+                os.path.exists(self.arch_filepath)):
+            size += os.path.getsize(self.arch_filepath)
+        return size
+
+    def _is_persisted(self, arch_name):
+        return (self.all_options.get('wrapper_persist_data', '0') == '1' and
+                arch_name == self.arch_filepath)
+
+    def _get_persist_targets(self):
+        targets = super(Wrapper, self)._get_persist_targets()
+        if self.all_options.get('wrapper_persist_data', '0') == '1':
+            targets.append(self.arch_filepath)
+        return targets
+
+    def _make_archive(self, threads=None):
         """
-        Produce archive and save it back. Than remove old one.
+        Produce archive and save it back. Than remove old one. If manifest of
+        the extracted files is available, only changed files will be applied
+        to the archive, or whole operation will be skipped, if there are no
+        changes at all. Save states and configuration are not part of the
+        archive. Size of the archived files is stored, so that next launch
+        doesn't need to list the archive to estimate it.
         """
         if self.all_options.get('wrapper_persist_data', '0') != '1':
             return True
 
-        curdir = os.path.abspath('.')
-        os.chdir(self.dir)
-
+        exclude = ['Config.fs-uae']
         saves = self._get_saves_dir()
         if saves:
-            shutil.rmtree(saves)
-        os.unlink('Config.fs-uae')
+            exclude.append(saves)
 
         title = self._get_title()
+        if threads is None:
+            threads = utils.get_threads(self.all_options.get(
+                'wrapper_threads'))
+
+        current = manifest.get_manifest(self.dir, exclude)
+        if self.manifest is not None:
+            added, modified, deleted = manifest.diff(self.manifest, current)
+            if not any((added, modified, deleted)):
+                logging.info("No changes in data, archive is left intact.")
+                return True
+
+            logging.info("Changes in data: %d added, %d modified, %d "
+                         "deleted.", len(added), len(modified), len(deleted))
+            if utils.update_archive(self.arch_filepath, added + modified,
+                                    deleted + modified, title, threads,
+                                    cwd=self.dir):
+                manifest.store_unpacked_size(self.arch_filepath,
+                                             manifest.get_tree_size(current))
+                return True
+            logging.info("Unable to update archive, it will be recreated.")
+
+        files = manifest.get_paths(self.dir, exclude)
+        if not files:
+            logging.warning("There is no data to be archived, archive `%s' "
+                            "is left intact.", self.arch_filepath)
+            return True
 
-        arch = os.path.basename(self.arch_filepath)
-        if not utils.create_archive(arch, title):
+        arch = os.path.join(self.dir, os.path.basename(self.arch_filepath))
+        digests = digest.Digests()
+        if not utils.create_archive(arch, title, files, threads=threads,
+                                    cwd=self.dir, digests=digests):
             return False
 
         shutil.move(arch, self.arch_filepath)
-        os.chdir(curdir)
+        # next launch will know the archive contents without hashing it
+        manifest.store_digests(self.arch_filepath, digests)
+        manifest.store_unpacked_size(self.arch_filepath,
+                                     manifest.get_tree_size(current))
         return True
@@ -1,12 +1,14 @@
 """
 Base class for all wrapper modules
 """
+import functools
 import logging
 import os
 import shutil
-import tempfile
 
-from fs_uae_wrapper import path, utils
+from fs_uae_wrapper import cache, file_archive, index, manifest, materialize
+from fs_uae_wrapper import members, persist, plan, stages, timing, tmpdir
+from fs_uae_wrapper import utils
 
 
 class Base(object):
@@ -28,6 +30,9 @@ class Base(object):
                                                    fsuae_options)
         self.dir = None
         self.save_filename = None
+        # values which are computed from configuration, replaced by wrapper
+        # with the plan stored between launches
+        self.plan = plan.Plan()
 
     def run(self):
         """
@@ -41,12 +46,19 @@ class Base(object):
             - archive save state
         """
         logging.debug("run")
-        if not self._validate_options():
-            return False
+        with timing.span('validate'):
+            if not self._validate_options():
+                return False
 
-        self.dir = tempfile.mkdtemp()
-        self._normalize_options()
         self._set_assets_paths()
+        with timing.span('estimate_size'):
+            size = self._get_required_space()
+        with timing.span('mkdtemp'):
+            self.dir = tmpdir.make_temp_dir(self.all_options, size)
+        if not self.dir:
+            return False
+        with timing.span('normalize_options'):
+            self._normalize_options()
 
         return True
 
@@ -56,6 +68,117 @@ class Base(object):
             shutil.rmtree(self.dir)
         return
 
+    def _get_stages(self):
+        """
+        Return dictionary of the stages, which prepare temporary directory
+        for the emulator. Keys are stage names, values are tuples of the
+        method and names of the stages which have to be done before.
+        """
+        return {'load_save': (self._load_save, ()),
+                'copy_conf': (self._copy_conf, ('load_save',))}
+
+    def _prepare(self):
+        """Run the stages which prepare temporary directory"""
+        with timing.span('prepare'):
+            return self._run_stages(self._get_stages())
+
+    def _run_stages(self, graph):
+        """
+        Run provided stages, independent ones concurrently, unless
+        wrapper_concurrent_stages option is set to 0.
+        """
+        workers = None
+        if self.all_options.get('wrapper_concurrent_stages', '1') == '0':
+            workers = 1
+        scheduler = stages.Scheduler(workers)
+        for name, (method, requires) in graph.items():
+            scheduler.add(name, method, requires)
+        return scheduler.run()
+
+    def _get_archives(self):
+        """Return list of archives, which will be extracted to temp dir"""
+        if (self.all_options.get('wrapper_save_state', '0') == '1' and
+                self.save_filename):
+            return [self.save_filename]
+        return []
+
+    def _get_required_space(self):
+        """
+        Return estimated size in bytes of the data which will be put into the
+        temporary directory, or None if it cannot be determined or there is
+        no need for it - without wrapper_tmp_dirs option there is only one
+        place for temporary directory anyway.
+        """
+        if not self.all_options.get('wrapper_tmp_dirs'):
+            return None
+
+        size = 0
+        for arch_name in self._get_archives():
+            if not os.path.exists(arch_name):
+                continue
+            unpacked = self._get_unpacked_size(arch_name)
+            if unpacked is None:
+                logging.debug("Cannot determine unpacked size of `%s'.",
+                              arch_name)
+                return None
+            size += unpacked
+        return size
+
+    def _get_unpacked_size(self, arch_name):
+        """
+        Return size of the data which will be extracted from archive. If the
+        archive is already in the cache, size of the cache entry is used, so
+        that archive doesn't need to be listed.
+        """
+        arch_cache = cache.get_cache(self.all_options)
+        if arch_cache:
+            size = arch_cache.get_size(arch_name)
+            if size is not None:
+                return size
+        return manifest.get_unpacked_size(arch_name)
+
+    def _finish(self):
+        """
+        Store the data after emulation. If asynchronous persistence is
+        enabled, this will be done by the detached worker, which also takes
+        over the temporary directory.
+        """
+        if self.all_options.get('wrapper_async_persist', '0') == '1':
+            targets = self._get_persist_targets()
+            with timing.span('spawn_worker'):
+                spawned = targets and persist.spawn(self, targets)
+            if spawned:
+                self.dir = None
+                return True
+
+        return self._persist()
+
+    def _get_persist_stages(self):
+        """
+        Return dictionary of the stages, which store the data after
+        emulation, in the same form as _get_stages.
+        """
+        graph = {}
+        if self._get_saves_dir():
+            graph['save_state'] = (self._save_save, ())
+        return graph
+
+    def _persist(self):
+        """Store the data which was changed during emulation"""
+        with timing.span('persist'):
+            return self._run_stages(self._get_persist_stages())
+
+    def _get_persist_targets(self):
+        """Return list of files which will be written by _persist method"""
+        if (self.all_options.get('wrapper_save_state', '0') == '1' and
+                self._get_saves_dir()):
+            return [self.save_filename]
+        return []
+
+    def _is_persisted(self, arch_name):
+        """Return True if archive is written back after emulation"""
+        return False
+
     def _set_assets_paths(self):
         """
         Set full paths for archive file (without extension) and for save state
@@ -80,10 +203,9 @@ class Base(object):
 
     def _run_emulator(self):
         """execute fs-uae"""
-        curdir = os.path.abspath('.')
-        os.chdir(self.dir)
-        utils.run_command(['fs-uae', *self.fsuae_options.list()])
-        os.chdir(curdir)
+        with timing.span('emulator'):
+            utils.run_command(['fs-uae', *self.fsuae_options.list()],
+                              cwd=self.dir)
         return True
 
     def _get_title(self):
@@ -99,6 +221,36 @@ class Base(object):
                 title = self.all_options['wrapper_archive']
         return title
 
+    def _extract_archive(self, arch_name, title='', files=None):
+        """
+        Extract provided archive (or only provided files from it) into the
+        temporary directory. If cache is enabled, archive contents will be
+        materialized from cache entry instead, unless archive is written back
+        after emulation, which would leave outdated entry behind every time.
+        """
+        threads = utils.get_threads(self.all_options.get('wrapper_threads'))
+        arch_cache = None
+        if not self._is_persisted(arch_name):
+            arch_cache = cache.get_cache(self.all_options)
+        if arch_cache:
+            with arch_cache.fetch(arch_name, title, threads, files) as tree:
+                if tree is None:
+                    return False
+                try:
+                    with timing.span('materialize',
+                                     archive=os.path.basename(arch_name)):
+                        materialize.materialize(tree, self.dir)
+                except OSError as exc:
+                    logging.error("Unable to copy files from cache: %s.",
+                                  exc)
+                    return False
+            return True
+
+        with timing.span('extract_archive',
+                         archive=os.path.basename(arch_name)):
+            return utils.extract_archive(arch_name, title, params=files,
+                                         threads=threads, cwd=self.dir)
+
     def _save_save(self):
         """
         Get the saves from emulator and store it where configuration is placed
@@ -106,7 +258,6 @@ class Base(object):
         if self.all_options.get('wrapper_save_state', '0') != '1':
             return True
 
-        os.chdir(self.dir)
         save_path = self._get_saves_dir()
         if not save_path:
             return True
@@ -114,14 +265,14 @@ class Base(object):
         if os.path.exists(self.save_filename):
             os.unlink(self.save_filename)
 
-        curdir = os.path.abspath('.')
-
-        if not utils.create_archive(self.save_filename, '', [save_path]):
+        # save states are small, and there is no point for using multiple
+        # threads for compressing them, so that in-process archivers can be
+        # used.
+        if not utils.create_archive(self.save_filename, '', [save_path],
+                                    cwd=self.dir):
             logging.error('Error: archiving save state failed.')
-            os.chdir(curdir)
             return False
 
-        os.chdir(curdir)
         return True
 
     def _load_save(self):
@@ -131,13 +282,11 @@ class Base(object):
         if self.all_options.get('wrapper_save_state', '0') != '1':
             return True
 
+        persist.wait_for(self.save_filename)
         if not os.path.exists(self.save_filename):
             return True
 
-        curdir = os.path.abspath('.')
-        os.chdir(self.dir)
-        utils.extract_archive(self.save_filename)
-        os.chdir(curdir)
+        utils.extract_archive(self.save_filename, cwd=self.dir)
         return True
 
     def _get_saves_dir(self):
@@ -176,6 +325,24 @@ class Base(object):
         needed to calculate new paths so that emulator can find assets.
         """
         logging.debug("_normalize_options")
+        inputs = []
+        changed_options = self.plan.get(
+            'normalized_options',
+            functools.partial(self._get_normalized_options, inputs), inputs)
+
+        self.fsuae_options.update(
+            (key, val.replace('$WRAPPER', self.dir, 1)
+             if val.startswith('$WRAPPER') else val)
+            for key, val in changed_options.items())
+
+    def _get_normalized_options(self, inputs=None):
+        """
+        Return dictionary of the options with paths, which needs to be
+        changed. Values starting with $WRAPPER are left as is, since they
+        depend on temporary directory. Paths of the configuration files which
+        were read, and paths of the assets which existence was checked, are
+        appended to the inputs list.
+        """
         options = ['wrapper_archive', 'wrapper_whdload_base',
                    'accelerator_rom', 'base_dir', 'cdrom_drive_0',
                    'cdroms_dir', 'controllers_dir', 'cpuboard_flash_ext_file',
@@ -196,7 +363,7 @@ class Base(object):
 
         changed_options = {}
 
-        for key, val in utils.get_config(self.conf_file).items():
+        for key, val in utils.get_config(self.conf_file, inputs).items():
 
             if key not in options:
                 continue
@@ -211,22 +378,25 @@ class Base(object):
                 continue
 
             if val.startswith('$WRAPPER'):
-                changed_options[key] = val.replace('$WRAPPER', self.dir)
+                changed_options[key] = val
                 continue
 
             if val.startswith('$CONFIG'):
-                abspath = utils.interpolate_variables(val, self.conf_file)
+                abspath = utils.interpolate_variables(val, self.conf_file,
+                                                      inputs=inputs)
                 changed_options[key] = abspath
                 logging.info("%s: %s => %s", key, val, abspath)
                 continue
 
             _val = os.path.abspath(val)
+            if inputs is not None:
+                inputs.append(_val)
             if os.path.exists(_val):
                 changed_options[key] = _val
             else:
                 changed_options[key] = val
 
-        self.fsuae_options.update(changed_options)
+        return changed_options
 
     def _validate_options(self):
         """Validate mandatory options"""
@@ -242,7 +412,8 @@ class Base(object):
                             "`wrapper_archiver' option, fall back to 7z")
             self.all_options['wrapper_archiver'] = "7z"
 
-        if not path.which(self.all_options['wrapper_archiver']):
+        if not file_archive.Archivers.is_available(
+                self.all_options['wrapper_archiver']):
             logging.error("Cannot find archiver `%s'.",
                           self.all_options['wrapper_archiver'])
             return False
@@ -265,6 +436,7 @@ class ArchiveBase(Base):
         super(ArchiveBase, self).__init__(conf_file, fsuae_options,
                                           configuration)
         self.arch_filepath = None
+        self.members = {}
 
     def _set_assets_paths(self):
         """
@@ -281,16 +453,46 @@ class ArchiveBase(Base):
             else:
                 self.arch_filepath = os.path.join(conf_abs_dir, arch)
 
+    def _get_archives(self):
+        archives = super(ArchiveBase, self)._get_archives()
+        if self.arch_filepath:
+            archives.insert(0, self.arch_filepath)
+        return archives
+
+    def _get_stages(self):
+        graph = {'extract': (self._extract, ())}
+        graph.update(super(ArchiveBase, self)._get_stages())
+        graph['copy_conf'] = (self._copy_conf, ('extract', 'load_save'))
+        return graph
+
+    def _get_members(self):
+        """
+        Return list of (name, size) tuples for files selected for extraction
+        from the archive, or None if whole archive should be extracted.
+        """
+        if self.arch_filepath not in self.members:
+            selected = None
+            if os.path.exists(self.arch_filepath):
+                selected = members.get_members(self.arch_filepath,
+                                               self.all_options)
+            self.members[self.arch_filepath] = selected
+        return self.members[self.arch_filepath]
+
+    def _get_unpacked_size(self, arch_name):
+        if arch_name == self.arch_filepath and self._get_members():
+            return sum(size for _, size in self._get_members())
+        return super(ArchiveBase, self)._get_unpacked_size(arch_name)
+
     def _extract(self):
         """Extract archive to temp dir"""
         logging.debug("_extract")
 
-        title = self._get_title()
-        curdir = os.path.abspath('.')
-        os.chdir(self.dir)
-        result = utils.extract_archive(self.arch_filepath, title)
-        os.chdir(curdir)
-        return result
+        persist.wait_for(self.arch_filepath)
+        files = None
+        if self._get_members():
+            files = sorted(name for name, _ in self._get_members())
+        return self._extract_archive(self.arch_filepath, self._get_title(),
+                                     files)
 
     def _validate_options(self):
         logging.debug("_validate_options")
@@ -302,7 +504,10 @@ class ArchiveBase(Base):
         if 'wrapper_archive' not in self.all_options:
             logging.warning("Configuration lacks of optional `wrapper_archive'"
                             " option.\n")
-            wrapper_archive = self._get_wrapper_archive_name()
+            conf_dir = os.path.dirname(os.path.abspath(self.conf_file))
+            wrapper_archive = self.plan.get('wrapper_archive',
+                                            self._get_wrapper_archive_name,
+                                            [conf_dir])
             if wrapper_archive is None:
                 logging.error("Configuration lacks of optional "
                               "`wrapper_archive', cannot deduct the name by "
@@ -316,13 +521,13 @@ class ArchiveBase(Base):
         """
         Return full path to the archive name using configuration file
         basename and appending one of the expected archive extensions.
+        Collection index is consulted first, to avoid directory scan.
         """
+        fname = index.get_archive_name(self.conf_file, index.get_db_path(
+            self.all_options.get('wrapper_index_db')))
+        if fname:
+            return fname
+
         basename = os.path.splitext(os.path.basename(self.conf_file))[0]
         file_list = os.listdir(os.path.dirname(self.conf_file))
-        for fname in file_list:
-            for ext in ('.7z', '.lha', '.lzx', '.zip', '.rar', '.tar', '.tgz',
-                        '.tar.gz', '.tar.bz2', '.tar.xz'):
-                if ((basename + ext).lower() == fname.lower() and
-                   basename == os.path.splitext(fname)[0]):
-                    return fname
-        return None
+        return index.find_archive(basename, index.get_names_map(file_list))
@@ -0,0 +1,485 @@
+"""
+Persistent cache for extracted archives
+
+Every archive is extracted only once into the cache directory, next launches
+will reuse already extracted tree. Entries are addressed by the archive
+content hash, which is computed once for every archive size and modification
+time. For archives not seen before, hash is computed during extraction.
+"""
+import contextlib
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from fs_uae_wrapper import digest, manifest, timing, utils
+
+DEFAULT_SIZE = 10240  # MiB
+# number of attempts to get the entry, which is evicted by other processes
+FETCH_ATTEMPTS = 3
+
+
+def get_cache_dir(options):
+    """
+    Return path to the cache directory or None, if cache is not enabled.
+    Cache is enabled either by wrapper_cache option set to "1" (in this case
+    per user cache directory will be used) or by providing the directory
+    through wrapper_cache_dir option.
+    """
+    if options.get('wrapper_cache_dir'):
+        return os.path.abspath(os.path.expanduser(
+            options['wrapper_cache_dir']))
+
+    if options.get('wrapper_cache', '0') != '1':
+        return None
+
+    xdg_cache = os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(xdg_cache, 'fs-uae-wrapper')
+
+
+def get_cache(options):
+    """Return Cache object or None, if cache is not enabled"""
+    directory = get_cache_dir(options)
+    if not directory:
+        return None
+
+    size = options.get('wrapper_cache_size', DEFAULT_SIZE)
+    try:
+        size = int(size)
+    except ValueError:
+        logging.warning("Wrong value for `wrapper_cache_size': %s, using "
+                        "default %d MiB.", size, DEFAULT_SIZE)
+        size = DEFAULT_SIZE
+
+    return Cache(directory, size)
+
+
+def get_file_hash(fname):
+    """Return hex digest of provided file contents"""
+    return digest.hash_file(fname)
+
+
+def get_dir_size(path):
+    """Return size in bytes of all the files in the directory tree"""
+    size = 0
+    for root, _, fnames in os.walk(path):
+        for fname in fnames:
+            size += os.lstat(os.path.join(root, fname)).st_size
+    return size
+
+
+def get_files_key(key, files):
+    """
+    Return key for the entry with only provided files extracted from the
+    archive with the key
+    """
+    if not files:
+        return key
+    return key + '-' + hashlib.sha1('\n'.join(sorted(files))
+                                    .encode('utf-8')).hexdigest()[:16]
+
+
+class Cache(object):
+    """
+    Cache of extracted archives. Layout of the cache directory is as follows:
+
+        entries/<key>/tree       extracted archive contents
+        entries/<key>/meta.json  entry metadata (size, last use, hits, pin)
+        ids/<path hash>.json     archive identity (size, mtime) to key map
+        locks/<key>.lock         lock files for the entries
+        tmp/                     staging area for entries being extracted
+        stats.json               hits, misses and evictions counters
+    """
+    def __init__(self, directory, size=DEFAULT_SIZE):
+        """
+        Params:
+            directory:  path to the cache directory
+            size:       cache size budget in MiB
+        """
+        self.directory = directory
+        self.size = size * 1024 * 1024
+        self.entries_dir = os.path.join(directory, 'entries')
+        self.ids_dir = os.path.join(directory, 'ids')
+        self.locks_dir = os.path.join(directory, 'locks')
+        self.tmp_dir = os.path.join(directory, 'tmp')
+        for path in (self.entries_dir, self.ids_dir, self.locks_dir,
+                     self.tmp_dir):
+            os.makedirs(path, exist_ok=True)
+
+    def get_key(self, arch_name, compute=True):
+        """
+        Return the cache key for the archive. Content hash will be calculated
+        only if the archive size or modification time has changed since last
+        call, and there is no digest manifest for the archive. If compute is
+        False, None is returned instead of calculating the hash.
+        """
+        arch_name = os.path.abspath(arch_name)
+        stat = os.stat(arch_name)
+        ident = utils.read_json(self._get_ident_path(arch_name))
+        if (ident and ident.get('size') == stat.st_size and
+                ident.get('mtime') == stat.st_mtime_ns):
+            return ident['key']
+
+        digests = manifest.load_digests(arch_name)
+        if digests:
+            key = digests['digest']
+        elif not compute:
+            return None
+        else:
+            logging.debug("Calculating hash for `%s'.", arch_name)
+            key = get_file_hash(arch_name)
+        self._set_key(arch_name, stat, key)
+        return key
+
+    def get_entry(self, key):
+        """Return path to the entry directory"""
+        return os.path.join(self.entries_dir, key)
+
+    def get_size(self, arch_name, files=None):
+        """
+        Return size in bytes of the entry for the archive (or for only
+        provided files from it), or None if it's not in the cache. Archive
+        is not hashed for that.
+        """
+        try:
+            key = self.get_key(arch_name, compute=False)
+        except OSError:
+            return None
+        if key is None:
+            return None
+
+        entry = self.get_entry(get_files_key(key, files))
+        meta = utils.read_json(os.path.join(entry, 'meta.json'))
+        if meta is None or not os.path.isdir(os.path.join(entry, 'tree')):
+            return None
+        return meta.get('size')
+
+    def get_lock(self, key):
+        """Return path to the lock file for the entry"""
+        return os.path.join(self.locks_dir, key + '.lock')
+
+    @contextlib.contextmanager
+    def fetch(self, arch_name, title='', threads=None, files=None):
+        """
+        Context manager which yields path to the directory with extracted
+        archive contents, or None in case of failure. Archive is extracted
+        only if it's not present in the cache. Entry is guaranteed not to be
+        evicted while inside the context. If files are provided, only those
+        will be extracted, and such partial entry is stored separately.
+        """
+        try:
+            with timing.span('cache_key',
+                             archive=os.path.basename(arch_name)):
+                key = self.get_key(arch_name, compute=False)
+        except OSError:
+            logging.error("Archive `%s' doesn't exists.", arch_name)
+            yield None
+            return
+
+        staging = None
+        if key is None:
+            staging, key = self._extract(arch_name, title, threads, files)
+            if staging is None:
+                yield None
+                return
+
+        key = get_files_key(key, files)
+        entry = self.get_entry(key)
+        tree = os.path.join(entry, 'tree')
+
+        for _ in range(FETCH_ATTEMPTS):
+            with utils.lock_file(self.get_lock(key)):
+                if not self._update_entry(entry):
+                    logging.info("Cache miss for `%s'.", arch_name)
+                    self._count('misses')
+                    if not self._store(arch_name, entry, title, threads,
+                                       files, staging):
+                        yield None
+                        return
+                else:
+                    logging.info("Cache hit for `%s'.", arch_name)
+                    self._count('hits')
+                    self._discard(staging)
+                staging = None
+
+            self.evict(keep=key)
+
+            # exclusive lock cannot be atomically turned into shared one, so
+            # entry may be evicted by other process in the meantime
+            with utils.lock_file(self.get_lock(key), shared=True):
+                if os.path.isdir(tree):
+                    yield tree
+                    return
+            logging.debug("Cache entry for `%s' vanished, storing it again.",
+                          arch_name)
+
+        logging.error("Cache entry for `%s' vanished.", arch_name)
+        yield None
+
+    def store(self, arch_name, threads=None, files=None):
+        """
+        Extract archive into the cache, unless it's already there. Unlike
+        fetch, entry is not marked as used. Return entry metadata, or None in
+        case of failure.
+        """
+        try:
+            key = self.get_key(arch_name, compute=False)
+        except OSError:
+            logging.error("Archive `%s' doesn't exists.", arch_name)
+            return None
+
+        staging = None
+        if key is None:
+            staging, key = self._extract(arch_name, '', threads, files)
+            if staging is None:
+                return None
+
+        key = get_files_key(key, files)
+        entry = self.get_entry(key)
+        meta_fname = os.path.join(entry, 'meta.json')
+        with utils.lock_file(self.get_lock(key)):
+            meta = utils.read_json(meta_fname)
+            if meta is None or not os.path.isdir(os.path.join(entry,
+                                                              'tree')):
+                if not self._store(arch_name, entry, '', threads, files,
+                                   staging):
+                    return None
+                meta = utils.read_json(meta_fname)
+            else:
+                self._discard(staging)
+
+        self.evict(keep=key)
+        return meta
+
+    def get_entries(self):
+        """Return dictionary of the entry keys and their metadata"""
+        entries = {}
+        for key in os.listdir(self.entries_dir):
+            meta = utils.read_json(os.path.join(self.entries_dir, key,
+                                                'meta.json'))
+            if meta is not None:
+                entries[key] = meta
+        return entries
+
+    def get_usage(self):
+        """Return size in bytes of all the entries in the cache"""
+        return sum(meta.get('size', 0) for meta in self.get_entries().values())
+
+    def get_stats(self):
+        """Return dictionary with hits, misses and evictions counters"""
+        stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'evicted': 0}
+        stats.update(utils.read_json(os.path.join(self.directory,
+                                                  'stats.json')) or {})
+        return stats
+
+    def pin(self, key, pinned=True):
+        """
+        Set pin of the entry, pinned entries are never evicted. Return
+        True/False
+        """
+        meta_fname = os.path.join(self.get_entry(key), 'meta.json')
+        with utils.lock_file(self.get_lock(key)):
+            meta = utils.read_json(meta_fname)
+            if meta is None:
+                return False
+            meta['pinned'] = pinned
+            utils.write_json(meta_fname, meta)
+        return True
+
+    def remove(self, key):
+        """Remove entry, unless it's in use. Return True/False"""
+        with utils.lock_file(self.get_lock(key), blocking=False) as locked:
+            if not locked:
+                return False
+            shutil.rmtree(self.get_entry(key), ignore_errors=True)
+        return True
+
+    def evict(self, keep=None, size=None, max_age=None):
+        """
+        Remove least recently used entries until cache fits in the size
+        budget (or provided size in bytes), and entries not used for more
+        than max_age seconds. Entries currently in use and pinned ones are
+        skipped. Return tuple of number of removed entries and their size.
+        """
+        size = self.size if size is None else size
+        now = time.time()
+        entries = self.get_entries()
+        total = sum(meta.get('size', 0) for meta in entries.values())
+        removed = freed = 0
+        for key, meta in sorted(entries.items(),
+                                key=lambda x: x[1].get('last_used', 0)):
+            expired = (max_age is not None and
+                       now - meta.get('last_used', 0) > max_age)
+            if total <= size and not expired:
+                break
+            if key == keep or meta.get('pinned'):
+                continue
+            if not self.remove(key):
+                continue
+            logging.debug("Evicting `%s' from cache.", meta['archive'])
+            total -= meta.get('size', 0)
+            removed += 1
+            freed += meta.get('size', 0)
+
+        if removed:
+            self._count('evictions', removed)
+            self._count('evicted', freed)
+        return removed, freed
+
+    def check(self, key, meta, deep=False):
+        """
+        Check whether entry still matches its source archive. Archive is
+        hashed again only if its size or modification time has changed.
+        Extracted files are compared with the archive listing. In deep mode
+        they are also hashed and compared with the file digests from the
+        digest manifest, if available.
+        Return "ok", "missing" (archive is gone), "stale" (archive contents
+        has changed) or "corrupt" (extracted files differ from the archive
+        contents).
+        """
+        arch_name = meta.get('archive', '')
+        try:
+            arch_key = self.get_key(arch_name)
+        except OSError:
+            return 'missing'
+        if key.split('-', 1)[0] != arch_key:
+            return 'stale'
+
+        hashes = {}
+        if deep:
+            digests = manifest.load_digests(arch_name) or {}
+            if digests.get('digest') == arch_key:
+                hashes = digests.get('files', {})
+        listing = utils.list_archive(arch_name)
+        if listing is None and not hashes:
+            return 'ok'
+
+        tree = os.path.join(self.get_entry(key), 'tree')
+        files = None
+        if listing is not None:
+            files = {os.path.normpath(name): size for name, size in listing
+                     if not os.path.isdir(os.path.join(tree, name)) and
+                     not os.path.islink(os.path.join(tree, name))}
+        found = 0
+        links = 0
+        for root, _, fnames in os.walk(tree):
+            for fname in fnames:
+                path = os.path.join(root, fname)
+                rel_path = os.path.relpath(path, tree)
+                if os.path.islink(path):
+                    # symbolic links are not listed by all the archivers
+                    links += 1
+                    continue
+                if (files is not None and
+                        files.get(rel_path) != os.lstat(path).st_size):
+                    return 'corrupt'
+                if (rel_path in hashes and
+                        get_file_hash(path) != hashes[rel_path]):
+                    return 'corrupt'
+                found += 1
+
+        if files is not None:
+            # number of requested files for partial entry includes links
+            if meta.get('files') and found + links != meta['files']:
+                return 'corrupt'
+            if not meta.get('files') and found != len(files):
+                return 'corrupt'
+        return 'ok'
+
+    def _count(self, name, value=1):
+        """Increase the counter"""
+        fname = os.path.join(self.directory, 'stats.json')
+        try:
+            with utils.lock_file(os.path.join(self.locks_dir, 'stats.lock')):
+                stats = utils.read_json(fname) or {}
+                stats[name] = stats.get(name, 0) + value
+                utils.write_json(fname, stats)
+        except OSError as exc:
+            logging.debug("Cannot update cache statistics: %s.", exc)
+
+    def _update_entry(self, entry):
+        """Update usage data for the entry. Return False if it's missing"""
+        meta_fname = os.path.join(entry, 'meta.json')
+        meta = utils.read_json(meta_fname)
+        if meta is None or not os.path.isdir(os.path.join(entry, 'tree')):
+            return False
+
+        meta['last_used'] = time.time()
+        meta['hits'] = meta.get('hits', 0) + 1
+        utils.write_json(meta_fname, meta)
+        return True
+
+    def _get_ident_path(self, arch_name):
+        """Return path to the identity file for the archive"""
+        return os.path.join(self.ids_dir, hashlib.sha1(
+            arch_name.encode('utf-8')).hexdigest() + '.json')
+
+    def _set_key(self, arch_name, stat, key):
+        """Store the key for the archive identified by its stat result"""
+        utils.write_json(self._get_ident_path(arch_name),
+                         {'archive': arch_name,
+                          'size': stat.st_size,
+                          'mtime': stat.st_mtime_ns,
+                          'key': key})
+
+    def _extract(self, arch_name, title, threads, files=None):
+        """
+        Extract archive into the new staging directory, digesting it on the
+        way. Archive key and digest manifest are stored. Return tuple of
+        staging directory and archive key, or (None, None) in case of
+        failure.
+        """
+        arch_name = os.path.abspath(arch_name)
+        stat = os.stat(arch_name)
+        staging = tempfile.mkdtemp(suffix=f'-{os.getpid()}',
+                                   dir=self.tmp_dir)
+        tree = os.path.join(staging, 'tree')
+        os.mkdir(tree)
+
+        digests = digest.Digests()
+        with timing.span('cache_store', archive=os.path.basename(arch_name)):
+            result = utils.extract_archive(arch_name, title, params=files,
+                                           threads=threads, cwd=tree,
+                                           digests=digests)
+        if not result:
+            self._discard(staging)
+            return None, None
+
+        if digests.archive is None:
+            # archiver wasn't able to digest the archive
+            logging.debug("Calculating hash for `%s'.", arch_name)
+            digests.archive = get_file_hash(arch_name)
+        self._set_key(arch_name, stat, digests.archive)
+        manifest.store_digests(arch_name, digests)
+
+        now = time.time()
+        utils.write_json(os.path.join(staging, 'meta.json'),
+                         {'archive': arch_name,
+                          'files': len(files) if files else None,
+                          'size': get_dir_size(tree),
+                          'created': now,
+                          'last_used': now,
+                          'hits': 0})
+        return staging, digests.archive
+
+    def _store(self, arch_name, entry, title, threads, files=None,
+               staging=None):
+        """
+        Move staging directory into the new cache entry. Archive is
+        extracted first, unless staging directory is provided.
+        """
+        if staging is None:
+            staging, _ = self._extract(arch_name, title, threads, files)
+            if staging is None:
+                return False
+
+        shutil.rmtree(entry, ignore_errors=True)
+        os.rename(staging, entry)
+        return True
+
+    def _discard(self, staging):
+        """Remove staging directory, which turned out not to be needed"""
+        if staging is not None:
+            shutil.rmtree(staging, ignore_errors=True)
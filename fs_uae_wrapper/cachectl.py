@@ -0,0 +1,202 @@
+"""
+Cache maintenance commands - statistics, pinning favourite titles, pruning
+and verifying entries against their source archives.
+"""
+import concurrent.futures
+import logging
+import os
+import shutil
+import sys
+import time
+
+from fs_uae_wrapper import cache, prefetch, utils
+
+COMMANDS = ('stats', 'pin', 'unpin', 'prune', 'verify')
+MIB = 1024 * 1024
+DAY = 24 * 60 * 60
+
+
+def get_targets(arch_cache, target, options):
+    """
+    Return list of (cache, archive, files) tuples for the target, which is
+    either a configuration file, or an archive
+    """
+    if not target.endswith('.fs-uae'):
+        return [(arch_cache, os.path.abspath(target), None)]
+
+    collection = prefetch.Collection(options)
+    collection.add(target)
+    return [(cache.Cache(directory, size), arch_name, files)
+            for (directory, arch_name, files), size
+            in collection.jobs.items()]
+
+
+def stats(arch_cache, out):
+    """Print statistics of the cache and its entries"""
+    entries = arch_cache.get_entries()
+    counters = arch_cache.get_stats()
+    total = sum(meta.get('size', 0) for meta in entries.values())
+    launches = counters['hits'] + counters['misses']
+    ratio = 100.0 * counters['hits'] / launches if launches else 0.0
+
+    out.write(f"Cache `{arch_cache.directory}': {len(entries)} entries, "
+              f"{total / MIB:.1f} MiB of {arch_cache.size / MIB:.1f} MiB, "
+              f"{sum(1 for meta in entries.values() if meta.get('pinned'))} "
+              f"pinned.\n"
+              f"Hits: {counters['hits']}, misses: {counters['misses']}, "
+              f"hit ratio: {ratio:.1f}%, evicted: {counters['evictions']} "
+              f"entries ({counters['evicted'] / MIB:.1f} MiB).\n")
+    if not entries:
+        return True
+
+    out.write(f"\n{'hits':>6} {'ratio':>6} {'MiB':>10} {'saved MiB':>10}  "
+              f"{'last used':16}  archive\n")
+    for meta in sorted(entries.values(),
+                       key=lambda meta: (-meta.get('hits', 0),
+                                         meta.get('archive', ''))):
+        hits = meta.get('hits', 0)
+        size = meta.get('size', 0)
+        last_used = time.strftime('%Y-%m-%d %H:%M',
+                                  time.localtime(meta.get('last_used', 0)))
+        flags = ''
+        if meta.get('pinned'):
+            flags += ' [pinned]'
+        if meta.get('files'):
+            flags += f" [{meta['files']} files]"
+        # entry was missed once, when it was created
+        out.write(f"{hits:>6} {100.0 * hits / (hits + 1):>5.1f}% "
+                  f"{size / MIB:>10.1f} {hits * size / MIB:>10.1f}  "
+                  f"{last_used}  {meta.get('archive')}{flags}\n")
+    return True
+
+
+def pin(arch_cache, target, options, out, pinned=True):
+    """
+    Pin (or unpin) entries for the target. Archives are extracted into the
+    cache first, if needed. Return True/False
+    """
+    if not target:
+        logging.error("Configuration file or archive to pin is needed.")
+        return False
+
+    threads = utils.get_threads(options.get('wrapper_threads'))
+    result = True
+    for entry_cache, arch_name, files in get_targets(arch_cache, target,
+                                                     options):
+        if pinned:
+            meta = entry_cache.store(arch_name, threads,
+                                     list(files) if files else None)
+            if meta is None:
+                result = False
+                continue
+        try:
+            key = cache.get_files_key(entry_cache.get_key(arch_name), files)
+        except OSError:
+            logging.error("Archive `%s' doesn't exists.", arch_name)
+            result = False
+            continue
+        if not entry_cache.pin(key, pinned):
+            logging.error("Archive `%s' is not in the cache.", arch_name)
+            result = False
+            continue
+        out.write(f"{'Pinned' if pinned else 'Unpinned'} `{arch_name}'.\n")
+    return result
+
+
+def prune(arch_cache, options, out):
+    """
+    Remove least recently used entries down to the size target, and entries
+    not used for the number of days. Leftovers of interrupted extractions
+    are removed as well. Return True/False
+    """
+    size = arch_cache.size
+    max_age = None
+    try:
+        if options.get('wrapper_prune_size'):
+            size = int(options['wrapper_prune_size']) * MIB
+        if options.get('wrapper_prune_age'):
+            max_age = float(options['wrapper_prune_age']) * DAY
+    except ValueError as exc:
+        logging.error("Wrong value for prune target: %s.", exc)
+        return False
+
+    for name in os.listdir(arch_cache.tmp_dir):
+        pid = name.rsplit('-', 1)[-1]
+        if pid.isdigit() and not _is_running(int(pid)):
+            logging.debug("Removing leftover `%s'.", name)
+            shutil.rmtree(os.path.join(arch_cache.tmp_dir, name),
+                          ignore_errors=True)
+
+    removed, freed = arch_cache.evict(size=size, max_age=max_age)
+    out.write(f"Removed {removed} entries, {freed / MIB:.1f} MiB freed, "
+              f"{arch_cache.get_usage() / MIB:.1f} MiB left.\n")
+    return True
+
+
+def _is_running(pid):
+    """Return True if process with the pid exists"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def _check(directory, key, meta, deep):
+    """Verify entry in the worker process"""
+    return cache.Cache(directory).check(key, meta, deep)
+
+
+def verify(arch_cache, options, out):
+    """
+    Verify entries against their source archives, in parallel. Extracted
+    files are hashed only in deep mode (wrapper_verify_deep option set to
+    "1"). Stale and corrupt entries are removed. Return False if any of
+    those was found.
+    """
+    entries = arch_cache.get_entries()
+    jobs = utils.get_threads(options.get('wrapper_threads'))
+    deep = options.get('wrapper_verify_deep', '0') == '1'
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        futures = {pool.submit(_check, arch_cache.directory, key, meta,
+                               deep): key
+                   for key, meta in entries.items()}
+        for future in concurrent.futures.as_completed(futures):
+            key = futures[future]
+            try:
+                results[key] = future.result()
+            except Exception as exc:  # worker has crashed
+                logging.error("Verifying `%s' failed: %s.",
+                              entries[key].get('archive'), exc)
+                results[key] = 'corrupt'
+
+    counts = dict.fromkeys(('ok', 'missing', 'stale', 'corrupt'), 0)
+    for key, status in sorted(results.items(),
+                              key=lambda x: entries[x[0]].get('archive')):
+        counts[status] += 1
+        if status == 'ok':
+            continue
+        if status in ('stale', 'corrupt'):
+            arch_cache.remove(key)
+        out.write(f"{status}: {entries[key].get('archive')}\n")
+
+    out.write(f"Verified {len(results)} entries: {counts['ok']} ok, "
+              f"{counts['missing']} with missing archive, {counts['stale']} "
+              f"stale, {counts['corrupt']} corrupt.\n")
+    return not counts['stale'] and not counts['corrupt']
+
+
+def run(command, target, options, out=None):
+    """Run cache maintenance command. Return True/False"""
+    out = out or sys.stdout
+    arch_cache = cache.get_cache(dict(options, wrapper_cache='1'))
+    if command == 'stats':
+        return stats(arch_cache, out)
+    if command in ('pin', 'unpin'):
+        return pin(arch_cache, target, options, out, command == 'pin')
+    if command == 'prune':
+        return prune(arch_cache, options, out)
+    return verify(arch_cache, options, out)
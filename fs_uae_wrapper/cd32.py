@@ -28,21 +28,13 @@ class Wrapper(base.ArchiveBase):
             - run the emulation
             - archive save state
         """
-        super(Wrapper, self).run()
-        if not self._validate_options():
+        if not super(Wrapper, self).run():
             return False
 
-        if not self._extract():
+        if not self._prepare():
             return False
 
-        for method in (self._copy_conf, self._load_save):
-            if not method():
-                return False
-
         if not self._run_emulator():
             return False
 
-        if self._get_saves_dir():
-            return self._save_save()
-
-        return True
+        return self._finish()
@@ -0,0 +1,173 @@
+"""
+Content digests of archives and files, computed while the data passes
+through the archivers, so that archives don't have to be read once again
+just for hashing.
+"""
+import hashlib
+import mmap
+import os
+
+ALGORITHM = 'sha1'
+CHUNK_SIZE = 1024 * 1024
+# files of at least that size are hashed through memory mapping
+MMAP_SIZE = 64 * 1024 * 1024
+
+
+def new():
+    """Return new hash object"""
+    return hashlib.new(ALGORITHM)
+
+
+def hash_file(fname):
+    """
+    Return hex digest of the file contents. Big files are memory mapped,
+    which saves copying the data into the buffers.
+    """
+    digest = new()
+    with open(fname, 'rb') as fobj:
+        size = os.fstat(fobj.fileno()).st_size
+        if size >= MMAP_SIZE:
+            with mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ) as mem:
+                if hasattr(mem, 'madvise'):
+                    mem.madvise(mmap.MADV_SEQUENTIAL)
+                digest.update(mem)
+        else:
+            for chunk in iter(lambda: fobj.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Stream(object):
+    """
+    File object of the archive member, which digests the data sequentially
+    read or written through it. If the digests dictionary is provided, hex
+    digest is stored there under the member name, when stream is closed.
+    """
+    def __init__(self, fobj, digests=None, name=None):
+        self.fobj = fobj
+        self.digest = new()
+        self.digests = digests
+        self.name = name
+
+    def read(self, size=-1):
+        """Read data from the file and digest it"""
+        data = self.fobj.read(size)
+        self.digest.update(data)
+        return data
+
+    def write(self, data):
+        """Write data into the file and digest it"""
+        self.digest.update(data)
+        return self.fobj.write(data)
+
+    def hexdigest(self):
+        """Return hex digest of the data read or written so far"""
+        return self.digest.hexdigest()
+
+    def close(self):
+        """Close the file and store the digest"""
+        self.fobj.close()
+        if self.digests is not None:
+            self.digests[self.name] = self.hexdigest()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self.fobj, name)
+
+
+class Digests(object):
+    """Digests collected during archive operation"""
+    def __init__(self):
+        self.archive = None
+        self.files = {}
+
+
+class Reader(object):
+    """
+    Archive file object, which digests the data read through it, as long
+    as it's read in order. Data read after seeking forward is not digested,
+    the rest of the file is digested on finish instead, so that digest of
+    the whole file is always computed, regardless of the reading pattern.
+    Sequential readers, like tar, read the file exactly once, zip archive
+    read with the zipfile module has only its central directory read twice.
+    """
+    def __init__(self, fobj):
+        self.fobj = fobj
+        self.digest = new()
+        self.hashed = 0
+
+    def read(self, size=-1):
+        """Read data from the file and digest it"""
+        pos = self.fobj.tell()
+        data = self.fobj.read(size)
+        self._update(pos, data)
+        return data
+
+    def copy(self, target):
+        """Copy whole file contents into target file object"""
+        for chunk in iter(lambda: self.read(CHUNK_SIZE), b''):
+            target.write(chunk)
+
+    def hexdigest(self):
+        """Digest the rest of the file, and return hex digest"""
+        self._catch_up(os.fstat(self.fobj.fileno()).st_size)
+        return self.digest.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self.fobj, name)
+
+    def _update(self, pos, data):
+        """Digest part of the data, which wasn't digested yet"""
+        if pos <= self.hashed < pos + len(data):
+            self.digest.update(memoryview(data)[self.hashed - pos:])
+            self.hashed = pos + len(data)
+
+    def _catch_up(self, pos):
+        """
+        Digest the file up to the position. Big parts are memory mapped, like
+        in hash_file.
+        """
+        if pos - self.hashed >= MMAP_SIZE:
+            with mmap.mmap(self.fobj.fileno(), 0,
+                           access=mmap.ACCESS_READ) as mem:
+                if hasattr(mem, 'madvise'):
+                    mem.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(mem) as view:
+                    self.digest.update(view[self.hashed:pos])
+            self.hashed = pos
+            return
+
+        while self.hashed < pos:
+            chunk = os.pread(self.fobj.fileno(),
+                             min(CHUNK_SIZE, pos - self.hashed), self.hashed)
+            if not chunk:
+                break
+            self.digest.update(chunk)
+            self.hashed += len(chunk)
+
+
+class Writer(object):
+    """
+    Archive file object for sequential writers, which digests data written
+    through it
+    """
+    def __init__(self, fobj):
+        self.fobj = fobj
+        self.digest = new()
+
+    def write(self, data):
+        """Write data into the file and digest it"""
+        self.digest.update(data)
+        return self.fobj.write(data)
+
+    def hexdigest(self):
+        """Return hex digest of written data"""
+        return self.digest.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self.fobj, name)
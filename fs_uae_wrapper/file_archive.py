@@ -1,12 +1,16 @@
 """
 File archive classes
 """
+import concurrent.futures
 import logging
 import os
 import re
+import stat
 import subprocess
+import tarfile
+import zipfile
 
-from fs_uae_wrapper import path
+from fs_uae_wrapper import digest, path, process
 
 
 class Archive(object):
@@ -14,90 +18,691 @@ class Archive(object):
     ADD = ('a',)
     EXTRACT = ('x',)
     ARCH = 'false'
-
-    def __init__(self):
+    # switches for enabling multithreading, {} is replaced by threads number
+    THREADS = ()
+    # commands for adding/replacing and removing files from existing archive
+    UPDATE = None
+    DELETE = None
+    # commands for listing archive contents and printing single file
+    LIST = None
+    PRINT = None
+
+    def __init__(self, threads=None):
+        """
+        Params:
+            threads:    maximal number of threads archiver may use, None or 1
+                        means single threaded operation
+        """
         self.archiver = path.which(self.ARCH)
         self._compress = self.archiver
         self._decompress = self.archiver
+        self.threads = threads
+        # digest.Digests object, if archive digest should be computed
+        # during extraction or creation
+        self.digests = None
+
+    def is_parallel(self):
+        """Return True if archiver will use more than one thread"""
+        return bool(self.archiver and self.THREADS and self.threads and
+                    self.threads > 1)
 
-    def create(self, arch_name, files=None):
+    def create(self, arch_name, files=None, cwd=None):
         """
-        Create archive. Return True on success, False otherwise.
+        Create archive out of files placed in cwd directory (current
+        directory by default). Return True on success, False otherwise.
         """
         files = files if files else ['.']
+        return self._create(arch_name, files, cwd)
+
+    def supports_update(self):
+        """Return True if existing archive can be updated in place"""
+        return bool(self.archiver and self.UPDATE and self.DELETE)
+
+    def update(self, arch_name, files=None, deleted=None, cwd=None):
+        """
+        Update existing archive - remove deleted files from it, and add or
+        replace provided files from cwd directory. Return True on success,
+        False otherwise.
+        """
+        if not self.supports_update():
+            logging.error("Archive `%s' cannot be updated.", arch_name)
+            return False
+
+        arch_name = os.path.abspath(arch_name) if cwd else arch_name
+        if deleted:
+            names = self._get_delete_names(deleted)
+            logging.debug("Calling `%s %s %s %s'.", self._compress,
+                          " ".join(self.DELETE), arch_name, " ".join(names))
+            if process.call([self._compress, *self.DELETE, arch_name,
+                             *names], cwd=cwd) != 0:
+                logging.error("Unable to delete files from archive `%s'.",
+                              arch_name)
+                return False
+            if not self._is_deleted(arch_name, deleted):
+                return False
+
+        if files:
+            args = (*self.UPDATE, *self._get_threads_args())
+            logging.debug("Calling `%s %s %s %s'.", self._compress,
+                          " ".join(args), arch_name, " ".join(files))
+            if process.call([self._compress, *args, arch_name, *files],
+                            cwd=cwd) != 0:
+                logging.error("Unable to update archive `%s'.", arch_name)
+                return False
+
+        return True
+
+    def _get_delete_names(self, deleted):
+        """Return archiver arguments for deleting provided paths"""
+        return list(deleted)
+
+    def _is_deleted(self, arch_name, deleted):
+        """
+        Return True if none of the deleted paths (including contents of the
+        deleted directories) is left in the archive. Archivers exit with
+        success even if they have deleted nothing, so archive is listed to
+        confirm that.
+        """
+        listing = self.list(arch_name)
+        if listing is None:
+            logging.error("Cannot confirm deletion of files from archive "
+                          "`%s'.", arch_name)
+            return False
+
+        deleted = [os.path.normpath(path) for path in deleted]
+        for name, _ in listing:
+            name = os.path.normpath(name)
+            if any(name == path or name.startswith(path + '/')
+                   for path in deleted):
+                logging.error("File `%s' was not deleted from archive `%s'.",
+                              name, arch_name)
+                return False
+        return True
+
+    def _create(self, arch_name, files, cwd=None):
+        """Call archiver for creating archive out of provided files"""
+        args = self._get_add_args()
+        arch_name = os.path.abspath(arch_name) if cwd else arch_name
         logging.debug("Calling `%s %s %s %s'.", self._compress,
-                      " ".join(self.ADD), arch_name, " ".join(files))
-        result = subprocess.call([self._compress, *self.ADD, arch_name,
-                                  *files])
+                      " ".join(args), arch_name, " ".join(files))
+        result = process.call([self._compress, *args, arch_name, *files],
+                              cwd=cwd)
         if result != 0:
             logging.error("Unable to create archive `%s'.", arch_name)
             return False
+        self._digest_archive(arch_name)
         return True
 
-    def extract(self, arch_name):
+    def extract(self, arch_name, files=None, cwd=None):
         """
-        Extract archive. Return True on success, False otherwise.
+        Extract archive, or only provided files from it, into cwd directory
+        (current directory by default). Return True on success, False
+        otherwise.
         """
         if not os.path.exists(arch_name):
             logging.error("Archive `%s' doesn't exists.", arch_name)
             return False
 
-        logging.debug("Calling `%s %s %s'.", self._compress,
-                      " ".join(self.ADD), arch_name)
-        result = subprocess.call([self._decompress, *self.EXTRACT, arch_name])
+        files = files if files else []
+        args = self._get_extract_args()
+        arch_name = os.path.abspath(arch_name) if cwd else arch_name
+        logging.debug("Calling `%s %s %s %s'.", self._decompress,
+                      " ".join(args), arch_name, " ".join(files))
+        result = self._call_extract(args, arch_name, files, cwd)
         if result != 0:
             logging.error("Unable to extract archive `%s'.", arch_name)
             return False
         return True
 
+    def _call_extract(self, args, arch_name, files, cwd):
+        """
+        Call archiver for extracting archive and return its exit code.
+        Archivers in general need random access to the archive, so it's
+        digested concurrently, while it's hot in the page cache, instead of
+        reading it once again afterwards.
+        """
+        cmd = [self._decompress, *args, arch_name, *files]
+        if self.digests is None:
+            return process.call(cmd, cwd=cwd)
+
+        with concurrent.futures.ThreadPoolExecutor(1) as pool:
+            future = pool.submit(digest.hash_file, arch_name)
+            result = process.call(cmd, cwd=cwd)
+            try:
+                self.digests.archive = future.result()
+            except OSError as exc:
+                logging.debug("Unable to digest `%s': %s.", arch_name, exc)
+        return result
+
+    def _digest_archive(self, arch_name):
+        """Digest just created archive, if digests are collected"""
+        if self.digests is None:
+            return
+        try:
+            self.digests.archive = digest.hash_file(arch_name)
+        except OSError as exc:
+            logging.debug("Unable to digest `%s': %s.", arch_name, exc)
+
+    def _get_file_digests(self):
+        """
+        Return dictionary for digests of the files, which are extracted or
+        archived, or None if digests are not collected
+        """
+        return None if self.digests is None else self.digests.files
+
+    def _get_reader(self, fobj):
+        """
+        Return file object for reading archive, which digests the data on
+        the way, if digests are collected
+        """
+        return fobj if self.digests is None else digest.Reader(fobj)
+
+    def list(self, arch_name):
+        """
+        Return list of (name, size) tuples for all the files in the archive,
+        or None, if archive cannot be listed.
+        """
+        if not os.path.exists(arch_name):
+            logging.error("Archive `%s' doesn't exists.", arch_name)
+            return None
+
+        if not self.LIST:
+            logging.debug("Listing archives `%s' is not supported.",
+                          arch_name)
+            return None
+
+        logging.debug("Calling `%s %s %s'.", self._decompress,
+                      " ".join(self.LIST), arch_name)
+        result = subprocess.run([self._decompress, *self.LIST, arch_name],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL)
+        if result.returncode != 0:
+            logging.error("Unable to list archive `%s'.", arch_name)
+            return None
+
+        output = result.stdout.decode('utf-8', errors='surrogateescape')
+        return self._parse_list(output)
+
+    def _parse_list(self, output):
+        """Parse archiver listing output into list of (name, size) tuples"""
+        return None
+
+    def read(self, arch_name, fname):
+        """Return contents of the file from archive, or None"""
+        if not self.PRINT:
+            logging.debug("Reading files from archive `%s' is not "
+                          "supported.", arch_name)
+            return None
+
+        logging.debug("Calling `%s %s %s %s'.", self._decompress,
+                      " ".join(self.PRINT), arch_name, fname)
+        result = subprocess.run([self._decompress, *self.PRINT, arch_name,
+                                 fname], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL)
+        if result.returncode != 0:
+            logging.error("Unable to read `%s' from archive `%s'.", fname,
+                          arch_name)
+            return None
+        return result.stdout
+
+    def _get_threads_args(self):
+        """Return archiver switches for multithreading"""
+        if not self.is_parallel():
+            return ()
+        return tuple(arg.format(self.threads) for arg in self.THREADS)
+
+    def _get_add_args(self):
+        """Return archiver arguments for creating archive"""
+        return (*self.ADD, *self._get_threads_args())
+
+    def _get_extract_args(self):
+        """Return archiver arguments for extracting archive"""
+        return (*self.EXTRACT, *self._get_threads_args())
+
 
 class TarArchive(Archive):
     ADD = ('cf',)
     EXTRACT = ('xf',)
     ARCH = 'tar'
+    UPDATE = ('rf',)
+    DELETE = ('--delete', '-f')
+    LIST = ('tvf',)
+    PRINT = ('xOf',)
+    # parallel implementations of the compressor used for this tar flavor,
+    # in order of preference, along with switch for setting threads number
+    COMPRESSORS = ()
+    # external compressor program required by this tar flavor
+    FILTER = None
+
+    def __init__(self, threads=None):
+        super(TarArchive, self).__init__(threads)
+        if self.FILTER and not path.which(self.FILTER):
+            self.archiver = None
+        self._compressor = None
+        if threads and threads > 1:
+            for executable, args in self.COMPRESSORS:
+                if path.which(executable):
+                    self._compressor = f'{executable} {args.format(threads)}'
+                    break
+
+    def is_parallel(self):
+        return bool(self.archiver and self._compressor)
+
+    def _call_extract(self, args, arch_name, files, cwd):
+        if self.digests is None:
+            return super(TarArchive, self)._call_extract(args, arch_name,
+                                                         files, cwd)
+
+        # tar reads the archive sequentially, so it can be fed through the
+        # pipe by the reader, which digests the data passing by. Extract
+        # arguments of compressed tar flavors always name the compressor.
+        with open(arch_name, 'rb') as fobj:
+            reader = digest.Reader(fobj)
+            result = process.call([self._decompress, *args, '-', *files],
+                                  cwd=cwd, feed=reader.copy)
+            self.digests.archive = reader.hexdigest()
+        return result
+
+    def create(self, arch_name, files=None, cwd=None):
+        files = files if files else sorted(os.listdir(cwd or '.'))
+        return self._create(arch_name, files, cwd)
+
+    def _get_add_args(self):
+        if self.is_parallel():
+            return ('-I', self._compressor, '-cf')
+        return self.ADD
+
+    def _get_extract_args(self):
+        if self.is_parallel():
+            return ('-I', self._compressor, '-xf')
+        return self.EXTRACT
+
+    def _parse_list(self, output):
+        # GNU tar verbose listing:
+        # -rw-r--r-- user/group    123 2020-01-01 12:00 path/to/file
+        files = []
+        for line in output.splitlines():
+            fields = line.split(None, 5)
+            if len(fields) < 6 or not fields[0].startswith('-'):
+                continue
+            try:
+                files.append((fields[5], int(fields[2])))
+            except ValueError:
+                continue
+        return files
+
+
+class DigestingTarFile(tarfile.TarFile):
+    """
+    TarFile which digests contents of the regular files while they are
+    extracted or added, if file_digests dictionary is set
+    """
+    file_digests = None
+
+    def makefile(self, tarinfo, targetpath):
+        if self.file_digests is None or tarinfo.sparse is not None:
+            super(DigestingTarFile, self).makefile(tarinfo, targetpath)
+            if self.file_digests is not None:
+                self.file_digests[os.path.normpath(tarinfo.name)] = \
+                    digest.hash_file(targetpath)
+            return
+
+        self.fileobj.seek(tarinfo.offset_data)
+        with digest.Stream(open(targetpath, 'wb'), self.file_digests,
+                           os.path.normpath(tarinfo.name)) as target:
+            tarfile.copyfileobj(self.fileobj, target, tarinfo.size,
+                                tarfile.ReadError, self.copybufsize)
+
+    def addfile(self, tarinfo, fileobj=None):
+        if self.file_digests is None or fileobj is None:
+            return super(DigestingTarFile, self).addfile(tarinfo, fileobj)
+
+        stream = digest.Stream(fileobj)
+        super(DigestingTarFile, self).addfile(tarinfo, stream)
+        self.file_digests[os.path.normpath(tarinfo.name)] = \
+            stream.hexdigest()
+
+
+class NativeTarArchive(TarArchive):
+    """In-process tar support by the tarfile module"""
+    ARCH = 'tarfile'
+    MODE = ''
+    UPDATE = None
+    DELETE = None
+
+    def __init__(self, threads=None):
+        self.archiver = self.ARCH
+        self.threads = threads
+        self._compress = self.archiver
+        self._decompress = self.archiver
+        self.digests = None
+
+    def create(self, arch_name, files=None, cwd=None):
+        cwd = cwd or '.'
+        files = files if files else sorted(os.listdir(cwd))
+        logging.debug("Creating `%s' with %s module, files: %s.", arch_name,
+                      self.ARCH, " ".join(files))
+        try:
+            with open(arch_name, 'wb') as fobj:
+                # tarfile writes sequentially, archive is digested on the way
+                if self.digests is not None:
+                    fobj = digest.Writer(fobj)
+                with DigestingTarFile.open(fileobj=fobj,
+                                           mode='w:' + self.MODE) as tar:
+                    tar.file_digests = self._get_file_digests()
+                    for fname in files:
+                        tar.add(os.path.join(cwd, fname), arcname=fname)
+        except (OSError, tarfile.TarError) as exc:
+            logging.error("Unable to create archive `%s': %s.", arch_name,
+                          exc)
+            return False
+        if self.digests is not None:
+            self.digests.archive = fobj.hexdigest()
+        return True
 
-    def create(self, arch_name, files=None):
-        files = files if files else sorted(os.listdir('.'))
-        logging.debug("Calling `%s %s %s %s'.", self._compress,
-                      " ".join(self.ADD), arch_name, " ".join(files))
-        result = subprocess.call([self._compress, *self.ADD, arch_name,
-                                  *files])
-        if result != 0:
-            logging.error("Unable to create archive `%s'.", arch_name)
+    def extract(self, arch_name, files=None, cwd=None):
+        if not os.path.exists(arch_name):
+            logging.error("Archive `%s' doesn't exists.", arch_name)
+            return False
+
+        logging.debug("Extracting `%s' with %s module.", arch_name,
+                      self.ARCH)
+        # since Python 3.12 there is an extraction filter available, which
+        # behave pretty much like GNU tar, use it if possible.
+        kwargs = {'filter': 'tar'} if hasattr(tarfile, 'tar_filter') else {}
+        try:
+            with open(arch_name, 'rb') as fobj:
+                fobj = self._get_reader(fobj)
+                with DigestingTarFile.open(fileobj=fobj,
+                                           mode='r:' + self.MODE) as tar:
+                    tar.file_digests = self._get_file_digests()
+                    if files:
+                        kwargs['members'] = [tar.getmember(fname)
+                                             for fname in files]
+                    tar.extractall(cwd or '.', **kwargs)
+                if self.digests is not None:
+                    self.digests.archive = fobj.hexdigest()
+        except (OSError, KeyError, tarfile.TarError) as exc:
+            logging.error("Unable to extract archive `%s': %s.", arch_name,
+                          exc)
             return False
         return True
 
+    def list(self, arch_name):
+        if not os.path.exists(arch_name):
+            logging.error("Archive `%s' doesn't exists.", arch_name)
+            return None
+
+        try:
+            with tarfile.open(arch_name, 'r:' + self.MODE) as tar:
+                return [(info.name, info.size) for info in tar
+                        if info.isfile()]
+        except (OSError, tarfile.TarError) as exc:
+            logging.error("Unable to list archive `%s': %s.", arch_name, exc)
+            return None
+
+    def read(self, arch_name, fname):
+        try:
+            with tarfile.open(arch_name, 'r:' + self.MODE) as tar:
+                return tar.extractfile(fname).read()
+        except (OSError, KeyError, AttributeError, tarfile.TarError) as exc:
+            logging.error("Unable to read `%s' from archive `%s': %s.", fname,
+                          arch_name, exc)
+            return None
+
+
+class NativeTarGzipArchive(NativeTarArchive):
+    MODE = 'gz'
+
+
+class NativeTarBzip2Archive(NativeTarArchive):
+    MODE = 'bz2'
+
+
+class NativeTarXzArchive(NativeTarArchive):
+    MODE = 'xz'
+
 
 class TarGzipArchive(TarArchive):
     ADD = ('zcf',)
+    # compression is not detected, when archive is read from the pipe
+    EXTRACT = ('zxf',)
+    COMPRESSORS = (('pigz', '-p {}'),)
+    UPDATE = None
+    DELETE = None
 
 
 class TarBzip2Archive(TarArchive):
     ADD = ('jcf',)
+    # compression is not detected, when archive is read from the pipe
+    EXTRACT = ('jxf',)
+    COMPRESSORS = (('pbzip2', '-p{}'),)
+    UPDATE = None
+    DELETE = None
 
 
 class TarXzArchive(TarArchive):
     ADD = ('Jcf',)
+    # compression is not detected, when archive is read from the pipe
+    EXTRACT = ('Jxf',)
+    COMPRESSORS = (('pixz', '-p {}'), ('xz', '-T{}'))
+    UPDATE = None
+    DELETE = None
+
+
+class TarZstdArchive(TarArchive):
+    ADD = ('-I', 'zstd', '-cf')
+    EXTRACT = ('-I', 'zstd', '-xf')
+    LIST = ('-I', 'zstd', '-tvf')
+    PRINT = ('-I', 'zstd', '-xOf')
+    COMPRESSORS = (('zstd', '-T{}'),)
+    FILTER = 'zstd'
+    UPDATE = None
+    DELETE = None
+
+    def _get_extract_args(self):
+        # zstd decompression is always single threaded
+        return self.EXTRACT
+
+
+class TarLz4Archive(TarArchive):
+    ADD = ('-I', 'lz4', '-cf')
+    EXTRACT = ('-I', 'lz4', '-xf')
+    LIST = ('-I', 'lz4', '-tvf')
+    PRINT = ('-I', 'lz4', '-xOf')
+    FILTER = 'lz4'
+    UPDATE = None
+    DELETE = None
+
+
+class NativeTarZstdArchive(NativeTarArchive):
+    MODE = 'zst'
 
 
 class LhaArchive(Archive):
     ARCH = 'lha'
+    LIST = ('lq',)
+    PRINT = ('pq',)
+    # [generic]              1234  55.5% Jan 01  2020 path/to/file
+    # -rw-r--r-- 1000/1000   1234  55.5% Jan 01 12:00 path/to/file
+    LIST_RE = re.compile(r'\s(\d+)\s+(?:[\d.]+%|\*+)\s+\S+\s+\d+\s+'
+                         r'[\d:]+\s(.+)$')
+
+    def _parse_list(self, output):
+        files = []
+        for line in output.splitlines():
+            match = self.LIST_RE.search(line)
+            if match and not match.group(2).endswith('/'):
+                files.append((match.group(2), int(match.group(1))))
+        return files
 
 
 class ZipArchive(Archive):
     ADD = ('a', '-tzip')
     ARCH = ('7z', 'zip')
+    THREADS = ('-mmt={}',)
+    UPDATE = ('u', '-tzip')
+    DELETE = ('d', '-tzip')
 
-    def __init__(self):
-        super(ZipArchive, self).__init__()
+    def __init__(self, threads=None):
+        super(ZipArchive, self).__init__(threads)
         if self.archiver == 'zip':
             self._decompress = path.which('unzip')
-            ZipArchive.ADD = ['-r']
-            ZipArchive.EXTRACT = []
+            self.ADD = ('-r',)
+            self.EXTRACT = ()
+            self.THREADS = ()
+            self.UPDATE = ('-r',)
+            self.DELETE = ('-d',)
+
+    def _get_delete_names(self, deleted):
+        if self.archiver != 'zip':
+            return super(ZipArchive, self)._get_delete_names(deleted)
+        # zip deletes only entries matching the names exactly, contents of
+        # the directories have to be matched by wildcard
+        names = []
+        for path in deleted:
+            names.extend((path, path + '/*'))
+        return names
+
+    def list(self, arch_name):
+        # zip central directory is cheap to read, there is no need to call
+        # external archiver for that.
+        if not os.path.exists(arch_name):
+            logging.error("Archive `%s' doesn't exists.", arch_name)
+            return None
+
+        try:
+            with zipfile.ZipFile(arch_name) as zip_:
+                return [(info.filename, info.file_size)
+                        for info in zip_.infolist() if not info.is_dir()]
+        except (OSError, zipfile.BadZipFile) as exc:
+            logging.error("Unable to list archive `%s': %s.", arch_name, exc)
+            return None
+
+    def read(self, arch_name, fname):
+        try:
+            with zipfile.ZipFile(arch_name) as zip_:
+                return zip_.read(fname)
+        except (OSError, KeyError, zipfile.BadZipFile) as exc:
+            logging.error("Unable to read `%s' from archive `%s': %s.", fname,
+                          arch_name, exc)
+            return None
+
+
+class DigestingZipFile(zipfile.ZipFile):
+    """
+    ZipFile which digests contents of the files while they are extracted or
+    added, if file_digests dictionary is set
+    """
+    file_digests = None
+
+    def open(self, name, mode='r', pwd=None, **kwargs):
+        fobj = super(DigestingZipFile, self).open(name, mode, pwd, **kwargs)
+        if self.file_digests is None:
+            return fobj
+        fname = getattr(name, 'filename', name)
+        return digest.Stream(fobj, self.file_digests,
+                             os.path.normpath(fname))
+
+
+class NativeZipArchive(ZipArchive):
+    """In-process zip support by the zipfile module"""
+    ARCH = 'zipfile'
+    UPDATE = None
+    DELETE = None
+
+    def __init__(self, threads=None):
+        self.archiver = self.ARCH
+        self.threads = threads
+        self._compress = self.archiver
+        self._decompress = self.archiver
+        self.digests = None
+
+    def create(self, arch_name, files=None, cwd=None):
+        cwd = cwd or '.'
+        files = files if files else sorted(os.listdir(cwd))
+        logging.debug("Creating `%s' with %s module, files: %s.", arch_name,
+                      self.ARCH, " ".join(files))
+        try:
+            # files older than 1980 (like default AmigaDOS date) get the
+            # earliest timestamp zip is able to store
+            with DigestingZipFile(arch_name, 'w', zipfile.ZIP_DEFLATED,
+                                  strict_timestamps=False) as zip_:
+                zip_.file_digests = self._get_file_digests()
+                for fname in files:
+                    self._add(zip_, fname, cwd)
+        except (OSError, ValueError, zipfile.BadZipFile) as exc:
+            logging.error("Unable to create archive `%s': %s.", arch_name,
+                          exc)
+            return False
+        # zipfile seeks back for updating headers, so archive is digested
+        # afterwards, while it's still in the page cache
+        self._digest_archive(arch_name)
+        return True
+
+    def extract(self, arch_name, files=None, cwd=None):
+        if not os.path.exists(arch_name):
+            logging.error("Archive `%s' doesn't exists.", arch_name)
+            return False
+
+        logging.debug("Extracting `%s' with %s module.", arch_name,
+                      self.ARCH)
+        try:
+            with open(arch_name, 'rb') as fobj:
+                fobj = self._get_reader(fobj)
+                with DigestingZipFile(fobj) as zip_:
+                    zip_.file_digests = self._get_file_digests()
+                    infos = zip_.infolist()
+                    if files:
+                        infos = [zip_.getinfo(fname) for fname in files]
+                    for info in infos:
+                        fname = zip_.extract(info, cwd)
+                        # zipfile doesn't restore permissions, do it manually
+                        mode = stat.S_IMODE(info.external_attr >> 16)
+                        if mode and not info.is_dir():
+                            os.chmod(fname, mode)
+                if self.digests is not None:
+                    self.digests.archive = fobj.hexdigest()
+        except (OSError, KeyError, zipfile.BadZipFile) as exc:
+            logging.error("Unable to extract archive `%s': %s.", arch_name,
+                          exc)
+            return False
+        return True
+
+    def _add(self, zip_, fname, cwd):
+        """Add file or directory recursively to the zip archive"""
+        path = os.path.join(cwd, fname)
+        zip_.write(path, fname)
+        if not os.path.isdir(path) or os.path.islink(path):
+            return
+        for root, dirnames, fnames in os.walk(path):
+            for name in sorted(dirnames) + sorted(fnames):
+                full_path = os.path.join(root, name)
+                zip_.write(full_path, os.path.relpath(full_path, cwd))
 
 
 class SevenZArchive(Archive):
     ARCH = '7z'
+    THREADS = ('-mmt={}',)
+    UPDATE = ('u',)
+    DELETE = ('d',)
+    LIST = ('l', '-slt')
+    PRINT = ('e', '-so')
+
+    def _parse_list(self, output):
+        # technical listing consists of blocks of "key = value" lines, one
+        # block per file, preceded by the block describing archive itself.
+        _, _, output = output.partition('\n----------\n')
+        files = []
+        for block in output.split('\n\n'):
+            entry = dict(line.split(' = ', 1) for line in block.splitlines()
+                         if ' = ' in line)
+            if 'Path' not in entry or entry.get('Folder') == '+':
+                continue
+            if 'D' in entry.get('Attributes', '').split(' ')[0]:
+                continue
+            files.append((entry['Path'], int(entry.get('Size') or 0)))
+        return files
 
 
 class LzxArchive(Archive):
@@ -105,7 +710,7 @@ class LzxArchive(Archive):
     ARCH = 'unlzx'
 
     @classmethod
-    def create(self, arch_name, files=None):
+    def create(self, arch_name, files=None, cwd=None):
         logging.error('Cannot create LZX archive. Only extracting is'
                       'supported.')
         return False
@@ -113,35 +718,65 @@ class LzxArchive(Archive):
 
 class RarArchive(Archive):
     ARCH = ('rar', 'unrar')
-
-    def create(self, arch_name, files=None):
-        files = files if files else sorted(os.listdir('.'))
+    THREADS = ('-mt{}',)
+    UPDATE = ('u',)
+    DELETE = ('d',)
+    LIST = ('lt',)
+    PRINT = ('p', '-inul')
+
+    def _parse_list(self, output):
+        # technical listing consists of blocks of "key: value" lines, one
+        # block per file.
+        files = []
+        for block in output.split('\n\n'):
+            entry = dict(line.strip().split(': ', 1)
+                         for line in block.splitlines() if ': ' in line)
+            if 'Name' not in entry or entry.get('Type') != 'File':
+                continue
+            files.append((entry['Name'], int(entry.get('Size') or 0)))
+        return files
+
+    def supports_update(self):
+        return (self.archiver != 'unrar' and
+                super(RarArchive, self).supports_update())
+
+    def create(self, arch_name, files=None, cwd=None):
+        files = files if files else sorted(os.listdir(cwd or '.'))
         if self.archiver == 'unrar':
             logging.error('Cannot create RAR archive. Only extracting is'
                           'supported by unrar.')
             return False
 
-        logging.debug("Calling `%s %s %s %s'.", self._compress,
-                      " ".join(self.ADD), arch_name, " ".join(files))
-        result = subprocess.call([self._compress, *self.ADD, arch_name,
-                                  *files])
-        if result != 0:
-            logging.error("Unable to create archive `%s'.", arch_name)
-            return False
-        return True
+        return self._create(arch_name, files, cwd)
+
+
+# formats, which cannot be listed without decompressing whole archive
+STREAM_FORMATS = ('tgz', 'tar.bz2', 'tar.xz', 'zst', 'lz4')
+# tarfile supports zstd compression starting from Python 3.14
+NATIVE_ZSTD = (NativeTarZstdArchive
+               if 'zst' in tarfile.TarFile.OPEN_METH else None)
 
 
 class Archivers(object):
-    """Archivers class"""
-    archivers = ({'arch': TarArchive, 'name': 'tar', 'ext': ['tar']},
-                 {'arch': TarGzipArchive, 'name': 'tgz',
-                  'ext': ['tar.gz', 'tgz']},
-                 {'arch': TarBzip2Archive, 'name': 'tar.bz2',
-                  'ext': ['tar.bz2']},
-                 {'arch': TarXzArchive, 'name': 'tar.xz', 'ext': ['tar.xz']},
+    """
+    Archivers class. Formats which have in-process implementation ('native'
+    key) will use it in favor of external archivers.
+    """
+    archivers = ({'arch': TarArchive, 'native': NativeTarArchive,
+                  'name': 'tar', 'ext': ['tar']},
+                 {'arch': TarGzipArchive, 'native': NativeTarGzipArchive,
+                  'name': 'tgz', 'ext': ['tar.gz', 'tgz']},
+                 {'arch': TarBzip2Archive, 'native': NativeTarBzip2Archive,
+                  'name': 'tar.bz2', 'ext': ['tar.bz2']},
+                 {'arch': TarXzArchive, 'native': NativeTarXzArchive,
+                  'name': 'tar.xz', 'ext': ['tar.xz']},
+                 {'arch': TarZstdArchive, 'native': NATIVE_ZSTD,
+                  'name': 'zst', 'ext': ['tar.zst', 'tzst']},
+                 {'arch': TarLz4Archive, 'name': 'lz4', 'ext': ['tar.lz4']},
                  {'arch': RarArchive, 'name': 'rar', 'ext': ['rar']},
                  {'arch': SevenZArchive, 'name': '7z', 'ext': ['7z']},
-                 {'arch': ZipArchive, 'name': 'zip', 'ext': ['zip']},
+                 {'arch': ZipArchive, 'native': NativeZipArchive,
+                  'name': 'zip', 'ext': ['zip']},
                  {'arch': LhaArchive, 'name': 'lha', 'ext': ['lha', 'lzh']},
                  {'arch': LzxArchive, 'name': 'lzx', 'ext': ['lzx']})
 
@@ -155,6 +790,27 @@ class Archivers(object):
                 return arch['arch']
         return None
 
+    @classmethod
+    def get_native(cls, extension):
+        """
+        Get the in-process archive class or None
+        """
+        for arch in cls.archivers:
+            if extension in arch['ext']:
+                return arch.get('native')
+        return None
+
+    @classmethod
+    def is_available(cls, name):
+        """
+        Check if archive format with provided name can be created, either by
+        in-process implementation or by external archiver.
+        """
+        for arch in cls.archivers:
+            if name == arch['name']:
+                return bool(arch.get('native') or arch['arch']().archiver)
+        return False
+
     @classmethod
     def get_extension_by_name(cls, name):
         """
@@ -166,9 +822,8 @@ class Archivers(object):
         return None
 
 
-def get_archiver(arch_name):
-    """Return right class for provided archive file name"""
-
+def get_extension(arch_name):
+    """Return extension of the archive file name, without leading dot"""
     _, ext = os.path.splitext(arch_name)
     re_tar = re.compile('.*(.[tT][aA][rR].[^.]+$)')
     result = re_tar.match(arch_name)
@@ -178,13 +833,89 @@ def get_archiver(arch_name):
 
     if ext:
         ext = ext[1:]
-
+    return ext
+
+
+def get_format(arch_name):
+    """Return name of the archive format for provided file name, or None"""
+    ext = get_extension(arch_name).lower()
+    for arch in Archivers.archivers:
+        if ext in arch['ext']:
+            return arch['name']
+    return None
+
+
+def get_stream_size(arch_name):
+    """
+    Return size of the decompressed data of the compressed tar archive, out
+    of the compression metadata, or None if the format doesn't record it.
+    Unlike listing, which has to decompress whole archive, it's cheap.
+    """
+    arch_format = get_format(arch_name)
+    try:
+        if arch_format == 'tgz':
+            return _get_gzip_size(arch_name)
+        if arch_format == 'tar.xz' and path.which('xz'):
+            return _get_xz_size(arch_name)
+    except (OSError, ValueError) as exc:
+        logging.debug("Cannot read decompressed size of `%s': %s.",
+                      arch_name, exc)
+    return None
+
+
+def _get_gzip_size(arch_name):
+    """
+    Return decompressed size of gzip file out of its trailer. Size is stored
+    modulo 4 GiB, and since deflate expands incompressible data only by few
+    bytes per block, it's adjusted to be at least half of compressed size.
+    """
+    with open(arch_name, 'rb') as fobj:
+        fobj.seek(-4, os.SEEK_END)
+        size = int.from_bytes(fobj.read(4), 'little')
+        compressed = fobj.tell()
+    while size < compressed // 2:
+        size += 2**32
+    return size
+
+
+def _get_xz_size(arch_name):
+    """Return decompressed size of xz file out of its index"""
+    result = subprocess.run(['xz', '--robot', '--list', arch_name],
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL)
+    if result.returncode != 0:
+        return None
+    for line in result.stdout.decode('utf-8', errors='replace').splitlines():
+        fields = line.split('\t')
+        if fields[0] == 'totals':
+            return int(fields[4])
+    return None
+
+
+def get_archiver(arch_name, threads=None, update=False):
+    """
+    Return right class for provided archive file name. In-process
+    implementation is preferred, unless external archiver is able to utilize
+    provided number of threads. If update is set, only archiver capable of
+    updating archives in place will be returned.
+    """
+
+    ext = get_extension(arch_name)
     archiver = Archivers.get(ext)
     if not archiver:
         logging.error("Unable find archive type for `%s'.", arch_name)
         return None
 
-    archobj = archiver()
+    archobj = archiver(threads)
+    native = Archivers.get_native(ext)
+    if update:
+        if not archobj.supports_update():
+            logging.debug("Archive `%s' cannot be updated in place.",
+                          arch_name)
+            return None
+    elif native and not archobj.is_parallel():
+        archobj = native(threads)
+
     if archobj.archiver is None:
         logging.error("Unable find executable for operating on files `*%s'.",
                       ext)
@@ -0,0 +1,105 @@
+"""
+Launch history - configurations launched recently, in order, which is used
+for predicting which game will be launched next.
+"""
+import logging
+import os
+import time
+
+from fs_uae_wrapper import persist, prefetch, utils
+
+HISTORY_NAME = 'history.json'
+MAX_ENTRIES = 1000
+# weights of the things which make configuration a likely next launch
+SUCCESSOR_WEIGHT = 3.0
+NEIGHBOUR_WEIGHT = 2.0
+# number of launches after which the launch counts half
+HALF_LIFE = 20
+NEIGHBOUR_DISTANCE = 2
+
+
+def get_history_path():
+    """Return path to the history file"""
+    return os.path.join(persist.get_state_dir(), HISTORY_NAME)
+
+
+def load():
+    """Return list of the launches, oldest first"""
+    history = utils.read_json(get_history_path())
+    if not isinstance(history, list):
+        return []
+    return history
+
+
+def record(conf_file):
+    """Append launch of the configuration to the history. Return True/False"""
+    fname = get_history_path()
+    try:
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        with utils.lock_file(fname + '.lock'):
+            history = load()
+            history.append({'config': os.path.abspath(conf_file),
+                            'time': time.time()})
+            utils.write_json(fname, history[-MAX_ENTRIES:])
+    except OSError as exc:
+        logging.debug("Cannot record launch history in `%s': %s.", fname,
+                      exc)
+        return False
+    return True
+
+
+def get_playlist(conf_file, playlist=None):
+    """
+    Return list of configuration files in order they are presented to the
+    user. It's either read from provided playlist file (see
+    prefetch.get_configs), or it's configuration files from the directory of
+    the launched one, sorted by name.
+    """
+    if not playlist:
+        playlist = os.path.dirname(os.path.abspath(conf_file))
+        try:
+            return [os.path.join(playlist, fname)
+                    for fname in sorted(os.listdir(playlist))
+                    if fname.endswith('.fs-uae')]
+        except OSError:
+            return []
+
+    try:
+        return [os.path.abspath(fname)
+                for fname in prefetch.get_configs(playlist)]
+    except OSError as exc:
+        logging.warning("Cannot read playlist `%s': %s.", playlist, exc)
+        return []
+
+
+def get_candidates(conf_file, history, playlist, count):
+    """
+    Return list of up to count configuration files, which are most likely
+    to be launched after the provided one. Configurations score for being
+    launched after this one in the past, for being launched recently or
+    often, and for being neighbours of this one in the playlist.
+    """
+    conf_file = os.path.abspath(conf_file)
+    scores = {}
+    configs = [entry['config'] for entry in history]
+
+    for previous, config in zip(configs, configs[1:]):
+        if previous == conf_file:
+            scores[config] = scores.get(config, 0) + SUCCESSOR_WEIGHT
+
+    for age, config in enumerate(reversed(configs)):
+        scores[config] = scores.get(config, 0) + 0.5 ** (age / HALF_LIFE)
+
+    if conf_file in playlist:
+        position = playlist.index(conf_file)
+        for distance in range(1, NEIGHBOUR_DISTANCE + 1):
+            for idx in (position - distance, position + distance):
+                if 0 <= idx < len(playlist):
+                    config = playlist[idx]
+                    scores[config] = (scores.get(config, 0) +
+                                      NEIGHBOUR_WEIGHT / distance)
+
+    scores.pop(conf_file, None)
+    candidates = sorted(scores, key=lambda config: (-scores[config], config))
+    return [config for config in candidates
+            if os.path.exists(config)][:count]
@@ -0,0 +1,247 @@
+"""
+Index of the collection - configuration files with their wrapper modules
+and archives, stored in SQLite database, so that archive for configuration
+can be found without scanning its directory.
+"""
+import logging
+import os
+import sqlite3
+import sys
+
+from fs_uae_wrapper import file_archive, persist, plan, utils
+
+DB_NAME = 'index.sqlite'
+SCHEMA = """CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+CREATE TABLE IF NOT EXISTS configs (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    mtime INTEGER NOT NULL,
+    wrapper TEXT,
+    wrapper_archive TEXT,
+    archive TEXT,
+    format TEXT,
+    size INTEGER,
+    archive_mtime INTEGER);
+CREATE INDEX IF NOT EXISTS configs_dir ON configs (dir);"""
+# extensions of the archives, which are looked for next to the configuration
+# file, if wrapper_archive option is not set, in order of preference
+ARCHIVE_EXTS = ('.7z', '.lha', '.lzx', '.zip', '.rar', '.tar', '.tgz',
+                '.tar.gz', '.tar.bz2', '.tar.xz', '.tar.zst', '.tzst',
+                '.tar.lz4')
+
+
+def get_db_path(value=None):
+    """
+    Return path to the index database, default one is placed in the state
+    directory
+    """
+    if not value or value == '1':
+        return os.path.join(persist.get_state_dir(), DB_NAME)
+    return os.path.abspath(os.path.expanduser(value))
+
+
+def get_names_map(names):
+    """Return dictionary of lower case file names and the names"""
+    names_map = {}
+    for name in names:
+        names_map.setdefault(name.lower(), []).append(name)
+    return names_map
+
+
+def find_archive(basename, names_map):
+    """
+    Return name of the archive for configuration file basename (without
+    extension) out of the names map, or None. Extension is matched case
+    insensitive.
+    """
+    for ext in ARCHIVE_EXTS:
+        for fname in names_map.get((basename + ext).lower(), ()):
+            if fname.startswith(basename):
+                return fname
+    return None
+
+
+def get_archive_name(conf_file, db_path):
+    """
+    Return name of the archive for the configuration file found in the
+    index, or None, if configuration is not indexed, or its directory has
+    changed since it was indexed (files might have been added, removed or
+    renamed there).
+    """
+    if not os.path.exists(db_path):
+        return None
+
+    conf_file = os.path.abspath(conf_file)
+    try:
+        conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+        try:
+            row = conn.execute('SELECT configs.archive, dirs.mtime '
+                               'FROM configs JOIN dirs '
+                               'ON dirs.path = configs.dir '
+                               'WHERE configs.path = ? '
+                               'AND configs.wrapper_archive IS NULL',
+                               (conf_file,)).fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error as exc:
+        logging.debug("Cannot read index `%s': %s.", db_path, exc)
+        return None
+
+    if not row or not row[0]:
+        return None
+    if plan.get_mtime(os.path.dirname(conf_file)) != row[1]:
+        logging.debug("Directory of `%s' has changed since it was indexed.",
+                      conf_file)
+        return None
+    return row[0]
+
+
+class Indexer(object):
+    """
+    Index configuration files in directory tree. Directories which
+    modification time didn't change since last run are skipped, and only
+    changed configuration files are read again.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.dirs = 0
+        self.scanned = 0
+        self.configs = 0
+        self.parsed = 0
+
+    def update(self, top):
+        """Update index for directory tree"""
+        pending = [os.path.abspath(top)]
+        while pending:
+            dirpath = pending.pop()
+            mtime = plan.get_mtime(dirpath)
+            if mtime is None:
+                self._remove(dirpath)
+                continue
+
+            self.dirs += 1
+            row = self.conn.execute('SELECT mtime FROM dirs WHERE path = ?',
+                                    (dirpath,)).fetchone()
+            if row and row[0] == mtime:
+                pending.extend(child for child, in self.conn.execute(
+                    'SELECT path FROM dirs WHERE parent = ?', (dirpath,)))
+                continue
+
+            pending.extend(self._index_dir(dirpath, mtime))
+
+        self.configs = self.conn.execute('SELECT count(*) FROM configs')\
+            .fetchone()[0]
+
+    def _index_dir(self, dirpath, mtime):
+        """Index configuration files in directory. Return its subdirs"""
+        self.scanned += 1
+        try:
+            entries = list(os.scandir(dirpath))
+        except OSError as exc:
+            logging.warning("Cannot read directory `%s': %s.", dirpath, exc)
+            return []
+
+        names_map = get_names_map(entry.name for entry in entries)
+        known = {row[0]: row[1:] for row in self.conn.execute(
+            'SELECT path, mtime, wrapper, wrapper_archive FROM configs '
+            'WHERE dir = ?', (dirpath,))}
+        subdirs = []
+        configs = []
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(entry.path)
+                continue
+            if not entry.name.endswith('.fs-uae'):
+                continue
+
+            try:
+                conf_mtime = entry.stat().st_mtime_ns
+            except OSError:
+                continue
+            if entry.path in known and known[entry.path][0] == conf_mtime:
+                wrapper, wrapper_archive = known[entry.path][1:]
+            else:
+                self.parsed += 1
+                conf = utils.get_config_options(entry.path)
+                if conf is None:
+                    logging.warning("Cannot read configuration `%s'.",
+                                    entry.path)
+                    continue
+                wrapper = conf.get('wrapper')
+                wrapper_archive = conf.get('wrapper_archive')
+
+            archive = wrapper_archive
+            if not archive:
+                archive = find_archive(os.path.splitext(entry.name)[0],
+                                       names_map)
+            configs.append((entry.path, dirpath, conf_mtime, wrapper,
+                            wrapper_archive, archive) +
+                           _get_archive_info(dirpath, archive))
+
+        with self.conn:
+            self.conn.execute('DELETE FROM configs WHERE dir = ?', (dirpath,))
+            self.conn.executemany('INSERT INTO configs VALUES '
+                                  '(?, ?, ?, ?, ?, ?, ?, ?, ?)', configs)
+            # forget subdirectories which are gone
+            known_dirs = [row[0] for row in self.conn.execute(
+                'SELECT path FROM dirs WHERE parent = ?', (dirpath,))]
+            for path in known_dirs:
+                if path not in subdirs:
+                    self._remove(path)
+            self.conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)',
+                              (dirpath, os.path.dirname(dirpath), mtime))
+        return subdirs
+
+    def _remove(self, dirpath):
+        """Remove directory and all its subdirectories from the index"""
+        pending = [dirpath]
+        with self.conn:
+            while pending:
+                path = pending.pop()
+                pending.extend(row[0] for row in self.conn.execute(
+                    'SELECT path FROM dirs WHERE parent = ?', (path,)))
+                self.conn.execute('DELETE FROM configs WHERE dir = ?',
+                                  (path,))
+                self.conn.execute('DELETE FROM dirs WHERE path = ?', (path,))
+
+
+def _get_archive_info(dirpath, archive):
+    """Return tuple of format, size and modification time of the archive"""
+    if not archive:
+        return None, None, None
+    arch_path = os.path.join(dirpath, os.path.expanduser(archive))
+    try:
+        stat = os.stat(arch_path)
+    except OSError:
+        return file_archive.get_format(archive), None, None
+    return file_archive.get_format(archive), stat.st_size, stat.st_mtime_ns
+
+
+def update(db_path, directory, out=None):
+    """Update index with the directory tree. Return True/False"""
+    out = out or sys.stdout
+    if not os.path.isdir(directory):
+        logging.error("Directory `%s' doesn't exist.", directory)
+        return False
+
+    try:
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        conn = sqlite3.connect(db_path, timeout=5)
+        try:
+            conn.executescript(SCHEMA)
+            indexer = Indexer(conn)
+            indexer.update(directory)
+        finally:
+            conn.close()
+    except (OSError, sqlite3.Error) as exc:
+        logging.error("Unable to update index `%s': %s.", db_path, exc)
+        return False
+
+    out.write(f"Indexed {indexer.dirs} directories ({indexer.scanned} "
+              f"scanned, {indexer.parsed} configurations read), "
+              f"{indexer.configs} configurations in `{db_path}'.\n")
+    return True
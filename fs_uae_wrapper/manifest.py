@@ -0,0 +1,215 @@
+"""
+Directory tree manifests, used for detecting changes made on the extracted
+files during emulation, digest manifests of the archives, which hold
+content hashes computed during extraction or creation of the archive, and
+stored sizes of the archives contents
+"""
+import hashlib
+import logging
+import os
+
+from fs_uae_wrapper import digest, persist, utils
+
+
+def get_manifest(directory, exclude=()):
+    """
+    Return manifest of the directory tree as a dictionary, where keys are
+    paths relative to the directory, and values are:
+        - None for directories
+        - [size, modification time in ns] for files
+        - ['link', target] for symbolic links
+    Paths (relative to the directory) listed in exclude are omitted along
+    with their contents.
+    """
+    exclude = {os.path.normpath(path) for path in exclude}
+    manifest = {}
+    for root, dirnames, fnames in os.walk(directory):
+        dirnames[:] = [name for name in dirnames
+                       if os.path.relpath(os.path.join(root, name),
+                                          directory) not in exclude]
+        for name in dirnames + fnames:
+            full_path = os.path.join(root, name)
+            path = os.path.relpath(full_path, directory)
+            if path in exclude:
+                continue
+            stat = os.lstat(full_path)
+
+            if os.path.islink(full_path):
+                manifest[path] = ['link', os.readlink(full_path)]
+            elif name in dirnames:
+                manifest[path] = None
+            else:
+                manifest[path] = [stat.st_size, stat.st_mtime_ns]
+    return manifest
+
+
+def get_paths(directory, exclude=()):
+    """
+    Return sorted list of paths relative to the directory, which cover all
+    of its contents except the excluded paths. Only directories which contain
+    excluded paths are descended into.
+    """
+    exclude = {os.path.normpath(path) for path in exclude}
+    return _get_paths(directory, exclude, '')
+
+
+def diff(old, new):
+    """
+    Compare two manifests and return tuple of sorted lists of added,
+    modified and deleted paths. Directories are never reported as modified.
+    Paths inside added or deleted directories are omitted, since operations
+    on directories are recursive.
+    """
+    added = _collapse(set(new) - set(old))
+    deleted = _collapse(set(old) - set(new))
+    modified = sorted(path for path in set(old) & set(new)
+                      if old[path] != new[path])
+    return added, modified, deleted
+
+
+def get_digests_path(arch_name):
+    """Return path to the digest manifest for provided archive"""
+    name = hashlib.sha1(os.path.abspath(arch_name).encode('utf-8'))
+    return os.path.join(persist.get_state_dir(), 'digests',
+                        name.hexdigest() + '.json')
+
+
+def load_digests(arch_name):
+    """
+    Return digest manifest of the archive as a dictionary with following
+    keys, or None if it's missing or archive has changed since:
+        - archive: absolute path to the archive
+        - size, mtime: archive size and modification time in ns, at the
+          time digests were computed
+        - algorithm: name of the hash algorithm
+        - digest: hex digest of the archive contents
+        - files: dictionary of the paths inside archive and hex digests of
+          the files contents, possibly for part of the files only
+    """
+    data = utils.read_json(get_digests_path(arch_name))
+    try:
+        stat = os.stat(arch_name)
+    except OSError:
+        return None
+    if (not data or data.get('size') != stat.st_size or
+            data.get('mtime') != stat.st_mtime_ns or
+            data.get('algorithm') != digest.ALGORITHM):
+        return None
+    return data
+
+
+def store_digests(arch_name, digests):
+    """
+    Store digest manifest for the archive out of digest.Digests object.
+    File digests already stored for the same archive contents are kept.
+    Return True/False
+    """
+    if not digests.archive:
+        return False
+
+    fname = get_digests_path(arch_name)
+    try:
+        stat = os.stat(arch_name)
+        files = {}
+        old = load_digests(arch_name)
+        if old and old.get('digest') == digests.archive:
+            files = old.get('files', {})
+        files.update(digests.files)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        utils.write_json(fname, {'archive': os.path.abspath(arch_name),
+                                 'size': stat.st_size,
+                                 'mtime': stat.st_mtime_ns,
+                                 'algorithm': digest.ALGORITHM,
+                                 'digest': digests.archive,
+                                 'files': files})
+    except OSError as exc:
+        logging.debug("Cannot store digests for `%s': %s.", arch_name, exc)
+        return False
+    return True
+
+
+def get_size_path(arch_name):
+    """Return path to the file with stored unpacked size of the archive"""
+    name = hashlib.sha1(os.path.abspath(arch_name).encode('utf-8'))
+    return os.path.join(persist.get_state_dir(), 'sizes',
+                        name.hexdigest() + '.json')
+
+
+def get_unpacked_size(arch_name):
+    """
+    Return size in bytes of extracted archive contents, or None if it cannot
+    be determined. Archive is listed only if its size or modification time
+    has changed since the last time, otherwise stored size is used.
+    """
+    try:
+        stat = os.stat(arch_name)
+    except OSError:
+        return None
+
+    fname = get_size_path(arch_name)
+    data = utils.read_json(fname)
+    if (data and data.get('size') == stat.st_size and
+            data.get('mtime') == stat.st_mtime_ns):
+        return data['unpacked']
+
+    unpacked = utils.get_unpacked_size(arch_name)
+    if unpacked is None:
+        return None
+
+    store_unpacked_size(arch_name, unpacked)
+    return unpacked
+
+
+def store_unpacked_size(arch_name, unpacked):
+    """
+    Store size in bytes of the archive contents for the current archive
+    file, so that it doesn't need to be listed for estimating the size.
+    """
+    try:
+        stat = os.stat(arch_name)
+        fname = get_size_path(arch_name)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        utils.write_json(fname, {'archive': os.path.abspath(arch_name),
+                                 'size': stat.st_size,
+                                 'mtime': stat.st_mtime_ns,
+                                 'unpacked': unpacked})
+    except OSError as exc:
+        logging.debug("Cannot store unpacked size of `%s': %s.", arch_name,
+                      exc)
+        return False
+    return True
+
+
+def get_tree_size(manifest):
+    """Return size in bytes of all the files listed in the manifest"""
+    return sum(value[0] for value in manifest.values()
+               if value is not None and value[0] != 'link')
+
+
+def _collapse(paths):
+    """Return sorted paths without those, which parents are also present"""
+    result = []
+    for path in sorted(paths):
+        parent = os.path.dirname(path)
+        while parent and parent not in paths:
+            parent = os.path.dirname(parent)
+        if not parent:
+            result.append(path)
+    return result
+
+
+def _get_paths(directory, exclude, prefix):
+    """Return paths under prefix directory, except excluded ones"""
+    paths = []
+    for name in sorted(os.listdir(os.path.join(directory, prefix))):
+        path = os.path.join(prefix, name)
+        if path in exclude:
+            continue
+        full_path = os.path.join(directory, path)
+        if (os.path.isdir(full_path) and not os.path.islink(full_path) and
+                any(excluded.startswith(path + os.sep)
+                    for excluded in exclude)):
+            paths.extend(_get_paths(directory, exclude, path))
+        else:
+            paths.append(path)
+    return paths
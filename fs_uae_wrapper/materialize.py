@@ -0,0 +1,142 @@
+"""
+Populating session directory with the files from already existing tree (like
+cache entry) without copying data, where possible. Hard links are used only
+for read only files owned by other user, which in practice means cache
+directory shared between users (wrapper_cache_dir) and populated by someone
+else; entries of own cache are always cloned or copied.
+"""
+import errno
+import fcntl
+import logging
+import os
+import shutil
+
+# ioctl request for cloning file (reflink) on btrfs, xfs and others
+FICLONE = 0x40049409
+CHUNK_SIZE = 64 * 1024 * 1024
+# errors, which mean that the method is not available for the file system
+UNSUPPORTED = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL,
+               errno.ENOSYS, errno.EPERM, errno.EMLINK)
+
+
+def reflink(src, dst):
+    """Create dst as a copy on write clone of src"""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def copy_range(src, dst):
+    """Copy src to dst using in-kernel copy_file_range"""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        while os.copy_file_range(fsrc.fileno(), fdst.fileno(), CHUNK_SIZE):
+            pass
+
+
+def is_read_only(fname):
+    """
+    Return True if the file cannot be modified by the user - it has no write
+    permissions and user is not able to change them
+    """
+    stat = os.stat(fname)
+    uid = os.geteuid()
+    return not stat.st_mode & 0o222 and uid != 0 and stat.st_uid != uid
+
+
+class Materializer(object):
+    """
+    Copy directory trees using the cheapest method available, in order:
+
+        reflink          copy on write clone, which shares data blocks
+        hardlink         only for read only files owned by other user, which
+                         cannot be made writable in the session, since they
+                         share inode with the source
+        copy_file_range  in-kernel copy, may be offloaded by file system
+        copy             regular copy
+
+    Method which fails as unsupported is not tried again for the next files.
+    """
+    STRATEGIES = ('reflink', 'hardlink', 'copy_file_range', 'copy')
+
+    def __init__(self):
+        self.stats = dict.fromkeys(self.STRATEGIES, 0)
+        self._available = {'reflink': True,
+                           'hardlink': True,
+                           'copy_file_range': hasattr(os, 'copy_file_range'),
+                           'copy': True}
+
+    def copy_tree(self, src, dst):
+        """Copy contents of src directory into dst directory"""
+        os.makedirs(dst, exist_ok=True)
+        for root, dirnames, fnames in os.walk(src):
+            target = os.path.join(dst, os.path.relpath(root, src))
+            for name in dirnames + fnames:
+                src_path = os.path.join(root, name)
+                dst_path = os.path.join(target, name)
+                if os.path.islink(src_path):
+                    _unlink(dst_path)
+                    os.symlink(os.readlink(src_path), dst_path)
+                elif name in dirnames:
+                    os.makedirs(dst_path, exist_ok=True)
+                else:
+                    self.copy_file(src_path, dst_path)
+            shutil.copystat(root, target)
+
+    def copy_file(self, src, dst):
+        """
+        Copy single file, replacing existing one, return name of used
+        strategy
+        """
+        _unlink(dst)
+        for strategy in self.STRATEGIES:
+            if not self._available[strategy]:
+                continue
+            if strategy == 'hardlink' and not is_read_only(src):
+                continue
+
+            try:
+                self._copy(strategy, src, dst)
+            except OSError as exc:
+                if exc.errno not in UNSUPPORTED or strategy == 'copy':
+                    raise
+                logging.debug("Cannot use %s for `%s': %s.", strategy, dst,
+                              exc)
+                self._available[strategy] = False
+                if os.path.lexists(dst):
+                    os.unlink(dst)
+                continue
+
+            self.stats[strategy] += 1
+            return strategy
+
+    def _copy(self, strategy, src, dst):
+        """Copy file with provided strategy"""
+        if strategy == 'hardlink':
+            os.link(src, dst)
+            return
+
+        if strategy == 'reflink':
+            reflink(src, dst)
+        elif strategy == 'copy_file_range':
+            copy_range(src, dst)
+        else:
+            shutil.copyfile(src, dst)
+        shutil.copystat(src, dst)
+
+
+def _unlink(path):
+    """Remove existing file or symbolic link, which is going to be replaced"""
+    if os.path.islink(path) or os.path.isfile(path):
+        os.unlink(path)
+
+
+def materialize(src, dst):
+    """
+    Populate dst directory with the contents of src directory. Return
+    dictionary with number of files copied by each strategy.
+    """
+    materializer = Materializer()
+    materializer.copy_tree(src, dst)
+    logging.info("Files materialized: %s.",
+                 ", ".join(f"{key}: {val}" for key, val in
+                           materializer.stats.items() if val) or "none")
+    return materializer.stats
@@ -0,0 +1,123 @@
+"""
+Selection of archive members for extraction, based on files referenced by
+the configuration
+"""
+import fnmatch
+import logging
+import os
+import re
+
+from fs_uae_wrapper import utils
+
+PATH_OPTIONS = ('cdrom_drive_', 'cdrom_image_', 'floppy_drive_',
+                'floppy_image_', 'hard_drive_')
+CUE_FILE_RE = re.compile(r'^\s*FILE\s+(?:"([^"]+)"|(\S+))',
+                         re.IGNORECASE | re.MULTILINE)
+
+
+def get_globs(value):
+    """Return list of glob patterns out of comma separated string"""
+    if not value:
+        return []
+    return [glob.strip() for glob in value.split(',') if glob.strip()]
+
+
+def get_referenced(options):
+    """
+    Return list of paths relative to the temporary directory, referenced by
+    drive and image options. Path '.' means whole directory.
+    """
+    paths = []
+    for key, val in options.items():
+        if not key.startswith(PATH_OPTIONS):
+            continue
+        if not key.rsplit('_', 1)[-1].isdigit():
+            continue
+        if not val.startswith('$WRAPPER'):
+            continue
+        paths.append(os.path.normpath(val[len('$WRAPPER'):].strip('/') or
+                                      '.'))
+    return paths
+
+
+def get_cue_tracks(cue_name, contents):
+    """Return paths of the track files referenced by the cue sheet"""
+    tracks = []
+    directory = os.path.dirname(cue_name)
+    for match in CUE_FILE_RE.finditer(contents):
+        fname = match.group(1) or match.group(2)
+        tracks.append(os.path.normpath(os.path.join(directory, fname)))
+    return tracks
+
+
+def select(files, paths, include=(), exclude=()):
+    """
+    Return (name, size) tuples for files which are either placed under one of
+    the paths or match one of the include globs, and don't match any of the
+    exclude globs. Paths are compared case insensitive.
+    """
+    paths = [path.lower() for path in paths]
+    result = []
+    for name, size in files:
+        path = os.path.normpath(name).lower()
+        if not (any(path == ref or path.startswith(ref + '/') or ref == '.'
+                    for ref in paths) or
+                any(fnmatch.fnmatch(name, glob) for glob in include)):
+            continue
+        if any(fnmatch.fnmatch(name, glob) for glob in exclude):
+            continue
+        result.append((name, size))
+    return result
+
+
+def get_members(arch_name, options):
+    """
+    Return list of (name, size) tuples for files which should be extracted
+    from the archive, or None if whole archive should be extracted.
+    """
+    selective = options.get('wrapper_selective_extract', '0') == '1'
+    include = get_globs(options.get('wrapper_extract_include'))
+    exclude = get_globs(options.get('wrapper_extract_exclude'))
+    if not selective and not exclude:
+        return None
+
+    if options.get('wrapper_persist_data', '0') == '1':
+        logging.warning("Selective extraction cannot be used along with "
+                        "`wrapper_persist_data' option, extracting whole "
+                        "archive.")
+        return None
+
+    files = utils.list_archive(arch_name)
+    if files is None:
+        logging.warning("Cannot list archive `%s', extracting whole "
+                        "archive.", arch_name)
+        return None
+
+    paths = ['.']
+    if selective:
+        paths = get_referenced(options)
+        names = {os.path.normpath(name).lower(): name for name, _ in files}
+        for path in list(paths):
+            if not path.lower().endswith('.cue') or path.lower() not in names:
+                continue
+            contents = utils.read_archive_file(arch_name,
+                                               names[path.lower()])
+            if contents is None:
+                logging.warning("Cannot read `%s', extracting whole "
+                                "archive.", path)
+                return None
+            paths.extend(get_cue_tracks(path, contents.decode('utf-8',
+                                                              'replace')))
+
+    members = select(files, paths, include, exclude)
+    if not members:
+        logging.warning("None of the files from archive `%s' were selected, "
+                        "extracting whole archive.", arch_name)
+        return None
+
+    if len(members) == len(files):
+        return None
+
+    logging.info("Extracting %d of %d files from `%s'.", len(members),
+                 len(files), arch_name)
+    return members
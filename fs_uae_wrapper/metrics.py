@@ -0,0 +1,177 @@
+"""
+Historical metrics of the launches, stored in SQLite database, and the
+report with latency percentiles per game and per archive format
+"""
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+from fs_uae_wrapper import file_archive, persist
+
+DB_NAME = 'metrics.sqlite'
+SCHEMA = """CREATE TABLE IF NOT EXISTS launches (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    config TEXT NOT NULL,
+    wrapper TEXT NOT NULL,
+    format TEXT,
+    size INTEGER,
+    result INTEGER NOT NULL,
+    launch REAL,
+    exit REAL,
+    phases TEXT NOT NULL)"""
+COLUMNS = ('time', 'config', 'wrapper', 'format', 'size', 'result', 'launch',
+           'exit', 'phases')
+
+
+def get_db_path(value):
+    """
+    Return path to the metrics database. Value "1" means the default
+    location in the state directory.
+    """
+    if not value or value == '1':
+        return os.path.join(persist.get_state_dir(), DB_NAME)
+    return os.path.abspath(os.path.expanduser(value))
+
+
+def connect(fname):
+    """Open metrics database, create it if needed, and return connection"""
+    dirname = os.path.dirname(fname)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    conn = sqlite3.connect(fname, timeout=5)
+    conn.execute(SCHEMA)
+    return conn
+
+
+def get_record(config_file, wrapper_module, arch_name, result, events,
+               end):
+    """
+    Return record of the launch. Launch latency is the time from wrapper
+    start to the emulator start, exit latency is the time from the emulator
+    exit to the end of the wrapper work, both in seconds, or None if the
+    emulator wasn't run. Events are span events of the tracer, end is the
+    tracer timestamp of the end of the run.
+    """
+    phases = {}
+    launch = exit_ = None
+    for event in events:
+        phases[event['name']] = round(phases.get(event['name'], 0) +
+                                      event['dur'] / 1e6, 6)
+        if event['name'] == 'emulator' and launch is None:
+            launch = event['ts'] / 1e6
+            exit_ = max(end - event['ts'] - event['dur'], 0) / 1e6
+
+    arch_format = size = None
+    if arch_name:
+        arch_format = file_archive.get_format(arch_name)
+        try:
+            size = os.path.getsize(arch_name)
+        except OSError:
+            pass
+
+    return {'time': time.time(),
+            'config': os.path.abspath(config_file),
+            'wrapper': wrapper_module,
+            'format': arch_format,
+            'size': size,
+            'result': int(bool(result)),
+            'launch': launch,
+            'exit': exit_,
+            'phases': json.dumps(phases, separators=(',', ':'))}
+
+
+def record(fname, launch_record):
+    """Append launch record to the metrics database"""
+    try:
+        conn = connect(fname)
+        with conn:
+            conn.execute(f"INSERT INTO launches ({', '.join(COLUMNS)}) "
+                         f"VALUES ({', '.join('?' * len(COLUMNS))})",
+                         [launch_record[key] for key in COLUMNS])
+        conn.close()
+    except (OSError, sqlite3.Error) as exc:
+        logging.warning("Unable to store launch metrics in `%s': %s.",
+                        fname, exc)
+        return False
+    return True
+
+
+def percentile(values, pct):
+    """
+    Return percentile of the values, with linear interpolation between
+    closest ranks, or None for empty values.
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    pos = (len(values) - 1) * pct / 100
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+def get_stats(conn, column):
+    """
+    Return list of tuples (key, launches, launch p50, launch p95, exit p50,
+    exit p95) grouped by the column (config or format) of the successful
+    launches, sorted by the launch p95 from the slowest.
+    """
+    groups = {}
+    for key, launch, exit_ in conn.execute(
+            f"SELECT {column}, launch, exit FROM launches "
+            "WHERE result = 1 AND launch IS NOT NULL"):
+        group = groups.setdefault(key or '-', ([], []))
+        group[0].append(launch)
+        group[1].append(exit_)
+
+    stats = [(key, len(launches),
+              percentile(launches, 50), percentile(launches, 95),
+              percentile(exits, 50), percentile(exits, 95))
+             for key, (launches, exits) in groups.items()]
+    stats.sort(key=lambda item: (-item[3], item[0]))
+    return stats
+
+
+def get_title(config):
+    """
+    Return name of the game for the configuration file path - its name
+    without extension, or the directory name for default `Config.fs-uae'.
+    """
+    name = os.path.splitext(os.path.basename(config))[0]
+    if name == 'Config':
+        name = os.path.basename(os.path.dirname(config)) or name
+    return name
+
+
+def report(fname, out=None):
+    """Write the latency report of the stored launches. Return True/False"""
+    out = out or sys.stdout
+    if not os.path.exists(fname):
+        logging.error("Metrics database `%s' doesn't exist. Enable "
+                      "wrapper_metrics option to collect them.", fname)
+        return False
+
+    try:
+        conn = connect(fname)
+        tables = [('game', get_stats(conn, 'config')),
+                  ('format', get_stats(conn, 'format'))]
+        conn.close()
+    except sqlite3.Error as exc:
+        logging.error("Unable to read metrics from `%s': %s.", fname, exc)
+        return False
+
+    tables[0] = ('game', [(get_title(item[0]),) + item[1:]
+                          for item in tables[0][1]])
+    for title, stats in tables:
+        width = max([len(title)] + [len(item[0]) for item in stats])
+        out.write(f"{title:<{width}}  {'runs':>5}  {'launch p50':>10}  "
+                  f"{'launch p95':>10}  {'exit p50':>8}  {'exit p95':>8}\n")
+        for key, count, l50, l95, e50, e95 in stats:
+            out.write(f"{key:<{width}}  {count:>5}  {l50:>10.2f}  "
+                      f"{l95:>10.2f}  {e50:>8.2f}  {e95:>8.2f}\n")
+        out.write('\n')
+    return True
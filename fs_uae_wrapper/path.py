@@ -3,6 +3,9 @@ Misc utilities
 """
 import os
 
+# results of the executables lookups, for every PATH value
+_LOOKUPS = {}
+
 
 def which(executables):
     """
@@ -10,13 +13,33 @@ def which(executables):
     to the archiver attribute
     """
 
-    if not isinstance(executables, list):
+    if not isinstance(executables, (list, tuple)):
         executables = [executables]
 
+    lookups = _LOOKUPS.setdefault(os.environ["PATH"], {})
     for fname in executables:
-        for path in os.environ["PATH"].split(os.pathsep):
-            path = os.path.join(path.strip('"'), fname)
-            if os.path.isfile(path) and os.access(path, os.X_OK):
-                return fname
+        if fname not in lookups:
+            lookups[fname] = _find(fname)
+        if lookups[fname]:
+            return fname
 
     return None
+
+
+def get_lookups():
+    """Return dictionary of executables looked up in current PATH"""
+    return dict(_LOOKUPS.get(os.environ["PATH"], {}))
+
+
+def add_lookups(lookups):
+    """Add results of executables lookups made in current PATH"""
+    _LOOKUPS.setdefault(os.environ["PATH"], {}).update(lookups)
+
+
+def _find(fname):
+    """Return True if executable can be found in PATH"""
+    for path in os.environ["PATH"].split(os.pathsep):
+        path = os.path.join(path.strip('"'), fname)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return True
+    return False
@@ -0,0 +1,177 @@
+"""
+Detached worker for storing data (save states, changed filesystems) after
+emulator exits, so that the wrapper can return immediately.
+
+Worker holds exclusive locks for all target archives until it's done, so
+that next launch of the same game will wait for the data to be stored.
+Outcome of the worker is recorded in the status file for every target.
+"""
+import fcntl
+import hashlib
+import importlib
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from fs_uae_wrapper import utils
+
+# attributes of the wrapper object, which are not needed by the worker
+TRANSIENT = ('plan',)
+
+
+def get_state_dir():
+    """Return directory for lock and status files"""
+    xdg_state = os.getenv('XDG_STATE_HOME',
+                          os.path.expanduser('~/.local/state'))
+    return os.path.join(xdg_state, 'fs-uae-wrapper')
+
+
+def _get_path(target, ext):
+    """Return path to the state file for provided target"""
+    name = hashlib.sha1(os.path.abspath(target).encode('utf-8')).hexdigest()
+    return os.path.join(get_state_dir(), name + ext)
+
+
+def get_lock_path(target):
+    """Return path to the lock file for provided target"""
+    return _get_path(target, '.lock')
+
+
+def get_status_path(target):
+    """Return path to the status file for provided target"""
+    return _get_path(target, '.status')
+
+
+def get_status(target):
+    """Return status dict for the target or None"""
+    return utils.read_json(get_status_path(target))
+
+
+def set_status(targets, status, **kwargs):
+    """Write status for provided targets"""
+    for target in targets:
+        utils.write_json(get_status_path(target),
+                         {'target': os.path.abspath(target),
+                          'status': status,
+                          'pid': os.getpid(),
+                          'time': time.time(),
+                          **kwargs})
+
+
+def wait_for(target):
+    """
+    Wait for the pending background worker which stores the target, if there
+    is any.
+    """
+    lock = get_lock_path(target)
+    if not os.path.exists(lock):
+        return
+
+    with utils.lock_file(lock, shared=True, blocking=False) as locked:
+        if not locked:
+            logging.info("Waiting for pending save of `%s'.", target)
+    with utils.lock_file(lock, shared=True):
+        pass
+
+    status = get_status(target) or {}
+    if status.get('status') == 'failed':
+        logging.warning("Last background save of `%s' has failed: %s.",
+                        target, status.get('error', 'unknown error'))
+
+
+def get_state(runner):
+    """Return attributes of the wrapper object, which are passed to worker"""
+    return {key: val for key, val in vars(runner).items()
+            if key not in TRANSIENT}
+
+
+def spawn(runner, targets):
+    """
+    Hand over the wrapper object (along with its temporary directory) to the
+    detached worker process. Locks for the targets are acquired here, and
+    inherited by the worker. Return True on success. On failure the locks
+    are released, and temporary directory stays with the wrapper object, so
+    that the data can be stored synchronously.
+    """
+    fds = []
+    job = runner.dir + '.job'
+    try:
+        os.makedirs(get_state_dir(), exist_ok=True)
+        for target in targets:
+            fd = os.open(get_lock_path(target), os.O_WRONLY | os.O_CREAT,
+                         0o644)
+            fds.append(fd)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+
+        utils.write_json(job, {'module': type(runner).__module__,
+                               'class': type(runner).__name__,
+                               'state': get_state(runner),
+                               'targets': targets})
+        set_status(targets, 'pending')
+        subprocess.Popen([sys.executable, '-m', 'fs_uae_wrapper.persist',
+                          job], pass_fds=fds, start_new_session=True,
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL)
+    except (OSError, TypeError, ValueError) as exc:
+        logging.error("Unable to start background worker: %s.", exc)
+        try:
+            if os.path.exists(job):
+                os.unlink(job)
+            set_status(targets, 'failed', error=str(exc))
+        except OSError as exc:
+            logging.debug("Cannot clean up after the worker: %s.", exc)
+        return False
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+    logging.info("Data will be stored in background by the worker.")
+    return True
+
+
+def main(job_file):
+    """
+    Worker entry point. Recreate wrapper object out of the job file, and run
+    its post emulation tasks.
+    """
+    logging.basicConfig(filename=os.path.join(get_state_dir(), 'worker.log'),
+                        level=logging.INFO,
+                        format="%(asctime)s %(levelname)s\t%(process)d\t"
+                        "%(filename)s:%(lineno)d:\t\t%(message)s")
+
+    job = utils.read_json(job_file)
+    if job is None:
+        logging.error("Unable to read job file `%s'.", job_file)
+        return 1
+    os.unlink(job_file)
+
+    module = importlib.import_module(job['module'])
+    cls = getattr(module, job['class'])
+    runner = cls.__new__(cls)
+    runner.__dict__.update(job['state'])
+    runner.fsuae_options = utils.CmdOption(runner.fsuae_options)
+
+    set_status(job['targets'], 'running')
+    error = None
+    try:
+        result = runner._persist()
+    except Exception as exc:
+        logging.exception("Background save failed.")
+        result = False
+        error = str(exc)
+    finally:
+        runner.clean()
+
+    if result:
+        set_status(job['targets'], 'done')
+        return 0
+
+    set_status(job['targets'], 'failed',
+               error=error or 'see worker.log for details')
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1]))
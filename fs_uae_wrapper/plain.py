@@ -2,7 +2,7 @@
 Simple class for executing fs-uae with specified parameters. This is a
 failsafe class for running fs-uae.
 """
-from fs_uae_wrapper import base, utils
+from fs_uae_wrapper import base, timing, utils
 
 
 class Wrapper(base.Base):
@@ -16,8 +16,9 @@ class Wrapper(base.Base):
 
     def _run_emulator(self):
         """execute fs-uae"""
-        utils.run_command(['fs-uae', self.conf_file,
-                           *self.fsuae_options.list()])
+        with timing.span('emulator'):
+            utils.run_command(['fs-uae', self.conf_file,
+                               *self.fsuae_options.list()])
 
     def clean(self):
         """Do the cleanup. Here - just do nothing"""
@@ -0,0 +1,137 @@
+"""
+Launch plan - results of processing the configuration (options read from
+the configuration files, normalized paths, archive name and lookups of the
+archivers executables), which are stored between launches and reused as long
+as none of the files they were computed from, PATH, current directory and
+command line options has changed.
+"""
+import hashlib
+import logging
+import os
+
+from fs_uae_wrapper import path, persist, utils
+
+VERSION = 1
+
+
+class Plan(object):
+    """
+    Memoized values of the launch. Plan without file name is disabled, and
+    values are computed every time.
+    """
+    def __init__(self, fname=None, key=None):
+        self.fname = fname
+        self.key = key
+        self.data = {}
+        self.inputs = {}
+        self.changed = False
+
+    def get(self, name, func, inputs=()):
+        """
+        Return value stored under name, or compute it with func and store
+        it, unless it's None. Value depends on contents of the files listed in
+        inputs. Inputs are checked after calling func, so it may extend the
+        list.
+        """
+        if not self.fname:
+            return func()
+
+        if name in self.data:
+            return self.data[name]
+
+        value = func()
+        if value is not None:
+            self.data[name] = value
+            self.inputs.update((fname, get_mtime(fname)) for fname in inputs)
+            self.changed = True
+        return value
+
+    def load(self):
+        """Read stored plan, if it's still valid. Return True/False"""
+        if not self.fname:
+            return False
+
+        stored = utils.read_json(self.fname)
+        if (not stored or stored.get('version') != VERSION or
+                stored.get('key') != self.key):
+            return False
+
+        for fname, mtime in stored['inputs'].items():
+            if get_mtime(fname) != mtime:
+                logging.debug("Launch plan is outdated, `%s' has changed.",
+                              fname)
+                return False
+
+        self.data = stored['data']
+        self.inputs = stored['inputs']
+        path.add_lookups(self.data.get('executables', {}))
+        return True
+
+    def save(self):
+        """Store the plan, if it has changed. Return True/False"""
+        if not self.fname:
+            return True
+
+        lookups = path.get_lookups()
+        if lookups != self.data.get('executables'):
+            self.data['executables'] = lookups
+            self.changed = True
+
+        if not self.changed:
+            return True
+
+        try:
+            os.makedirs(os.path.dirname(self.fname), exist_ok=True)
+            utils.write_json(self.fname, {'version': VERSION,
+                                          'key': self.key,
+                                          'inputs': self.inputs,
+                                          'data': self.data})
+        except OSError as exc:
+            logging.debug("Cannot store launch plan in `%s': %s.", self.fname,
+                          exc)
+            return False
+        self.changed = False
+        return True
+
+
+def get_mtime(fname):
+    """Return modification time of the file in ns, or None if it's missing"""
+    try:
+        return os.stat(fname).st_mtime_ns
+    except OSError:
+        return None
+
+
+def get_key(conf_file, options):
+    """
+    Return key of the plan - things other than input files, which values
+    depend on. Directories in PATH are included with their modification
+    times, which change when executables are installed or removed.
+    """
+    dirs = os.environ.get('PATH', '').split(os.pathsep)
+    return {'config': os.path.abspath(conf_file),
+            'cwd': os.getcwd(),
+            'options': dict(options),
+            'path': [[dirname, get_mtime(dirname.strip('"'))]
+                     for dirname in dirs]}
+
+
+def get_plan_path(conf_file):
+    """Return path to the plan file for provided configuration file"""
+    name = hashlib.sha1(os.path.abspath(conf_file).encode('utf-8'))
+    return os.path.join(persist.get_state_dir(), 'plans',
+                        name.hexdigest() + '.json')
+
+
+def load(conf_file, options):
+    """
+    Return launch plan for provided configuration file and command line
+    options. Stored values are reused if they are still valid.
+    """
+    if options.get('wrapper_plan_cache', '1') == '0':
+        return Plan()
+
+    launch_plan = Plan(get_plan_path(conf_file), get_key(conf_file, options))
+    if launch_plan.load():
+        logging.debug("Using stored launch plan `%s'.", launch_plan.fname)
+    return launch_plan
@@ -0,0 +1,338 @@
+"""
+Predictive prefetch - while the game is running, archives of the games which
+are most likely to be launched next (see history module) are extracted into
+the cache by detached, low priority worker, so that next launch hits a warm
+cache.
+
+Worker extracts one archive at a time in a separate process group, which is
+stopped (SIGSTOP) whenever the emulator is doing disk I/O, or when the
+worker itself exceeds its I/O budget, and continued (SIGCONT) afterwards.
+"""
+import logging
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from fs_uae_wrapper import cache, history, manifest, path, persist, prefetch
+from fs_uae_wrapper import process, utils
+
+EMULATOR = 'fs-uae'
+INTERVAL = 0.5
+# how long to wait for the emulator to start, in seconds
+START_TIMEOUT = 600
+DEFAULTS = {'wrapper_predict': 0,
+            'wrapper_predict_size': 2048,  # MiB added to the cache
+            'wrapper_predict_io': 8,  # MiB/s of worker disk I/O
+            'wrapper_predict_pressure': 1,  # MiB/s of emulator disk I/O
+            'wrapper_predict_threads': 1}
+
+
+def get_number(options, name):
+    """Return non negative integer value of the option"""
+    value = options.get(name, DEFAULTS[name])
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        logging.warning("Wrong value for `%s': %s, using %d.", name, value,
+                        DEFAULTS[name])
+        return DEFAULTS[name]
+
+
+def get_proc_stat(pid):
+    """
+    Return dictionary with parent pid, process group and aggregated block
+    I/O delay (in clock ticks) of the process, or None if it's gone.
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as fobj:
+            stat = fobj.read()
+    except OSError:
+        return None
+    # process name might contain spaces and parentheses
+    fields = stat[stat.rfind(')') + 2:].split()
+    try:
+        return {'ppid': int(fields[1]),
+                'pgrp': int(fields[2]),
+                'blkio': int(fields[39]) if len(fields) > 39 else 0}
+    except (IndexError, ValueError):
+        return None
+
+
+def get_processes(ppid=None, pgrp=None):
+    """Return list of pids of the processes with provided parent or group"""
+    pids = []
+    try:
+        names = os.listdir('/proc')
+    except OSError:
+        return pids
+    for name in names:
+        if not name.isdigit():
+            continue
+        stat = get_proc_stat(name)
+        if stat is None:
+            continue
+        if ppid is not None and stat['ppid'] != ppid:
+            continue
+        if pgrp is not None and stat['pgrp'] != pgrp:
+            continue
+        pids.append(int(name))
+    return pids
+
+
+def find_emulator(wrapper_pid):
+    """
+    Return pid of the emulator started by the wrapper, or None. Emulator
+    might be a script run by an interpreter, so interpreter argument is
+    checked as well.
+    """
+    for pid in get_processes(ppid=wrapper_pid):
+        try:
+            with open(f'/proc/{pid}/cmdline', 'rb') as fobj:
+                args = fobj.read().split(b'\0')[:2]
+        except OSError:
+            continue
+        if any(os.path.basename(arg.decode('utf-8', 'replace')) == EMULATOR
+               for arg in args):
+            return pid
+    return None
+
+
+def is_running(pid):
+    """Return True if process is still running (and it's not a zombie)"""
+    try:
+        with open(f'/proc/{pid}/stat') as fobj:
+            stat = fobj.read()
+    except OSError:
+        return False
+    return stat[stat.rfind(')') + 2:].split(' ', 1)[0] not in ('Z', 'X')
+
+
+class IOSampler(object):
+    """
+    Disk I/O rate of the group of processes. Only processes present in both
+    samples are accounted, so that processes which are gone don't spoil the
+    difference.
+    """
+    def __init__(self):
+        self.last = {}
+        self.time = time.monotonic()
+
+    def sample(self, pids):
+        """
+        Return tuple of disk I/O rate in bytes per second and block I/O
+        delay ticks of the processes since previous sample.
+        """
+        now = time.monotonic()
+        current = {}
+        for pid in pids:
+            io_stats = process.read_io(pid)
+            stat = get_proc_stat(pid)
+            if io_stats is None or stat is None:
+                continue
+            current[pid] = (io_stats.get('read_bytes', 0) +
+                            io_stats.get('write_bytes', 0), stat['blkio'])
+
+        io_bytes = sum(val[0] - self.last[pid][0]
+                       for pid, val in current.items() if pid in self.last)
+        ticks = sum(val[1] - self.last[pid][1]
+                    for pid, val in current.items() if pid in self.last)
+        elapsed = max(now - self.time, 1e-6)
+        self.last = current
+        self.time = now
+        return io_bytes / elapsed, ticks
+
+
+def _extract(directory, size, arch_name, files, threads):
+    """Extractor process entry point"""
+    os.setpgid(0, 0)
+    meta = cache.Cache(directory, size).store(arch_name, threads,
+                                              list(files) if files else None)
+    sys.exit(0 if meta else 1)
+
+
+class Predictor(object):
+    """Extract archives into the cache within the budget"""
+    def __init__(self, job):
+        self.job = job
+        self.size = job['size'] * 1024 * 1024
+        self.io_budget = job['io'] * 1024 * 1024
+        self.pressure = job['pressure'] * 1024 * 1024
+        self.emulator = None
+        self.added = 0
+        self.paused = 0
+
+    def run(self):
+        """Prefetch archives of the candidates. Return True/False"""
+        self.emulator = self._wait_for_emulator()
+        if self.emulator is None:
+            logging.info("Emulator has not been started, nothing to do.")
+            return True
+
+        candidates = history.get_candidates(
+            self.job['config'], history.load(),
+            history.get_playlist(self.job['config'], self.job['playlist']),
+            self.job['count'])
+        collection = prefetch.Collection(self.job['options'])
+        for conf_file in candidates:
+            collection.add(conf_file)
+
+        for (directory, arch_name, files), size in collection.jobs.items():
+            if not is_running(self.emulator):
+                logging.info("Emulator has exited, stopping.")
+                break
+            self._prefetch(cache.Cache(directory, size), arch_name, files)
+
+        logging.info("Prefetched %d MiB for %d candidates, paused for "
+                     "%.1f s.", self.added // 2**20, len(candidates),
+                     self.paused)
+        return True
+
+    def _wait_for_emulator(self):
+        """Return pid of the emulator, when it's started, or None"""
+        start = time.monotonic()
+        while time.monotonic() - start < START_TIMEOUT:
+            if not is_running(self.job['pid']):
+                return None
+            pid = find_emulator(self.job['pid'])
+            if pid:
+                return pid
+            time.sleep(INTERVAL)
+        return None
+
+    def _prefetch(self, arch_cache, arch_name, files):
+        """Extract archive into the cache, if it fits in the budget"""
+        estimate = manifest.get_unpacked_size(arch_name)
+        if estimate is None:
+            estimate = os.path.getsize(arch_name)
+        if self.added + estimate > self.size:
+            logging.info("Skipping `%s', it exceeds prefetch budget.",
+                         arch_name)
+            return False
+
+        usage = arch_cache.get_usage()
+        if usage + estimate > arch_cache.size:
+            # prefetched entry must not evict the ones which are used
+            logging.info("Skipping `%s', it doesn't fit in the cache.",
+                         arch_name)
+            return False
+
+        logging.info("Prefetching `%s'.", arch_name)
+        extractor = multiprocessing.Process(
+            target=_extract, args=(arch_cache.directory,
+                                   arch_cache.size // 2**20, arch_name,
+                                   files, self.job['threads']))
+        extractor.start()
+        self._watch(extractor)
+        self.added += max(arch_cache.get_usage() - usage, 0)
+        return extractor.exitcode == 0
+
+    def _watch(self, extractor):
+        """
+        Wait for the extractor, stopping it while the emulator is under I/O
+        pressure or extractor is over the I/O budget.
+        """
+        emulator_io = IOSampler()
+        extractor_io = IOSampler()
+        stopped = False
+        while extractor.is_alive():
+            extractor.join(INTERVAL)
+            rate, ticks = emulator_io.sample([self.emulator])
+            own_rate, _ = extractor_io.sample(get_processes(
+                pgrp=extractor.pid))
+            # after the emulator exits, extraction is finished at full speed
+            busy = is_running(self.emulator) and (
+                ticks > 0 or rate > self.pressure or
+                own_rate > self.io_budget)
+            if busy != stopped:
+                logging.debug("%s extractor (emulator I/O %d KiB/s, "
+                              "extractor I/O %d KiB/s).",
+                              'Stopping' if busy else 'Continuing',
+                              rate // 1024, own_rate // 1024)
+                _signal(extractor.pid,
+                        signal.SIGSTOP if busy else signal.SIGCONT)
+                stopped = busy
+            if stopped:
+                self.paused += INTERVAL
+
+        if stopped:
+            _signal(extractor.pid, signal.SIGCONT)
+
+
+def _signal(pgrp, signum):
+    """Send the signal to the process group"""
+    try:
+        os.killpg(pgrp, signum)
+    except OSError:
+        pass
+
+
+def spawn(conf_file, fsuae_options, options):
+    """
+    Start detached predictive prefetch worker for the launched configuration,
+    if it's enabled. Return True if worker was started.
+    """
+    count = get_number(options, 'wrapper_predict')
+    if not count:
+        return False
+    if cache.get_cache_dir(options) is None:
+        logging.warning("Predictive prefetch needs the cache to be enabled.")
+        return False
+
+    job = {'config': os.path.abspath(conf_file),
+           'options': dict(fsuae_options),
+           'pid': os.getpid(),
+           'count': count,
+           'size': get_number(options, 'wrapper_predict_size'),
+           'io': get_number(options, 'wrapper_predict_io'),
+           'pressure': get_number(options, 'wrapper_predict_pressure'),
+           'threads': max(get_number(options, 'wrapper_predict_threads'), 1),
+           'playlist': options.get('wrapper_playlist')}
+    job_file = os.path.join(persist.get_state_dir(),
+                            f'predict-{os.getpid()}.job')
+    try:
+        os.makedirs(persist.get_state_dir(), exist_ok=True)
+        utils.write_json(job_file, job)
+        subprocess.Popen([sys.executable, '-m', 'fs_uae_wrapper.predict',
+                          job_file], start_new_session=True,
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL)
+    except OSError as exc:
+        logging.error("Unable to start predictive prefetch: %s.", exc)
+        return False
+
+    logging.info("Predictive prefetch of %d archives started.", count)
+    return True
+
+
+def main(job_file):
+    """
+    Worker entry point. Lower CPU and I/O priority of the process, and
+    prefetch the archives.
+    """
+    logging.basicConfig(filename=os.path.join(persist.get_state_dir(),
+                                              'predict.log'),
+                        level=logging.INFO,
+                        format="%(asctime)s %(levelname)s\t%(process)d\t"
+                        "%(filename)s:%(lineno)d:\t\t%(message)s")
+
+    job = utils.read_json(job_file)
+    if job is None:
+        logging.error("Unable to read job file `%s'.", job_file)
+        return 1
+    os.unlink(job_file)
+
+    os.nice(19)
+    ionice = path.which('ionice')
+    if ionice:
+        # idle I/O class, disk is used only when nobody else needs it
+        subprocess.call([ionice, '-c', '3', '-p', str(os.getpid())],
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    return 0 if Predictor(job).run() else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1]))
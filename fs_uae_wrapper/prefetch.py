@@ -0,0 +1,304 @@
+"""
+Prefetch - extract archives of the whole collection into the cache ahead of
+time, so that even the first launch of the game will hit a warm cache.
+"""
+import concurrent.futures
+import logging
+import os
+import sys
+import time
+
+from fs_uae_wrapper import cache, file_archive, index, members, utils
+
+# formats, which extraction speed is limited by the CPU rather than by the
+# disk
+CPU_FORMATS = ('tar.bz2', 'tar.xz', '7z', 'rar', 'lha', 'lzx')
+WRAPPERS = ('archive', 'cd32', 'whdload')
+DEFAULT_IO_JOBS = 2
+MIB = 1024 * 1024
+
+
+def get_configs(source):
+    """
+    Return list of configuration files out of the source, which might be
+    a directory tree, single configuration file or a file with list of
+    configuration files, one per line. Relative paths in the list are
+    relative to the list file location.
+    """
+    if os.path.isdir(source):
+        configs = []
+        for root, dirs, fnames in os.walk(source):
+            dirs.sort()
+            configs.extend(os.path.join(root, fname)
+                           for fname in sorted(fnames)
+                           if fname.endswith('.fs-uae'))
+        return configs
+
+    if source.endswith('.fs-uae'):
+        return [source]
+
+    list_dir = os.path.dirname(os.path.abspath(source))
+    with open(source) as fobj:
+        return [os.path.join(list_dir, line.strip()) for line in fobj
+                if line.strip() and not line.startswith('#')]
+
+
+def get_kind(arch_name):
+    """Return "cpu" or "io" depending on what limits archive extraction"""
+    if file_archive.get_format(arch_name) in CPU_FORMATS:
+        return 'cpu'
+    return 'io'
+
+
+def get_jobs_number(options, name, default):
+    """Return number of the concurrent jobs set by the option"""
+    value = options.get(name, default)
+    try:
+        value = int(value)
+    except ValueError:
+        logging.warning("Wrong value for `%s': %s, using %d.", name, value,
+                        default)
+        return default
+    return max(value, 1)
+
+
+class Collection(object):
+    """
+    Archives used by the configurations from the collection, which are
+    extracted through the cache on launch.
+    """
+    def __init__(self, options):
+        """
+        Params:
+            options:    command line options, which have precedence over the
+                        configuration files ones
+        """
+        self.options = options
+        self.jobs = {}
+        self.configs = 0
+        self._names_maps = {}
+
+    def add(self, conf_file):
+        """Add archives used by configuration file. Return True/False"""
+        configuration = utils.get_config_options(conf_file)
+        if configuration is None:
+            logging.warning("Cannot read configuration `%s'.", conf_file)
+            return False
+
+        all_options = utils.merge_all_options(configuration, self.options)
+        wrapper = all_options.get('wrapper')
+        if wrapper not in WRAPPERS:
+            logging.debug("Configuration `%s' uses `%s' wrapper, skipping.",
+                          conf_file, wrapper)
+            return True
+
+        self.configs += 1
+        if (wrapper == 'archive' and
+                all_options.get('wrapper_persist_data', '0') == '1'):
+            logging.debug("Archive of `%s' is written back after emulation, "
+                          "skipping.", conf_file)
+            return True
+
+        arch_name = self._get_archive(conf_file, all_options)
+        if not arch_name:
+            return False
+
+        files = None
+        selected = members.get_members(arch_name, all_options)
+        if selected:
+            files = tuple(sorted(name for name, _ in selected))
+        arch_cache = cache.get_cache(dict(all_options, wrapper_cache='1'))
+        self._add_job(arch_cache, arch_name, files)
+
+        base_image = all_options.get('wrapper_whdload_base')
+        if wrapper == 'whdload' and base_image:
+            if base_image.startswith('$CONFIG'):
+                base_image = utils.interpolate_variables(base_image,
+                                                         conf_file)
+            base_image = os.path.abspath(os.path.expanduser(base_image))
+            if not os.path.exists(base_image):
+                logging.warning("Base image `%s' doesn't exists.",
+                                base_image)
+                return False
+            self._add_job(arch_cache, base_image, None)
+        return True
+
+    def _get_archive(self, conf_file, options):
+        """Return path to the archive used by configuration, or None"""
+        conf_dir = os.path.dirname(os.path.abspath(conf_file))
+        arch = options.get('wrapper_archive')
+        if not arch:
+            if conf_dir not in self._names_maps:
+                try:
+                    names = os.listdir(conf_dir)
+                except OSError:
+                    names = []
+                self._names_maps[conf_dir] = index.get_names_map(names)
+            arch = index.find_archive(
+                os.path.splitext(os.path.basename(conf_file))[0],
+                self._names_maps[conf_dir])
+
+        if not arch or not os.path.exists(os.path.join(conf_dir, arch)):
+            logging.warning("Cannot find archive for configuration `%s'.",
+                            conf_file)
+            return None
+        return os.path.join(conf_dir, arch)
+
+    def _add_job(self, arch_cache, arch_name, files):
+        """Add archive to be extracted into the cache"""
+        key = (arch_cache.directory, arch_name, files)
+        if key not in self.jobs:
+            self.jobs[key] = arch_cache.size // MIB
+
+
+def _store(directory, size, arch_name, files, threads):
+    """
+    Extract archive into the cache entry. Return tuple of flag whether
+    archive was extracted and entry size, or None in case of failure.
+    """
+    start = time.time()
+    meta = cache.Cache(directory, size).store(arch_name, threads,
+                                              list(files) if files else None)
+    if meta is None:
+        return None
+    return meta['created'] >= start, meta['size']
+
+
+class Stats(object):
+    """Statistics of the jobs done by one pool"""
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.extracted = 0
+        self.cached = 0
+        self.failed = 0
+        self.read = 0
+        self.written = 0
+
+    def update(self, result, arch_size):
+        """Update statistics with the job result"""
+        if result is None:
+            self.failed += 1
+        elif result[0]:
+            self.extracted += 1
+            self.read += arch_size
+            self.written += result[1]
+        else:
+            self.cached += 1
+
+
+class Prefetcher(object):
+    """
+    Extract archives into the cache using two bounded process pools: one for
+    formats, which extraction is CPU bound, with a process per CPU by
+    default, and one for I/O bound formats, with only a few processes, so
+    that the disk is not trashed by the concurrent reads.
+    """
+    def __init__(self, cpu_jobs, io_jobs):
+        self.cpu_jobs = cpu_jobs
+        self.io_jobs = io_jobs
+        self.stats = {'cpu': Stats(cpu_jobs), 'io': Stats(io_jobs)}
+        self.used = {}
+
+    def run(self, jobs):
+        """
+        Extract archives from the jobs dictionary (see Collection). Jobs are
+        submitted to the pools gradually, and when the size budget of the
+        cache is reached, remaining jobs for it are dropped.
+        """
+        queues = {'cpu': [], 'io': []}
+        for (directory, arch_name, files), size in jobs.items():
+            queues[get_kind(arch_name)].append((directory, size, arch_name,
+                                                files))
+
+        cpus = os.cpu_count() or 1
+        threads = {'cpu': max(cpus // self.cpu_jobs, 1), 'io': 1}
+        with concurrent.futures.ProcessPoolExecutor(self.cpu_jobs) as cpu, \
+                concurrent.futures.ProcessPoolExecutor(self.io_jobs) as io:
+            pools = {'cpu': cpu, 'io': io}
+            running = {}
+            while running or queues['cpu'] or queues['io']:
+                for kind, pool in pools.items():
+                    limit = self.stats[kind].jobs * 2
+                    while (queues[kind] and
+                           sum(1 for job in running.values()
+                               if job[0] == kind) < limit):
+                        job = queues[kind].pop(0)
+                        future = pool.submit(_store, *job, threads[kind])
+                        running[future] = (kind, job)
+
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    kind, job = running.pop(future)
+                    self._done(kind, job, future, queues)
+
+    def _done(self, kind, job, future, queues):
+        """Account finished job"""
+        directory, size, arch_name = job[:3]
+        try:
+            result = future.result()
+        except Exception as exc:  # worker has crashed
+            logging.error("Prefetching `%s' failed: %s.", arch_name, exc)
+            result = None
+
+        try:
+            arch_size = os.path.getsize(arch_name)
+        except OSError:
+            arch_size = 0
+        self.stats[kind].update(result, arch_size)
+        if result is None:
+            return
+
+        self.used[directory] = self.used.get(directory, 0) + result[1]
+        if self.used[directory] < size * MIB:
+            return
+
+        for name in queues:
+            dropped = [job for job in queues[name] if job[0] == directory]
+            if dropped:
+                logging.warning("Cache `%s' is full, skipping %d archives.",
+                                directory, len(dropped))
+                queues[name] = [job for job in queues[name]
+                                if job[0] != directory]
+
+
+def run(source, options, out=None):
+    """
+    Extract archives used by the configurations from the source into the
+    cache. Archives which are already in the cache are skipped, so that
+    interrupted run can be resumed by running it again. Return True/False
+    """
+    out = out or sys.stdout
+    start = time.time()
+    try:
+        configs = get_configs(source)
+    except OSError as exc:
+        logging.error("Cannot read list of configurations `%s': %s.", source,
+                      exc)
+        return False
+
+    collection = Collection(options)
+    for conf_file in configs:
+        collection.add(conf_file)
+
+    prefetcher = Prefetcher(
+        get_jobs_number(options, 'wrapper_prefetch_cpu_jobs',
+                        os.cpu_count() or 1),
+        get_jobs_number(options, 'wrapper_prefetch_io_jobs',
+                        DEFAULT_IO_JOBS))
+    prefetcher.run(collection.jobs)
+
+    elapsed = max(time.time() - start, 1e-6)
+    read = sum(stats.read for stats in prefetcher.stats.values())
+    written = sum(stats.written for stats in prefetcher.stats.values())
+    out.write(f"Prefetched {len(collection.jobs)} archives for "
+              f"{collection.configs} configurations in {elapsed:.1f} s, "
+              f"{read / MIB:.1f} MiB read ({read / MIB / elapsed:.1f} MiB/s), "
+              f"{written / MIB:.1f} MiB extracted "
+              f"({written / MIB / elapsed:.1f} MiB/s).\n")
+    for kind, stats in sorted(prefetcher.stats.items()):
+        out.write(f"  {kind} bound ({stats.jobs} jobs): {stats.extracted} "
+                  f"extracted, {stats.cached} already cached, "
+                  f"{stats.failed} failed, {stats.read / MIB:.1f} MiB "
+                  f"read.\n")
+    return not any(stats.failed for stats in prefetcher.stats.values())
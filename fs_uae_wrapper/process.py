@@ -0,0 +1,150 @@
+"""
+Running child processes (archivers, emulator) with accounting of the
+resources they used
+"""
+import logging
+import os
+import subprocess
+import threading
+import time
+
+# list of dictionaries with resource usage of every finished child process
+USAGE = []
+MAX_COMMAND_LEN = 256
+
+
+def call(cmd, cwd=None, feed=None):
+    """
+    Run command and wait for it to finish, like subprocess.call. Wall time,
+    CPU times, peak memory and I/O of the process are appended to USAGE.
+    Peak memory reported by the kernel includes memory of the wrapper at the
+    time process was started, so it's marked as exact only if it's bigger.
+    If feed callable is provided, it's called in separate thread with the
+    process standard input file object, which is closed afterwards.
+    Return exit code.
+    """
+    start = time.perf_counter()
+    inherited_rss = read_peak_rss(os.getpid())
+    stdin = subprocess.PIPE if feed else None
+    with subprocess.Popen(cmd, cwd=cwd, stdin=stdin) as proc:
+        feeder = None
+        if feed:
+            feeder = threading.Thread(target=_feed, args=(feed, proc.stdin),
+                                      daemon=True)
+            feeder.start()
+        try:
+            io_stats, rusage = _wait(proc)
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            if feeder:
+                feeder.join()
+
+    usage = {'command': ' '.join(cmd)[:MAX_COMMAND_LEN],
+             'pid': proc.pid,
+             'returncode': proc.returncode,
+             'wall': time.perf_counter() - start}
+    if rusage is not None:
+        usage.update({'user': rusage.ru_utime,
+                      'sys': rusage.ru_stime,
+                      # ru_maxrss is in KiB on Linux
+                      'max_rss': rusage.ru_maxrss * 1024,
+                      'max_rss_exact': (inherited_rss is not None and
+                                        rusage.ru_maxrss * 1024 >
+                                        inherited_rss)})
+    if io_stats is not None:
+        usage.update({'read_bytes': io_stats.get('read_bytes'),
+                      'write_bytes': io_stats.get('write_bytes'),
+                      'rchar': io_stats.get('rchar'),
+                      'wchar': io_stats.get('wchar')})
+    USAGE.append(usage)
+    return proc.returncode
+
+
+def read_io(pid):
+    """Return dictionary with the contents of /proc/<pid>/io or None"""
+    try:
+        with open(f'/proc/{pid}/io') as fobj:
+            return {key: int(val) for key, val in
+                    (line.split(':', 1) for line in fobj if ':' in line)}
+    except (OSError, ValueError):
+        return None
+
+
+def read_peak_rss(pid):
+    """
+    Return peak resident set size of the process in bytes, out of
+    /proc/<pid>/status, or None
+    """
+    try:
+        with open(f'/proc/{pid}/status') as fobj:
+            for line in fobj:
+                if line.startswith('VmHWM:'):
+                    # value is in kB
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def get_summary(usage):
+    """Return one line summary of the resource usage of the process"""
+    summary = (f"`{usage['command'].split(' ', 1)[0]}': "
+               f"{usage['wall']:.2f}s wall")
+    if 'user' in usage:
+        summary += (f", {usage['user']:.2f}s user, {usage['sys']:.2f}s sys, "
+                    f"{'' if usage.get('max_rss_exact') else 'at most '}"
+                    f"{usage['max_rss'] // 2**20} MiB peak RSS")
+    if usage.get('read_bytes') is not None:
+        summary += (f", {usage['read_bytes'] // 2**20} MiB read, "
+                    f"{usage['write_bytes'] // 2**20} MiB written")
+    return summary
+
+
+def log_usage():
+    """Log resource usage of all the finished child processes"""
+    for usage in USAGE:
+        logging.info("Process %s.", get_summary(usage))
+
+
+def _feed(feed, stdin):
+    """Call feed with the process standard input and close it"""
+    try:
+        feed(stdin)
+    except BrokenPipeError:
+        # process doesn't need the rest of the input
+        pass
+    except OSError as exc:
+        logging.error("Unable to feed the process: %s.", exc)
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def _wait(proc):
+    """
+    Wait for the process to exit. Before reaping it, read its I/O counters,
+    which are gone afterwards. Return tuple of I/O counters dictionary and
+    rusage, any of which may be None, if it's not available on the platform.
+    """
+    if not hasattr(os, 'waitid') or not hasattr(os, 'wait4'):
+        proc.wait()
+        return None, None
+
+    try:
+        os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+    except ChildProcessError:
+        # somebody else has reaped the process
+        proc.wait()
+        return None, None
+
+    io_stats = read_io(proc.pid)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return io_stats, rusage
@@ -33,16 +33,10 @@ class Wrapper(base.Base):
         if not super(Wrapper, self).run():
             return False
 
-        self._load_save()
-
-        if not self._copy_conf():
+        if not self._prepare():
             return False
 
         if not self._run_emulator():
             return False
 
-        if self._get_saves_dir():
-            if not self._save_save():
-                return False
-
-        return True
+        return self._finish()
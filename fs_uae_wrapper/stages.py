@@ -0,0 +1,100 @@
+"""
+Running the steps needed for preparing (or finishing) emulation session as a
+dependency graph, so that independent steps can be executed concurrently
+"""
+import concurrent.futures
+import logging
+import time
+
+from fs_uae_wrapper import timing
+
+
+class Scheduler(object):
+    """
+    Run stages in thread pool, as soon as all the stages they require are
+    done. Stages are callables which return True on success. If any of the
+    stages fails, no new stages are started, and the result of the whole run
+    is False.
+
+    With a single worker stages are run one by one, in the order they were
+    added, as long as requirements allow it.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers
+        self.stages = {}
+        self.durations = {}
+        self.elapsed = 0
+
+    def add(self, name, func, requires=()):
+        """Add stage, which will be run after stages named in requires"""
+        self.stages[name] = (func, tuple(requires))
+
+    def run(self):
+        """Run all the stages. Return True if all of them succeeded"""
+        for name, (_, requires) in self.stages.items():
+            for required in requires:
+                if required not in self.stages:
+                    raise ValueError(f"Stage `{name}' requires unknown stage "
+                                     f"`{required}'")
+
+        start = time.perf_counter()
+        done = set()
+        running = {}
+        result = True
+        workers = self.workers or max(len(self.stages), 1)
+
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            while result:
+                for name, (func, requires) in self.stages.items():
+                    if (name not in done and name not in running.values() and
+                            all(req in done for req in requires)):
+                        logging.debug("Starting stage `%s'.", name)
+                        running[executor.submit(self._run_stage, name,
+                                                func)] = name
+                if not running:
+                    break
+
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    if not future.result():
+                        logging.debug("Stage `%s' failed.", name)
+                        result = False
+                    done.add(name)
+
+            # let the already started stages finish
+            for future in concurrent.futures.as_completed(running):
+                future.result()
+
+        self.elapsed = time.perf_counter() - start
+        if result and len(done) < len(self.stages):
+            # there is a cycle in requirements
+            raise ValueError("Cannot run stages: " +
+                             ", ".join(sorted(set(self.stages) - done)))
+
+        if self.durations:
+            logging.info("Stages took %.2fs (%s), %.2fs saved by running "
+                         "them concurrently.", self.elapsed,
+                         ", ".join(f"{name}: {duration:.2f}s"
+                                   for name, duration in
+                                   self.durations.items()),
+                         self.get_saved_time())
+        return result
+
+    def get_saved_time(self):
+        """
+        Return difference between sum of durations of all the stages, and
+        the wall clock time they took.
+        """
+        return max(sum(self.durations.values()) - self.elapsed, 0)
+
+    def _run_stage(self, name, func):
+        """Run the stage and record its duration"""
+        start = time.perf_counter()
+        try:
+            with timing.span(name), timing.profiled():
+                return func()
+        finally:
+            self.durations[name] = time.perf_counter() - start
@@ -0,0 +1,142 @@
+"""
+Timing of the wrapper phases. Trace is written in Chrome trace event format,
+which can be opened in Perfetto (https://ui.perfetto.dev) or in
+chrome://tracing, optionally along with the cProfile dump of the wrapper
+Python code.
+"""
+import contextlib
+import cProfile
+import logging
+import os
+import pstats
+import threading
+import time
+
+from fs_uae_wrapper import persist, utils
+
+
+class Tracer(object):
+    """
+    Collect complete ('X') trace events for named spans. Spans are always
+    recorded, since it's cheap, so that phases which happen before options
+    are known are also included; they are written only on request.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.profiles = []
+        self._profile = None
+        self._start = time.perf_counter()
+        self._threads = {}
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        """Record duration of the code run within the context"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            event = {'name': name,
+                     'cat': 'wrapper',
+                     'ph': 'X',
+                     'ts': self._get_ts(start),
+                     'dur': self._get_ts(end) - self._get_ts(start),
+                     'pid': os.getpid(),
+                     'tid': self._get_tid()}
+            if args:
+                event['args'] = args
+            self.events.append(event)
+            logging.debug("%s took %.3fs.", name, end - start)
+
+    @contextlib.contextmanager
+    def profiled(self):
+        """
+        Profile the code run within the context in the current thread, if
+        profiling is enabled. cProfile works only for the thread, which
+        enabled it, so this is needed for code run in thread pools.
+        """
+        if self._profile is None or threading.current_thread() is \
+                threading.main_thread():
+            yield
+            return
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.profiles.append(profile)
+
+    def start_profile(self):
+        """Start profiling wrapper's Python code"""
+        if self._profile is not None:
+            return
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        self.profiles.append(self._profile)
+
+    def save(self, fname):
+        """
+        Write the trace into provided file, and profile (if enabled) into
+        the file with additional '.prof' extension. Return True on success.
+        """
+        if self._profile is not None:
+            self._profile.disable()
+
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                   'tid': tid, 'args': {'name': name}}
+                  for tid, name in self._threads.items()]
+        try:
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            utils.write_json(fname, {'traceEvents': events + self.events,
+                                     'displayTimeUnit': 'ms'})
+            if self.profiles:
+                pstats.Stats(*self.profiles).dump_stats(fname + '.prof')
+        except (OSError, TypeError) as exc:
+            logging.error("Unable to write trace `%s': %s.", fname, exc)
+            return False
+
+        logging.info("Trace written to `%s'.", fname)
+        return True
+
+    def now(self):
+        """Return current timestamp in microseconds since tracer creation"""
+        return self._get_ts(time.perf_counter())
+
+    def _get_ts(self, counter):
+        """Return timestamp in microseconds since tracer creation"""
+        return round((counter - self._start) * 1e6)
+
+    def _get_tid(self):
+        """Return id of the current thread, and remember its name"""
+        thread = threading.current_thread()
+        tid = threading.get_native_id()
+        self._threads.setdefault(tid, thread.name)
+        return tid
+
+
+TRACER = Tracer()
+
+
+def span(name, **args):
+    """Record the duration of the context with the global tracer"""
+    return TRACER.span(name, **args)
+
+
+def profiled():
+    """Profile the context in the current thread with the global tracer"""
+    return TRACER.profiled()
+
+
+def get_output_path(value, prefix):
+    """
+    Return path for the output file (trace, report) out of the option value.
+    For value "1" file is placed in state directory, and named after prefix
+    and current time.
+    """
+    if value != '1':
+        return os.path.abspath(os.path.expanduser(value))
+    return os.path.join(persist.get_state_dir(),
+                        time.strftime(f'{prefix}-%Y%m%d-%H%M%S.json'))
@@ -0,0 +1,123 @@
+"""
+Placement of the temporary directory, where games are extracted to
+"""
+import logging
+import os
+import shutil
+import tempfile
+
+RAM_FS = ('tmpfs', 'ramfs')
+# extra space on top of the estimated size, for file system overhead
+OVERHEAD = 0.1
+
+
+def get_candidates(options):
+    """
+    Return list of directories, where temporary directory can be placed, in
+    order of preference.
+    """
+    value = options.get('wrapper_tmp_dirs')
+    if not value:
+        return [tempfile.gettempdir()]
+    return [os.path.expandvars(os.path.expanduser(directory))
+            for directory in value.split(':') if directory]
+
+
+def get_fs_type(directory):
+    """
+    Return type of the file system directory resides on, or None if it
+    cannot be determined.
+    """
+    directory = os.path.realpath(directory)
+    fs_type = None
+    mount_point = ''
+    try:
+        with open('/proc/mounts') as fobj:
+            for line in fobj:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount = fields[1].replace('\\040', ' ')
+                if (os.path.commonpath([directory, mount]) == mount and
+                        len(mount) >= len(mount_point)):
+                    mount_point, fs_type = mount, fields[2]
+    except OSError:
+        return None
+    return fs_type
+
+
+def get_available_memory():
+    """Return available memory in bytes, or None if it cannot be read"""
+    try:
+        with open('/proc/meminfo') as fobj:
+            for line in fobj:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def get_free_space(directory):
+    """
+    Return free space in bytes for provided directory. For RAM backed file
+    systems it will be also limited by available memory.
+    """
+    free = shutil.disk_usage(directory).free
+    if get_fs_type(directory) in RAM_FS:
+        memory = get_available_memory()
+        if memory is not None:
+            free = min(free, memory)
+    return free
+
+
+def choose(candidates, size):
+    """
+    Return first of the candidate directories, which have enough free space
+    for provided size in bytes, or None. If size is None, first existing
+    directory is returned.
+    """
+    for directory in candidates:
+        if not os.path.isdir(directory):
+            logging.debug("Directory `%s' doesn't exists, skipping.",
+                          directory)
+            continue
+
+        if size is None:
+            return directory
+
+        try:
+            free = get_free_space(directory)
+        except OSError as exc:
+            logging.debug("Cannot check free space in `%s': %s.", directory,
+                          exc)
+            continue
+
+        if free >= size * (1 + OVERHEAD):
+            logging.debug("Using `%s' for temporary directory, %d MiB free, "
+                          "%d MiB needed.", directory, free // 2**20,
+                          size // 2**20)
+            return directory
+
+        logging.info("Not enough space in `%s': %d MiB free, %d MiB needed.",
+                     directory, free // 2**20, size // 2**20)
+    return None
+
+
+def make_temp_dir(options, size):
+    """
+    Create temporary directory in the first configured location which can
+    hold provided size in bytes. Return its path or None.
+    """
+    candidates = get_candidates(options)
+    directory = choose(candidates, size)
+    if directory is None:
+        if size is None:
+            logging.error("None of the temporary directories exists: %s.",
+                          ", ".join(candidates))
+        else:
+            logging.error("Not enough free space for extracting the game "
+                          "(%d MiB needed) in any of: %s.", size // 2**20,
+                          ", ".join(candidates))
+        return None
+    return tempfile.mkdtemp(dir=directory)
@@ -2,13 +2,16 @@
 Misc utilities
 """
 import configparser
+import contextlib
+import fcntl
+import json
 import logging
 import os
 import pathlib
 import shutil
-import subprocess
+import tempfile
 
-from fs_uae_wrapper import file_archive, message
+from fs_uae_wrapper import file_archive, materialize, message, process
 
 
 class CmdOption(dict):
@@ -24,11 +27,15 @@ class CmdOption(dict):
         if '=' in option:
             key, val = option.split('=', 1)
             key = key[2:].strip()
-            self[key] = val.strip()
+            val = val.strip()
         else:
             key = option[2:].strip()
             # parameters are always as options - parse them when need it later
-            self[key] = '1'
+            val = '1'
+        if key.startswith('wrapper-'):
+            # allow --wrapper-foo-bar spelling for wrapper options
+            key = key.replace('-', '_')
+        self[key] = val
 
     def list(self):
         """Return list of options as it was passed through the commandline"""
@@ -54,15 +61,20 @@ def get_config_options(conf):
             for key, val in parser.items(section)}
 
 
-def operate_archive(arch_name, operation, text, params):
+def operate_archive(arch_name, operation, text, params, threads=None,
+                    cwd=None, digests=None):
     """
-    Create archive from contents of current directory
+    Create or extract archive in cwd directory (current directory by default).
+    If digest.Digests object is provided, it will be filled with digest of
+    the archive, and, by in-process archivers, with digests of the files
+    created or extracted.
     """
 
-    archiver = file_archive.get_archiver(arch_name)
+    archiver = file_archive.get_archiver(arch_name, threads)
 
     if archiver is None:
         return False
+    archiver.digests = digests
 
     msg = message.Message(text)
     if text:
@@ -71,55 +83,165 @@ def operate_archive(arch_name, operation, text, params):
     res = False
 
     if operation == 'extract':
-        res = archiver.extract(arch_name)
+        res = archiver.extract(arch_name, params, cwd)
 
     if operation == 'create':
-        res = archiver.create(arch_name, params)
+        res = archiver.create(arch_name, params, cwd)
 
     msg.close()
 
     return res
 
 
-def create_archive(arch_name, title='', params=None):
+def create_archive(arch_name, title='', params=None, threads=None,
+                   cwd=None, digests=None):
     """
-    Create archive from contents of current directory
+    Create archive from contents of cwd directory (current directory by
+    default). Digests are collected into digests object, if provided.
     """
     msg = ''
     if title:
         msg = f"Creating archive for `{title}'. Please be patient"
-    return operate_archive(arch_name, 'create', msg, params)
+    return operate_archive(arch_name, 'create', msg, params, threads, cwd,
+                           digests)
 
 
-def extract_archive(arch_name, title='', params=None):
+def extract_archive(arch_name, title='', params=None, threads=None,
+                    cwd=None, digests=None):
     """
-    Extract provided archive to current directory
+    Extract provided archive to cwd directory (current directory by
+    default). If params are provided, only listed files will be extracted.
+    Digests are collected into digests object, if provided.
     """
     msg = ''
     if title:
         msg = f"Extracting files for `{title}'. Please be patient"
-    return operate_archive(arch_name, 'extract', msg, params)
+    return operate_archive(arch_name, 'extract', msg, params, threads, cwd,
+                           digests)
+
+
+def update_archive(arch_name, files, deleted, title='', threads=None,
+                   cwd=None):
+    """
+    Update existing archive - remove deleted files, and add files from cwd
+    directory (current directory by default). Files which should be
+    replaced have to be present on both lists, since some of the archivers
+    (like tar) can only append files. Update is applied on a copy of the
+    archive, which replaces the original only when it's complete, so that
+    interrupted update doesn't damage the archive. Return False if archive
+    cannot be updated.
+    """
+    archiver = file_archive.get_archiver(arch_name, threads, update=True)
+    if archiver is None:
+        return False
+
+    arch_name = os.path.abspath(arch_name)
+    # copy keeps the original name as a suffix, since archivers recognize
+    # format by the extension
+    fd, copy = tempfile.mkstemp(dir=os.path.dirname(arch_name),
+                                prefix='.tmp', suffix='-' +
+                                os.path.basename(arch_name))
+    os.close(fd)
+    try:
+        materialize.Materializer().copy_file(arch_name, copy)
+    except OSError as exc:
+        logging.error("Unable to copy archive `%s': %s.", arch_name, exc)
+        os.unlink(copy)
+        return False
+
+    msg = message.Message(f"Updating archive for `{title}'. Please be "
+                          "patient")
+    if title:
+        msg.show()
+
+    res = archiver.update(copy, files, deleted, cwd)
+
+    msg.close()
+    if res:
+        os.replace(copy, arch_name)
+    else:
+        os.unlink(copy)
+    return res
 
 
-def run_command(cmd):
+def list_archive(arch_name):
     """
-    Run provided command. Return true if command execution returns zero exit
-    code, false otherwise. If cmd is not a list, there would be an attempt to
-    split it up for subprocess call method. May throw exception if cmd is not
-    a list neither a string.
+    Return list of (name, size) tuples for files in provided archive, or
+    None if archive cannot be listed.
+    """
+    archiver = file_archive.get_archiver(arch_name)
+    if archiver is None:
+        return None
+    return archiver.list(arch_name)
+
+
+def read_archive_file(arch_name, fname):
+    """Return contents of the file from provided archive, or None"""
+    archiver = file_archive.get_archiver(arch_name)
+    if archiver is None:
+        return None
+    return archiver.read(arch_name, fname)
+
+
+def get_unpacked_size(arch_name):
+    """
+    Return size in bytes of extracted archive contents, or None if it cannot
+    be determined. Compressed tar archives are not listed, since it means
+    decompressing them whole, size recorded by the compressor (if any) is
+    used instead.
+    """
+    if file_archive.get_format(arch_name) in file_archive.STREAM_FORMATS:
+        return file_archive.get_stream_size(arch_name)
+
+    files = list_archive(arch_name)
+    if files is None:
+        return None
+    return sum(size for _, size in files)
+
+
+def run_command(cmd, cwd=None):
+    """
+    Run provided command in cwd directory (current directory by default).
+    Return true if command execution returns zero exit code, false
+    otherwise. If cmd is not a list, there would be an attempt to split it up
+    for subprocess call method. May throw exception if cmd is not a list
+    neither a string.
     """
 
     if not isinstance(cmd, list):
         cmd = cmd.split()
 
     logging.debug("Executing `%s'.", " ".join(cmd))
-    code = subprocess.call(cmd)
+    code = process.call(cmd, cwd=cwd)
     if code != 0:
         logging.error('Command `%s` returned non 0 exit code.', cmd[0])
         return False
     return True
 
 
+def get_threads(value):
+    """
+    Return number of threads archivers can use. By default it's a number of
+    available CPUs, which can be lowered by provided value. Values lower than
+    1 means no limit.
+    """
+    cpus = os.cpu_count() or 1
+    if not value:
+        return cpus
+
+    try:
+        value = int(value)
+    except ValueError:
+        logging.warning("Wrong value for `wrapper_threads': %s, using all "
+                        "%d available CPUs.", value, cpus)
+        return cpus
+
+    if value < 1:
+        return cpus
+
+    return min(value, cpus)
+
+
 def merge_all_options(configuration, commandline):
     """
     Merge dictionaries with wrapper options into one. Commandline options
@@ -130,7 +252,7 @@ def merge_all_options(configuration, commandline):
     return options
 
 
-def interpolate_variables(string, config_path, base=None):
+def interpolate_variables(string, config_path, base=None, inputs=None):
     """
     Interpolate variables used in fs-uae configuration files, like:
         - $CONFIG
@@ -139,6 +261,8 @@ def interpolate_variables(string, config_path, base=None):
         - $APP
         - $DOCUMENTS
         - $BASE
+    Interpolated path is returned only if it exists, so it is appended to
+    the inputs list, if provided.
     """
 
     _string = string
@@ -165,12 +289,14 @@ def interpolate_variables(string, config_path, base=None):
         if '$BASE' in string:
             string = string.replace('$BASE', base)
 
+    if inputs is not None:
+        inputs.append(string)
     if os.path.exists(string):
         return string
     return _string
 
 
-def get_config(conf_file):
+def get_config(conf_file, inputs=None):
     """
     Try to find configuration files and collect data from it.
     Will search for paths described in https://fs-uae.net/paths
@@ -181,7 +307,15 @@ def get_config(conf_file):
     - ~/.config/fs-uae/fs-uae.conf
     - ./fs-uae.conf
     - ./Config.fs-uae
+
+    Paths of all the files which were looked for are appended to the inputs
+    list, if provided.
     """
+    inputs = [] if inputs is None else inputs
+    inputs.append(conf_file)
+    # provided configuration is read only once, and applied on top of other
+    # configuration files
+    conf = get_config_options(conf_file) or {}
 
     xdg_conf = os.getenv('XDG_CONFIG_HOME', os.path.expanduser('~/.config'))
     user = os.path.expanduser('~/')
@@ -194,26 +328,26 @@ def get_config(conf_file):
               os.path.join(user, 'FS-UAE')))
 
     for path, conf_dir in paths:
+        inputs.append(path)
         if os.path.exists(path):
             config = get_config_options(path)
             if config is None:
                 continue
-            conf = get_config_options(conf_file) or {}
             config.update(conf)
             break
     else:
         conf_dir = None
-        config = get_config_options(conf_file) or {}
+        config = dict(conf)
 
     if 'base_dir' in config:
         base_dir = interpolate_variables(config['base_dir'], conf_file)
         host = os.path.join(base_dir, 'Configurations/Host.fs-uae')
+        inputs.append(host)
 
         if os.path.exists(host):
             host_conf = get_config_options(host) or {}
             config.update(host_conf)
             # overwrite host options again via provided custom/relative conf
-            conf = get_config_options(conf_file) or {}
             config.update(conf)
     elif conf_dir:
         config['_base_dir'] = conf_dir
@@ -221,6 +355,47 @@ def get_config(conf_file):
     return config
 
 
+def read_json(fname):
+    """Return data from json file or None if file is missing or broken"""
+    try:
+        with open(fname) as fobj:
+            return json.load(fobj)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(fname, data):
+    """Atomically write data as json file"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fname) or '.',
+                               prefix=os.path.basename(fname))
+    with os.fdopen(fd, 'w') as fobj:
+        json.dump(data, fobj)
+    os.replace(tmp, fname)
+
+
+@contextlib.contextmanager
+def lock_file(fname, shared=False, blocking=True):
+    """
+    Context manager for holding advisory lock on provided file name. Lock file
+    will be created if it doesn't exists. Yields True if lock was acquired,
+    False otherwise (which may happen only for non blocking mode).
+    """
+    operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    if not blocking:
+        operation |= fcntl.LOCK_NB
+
+    with open(fname, 'a') as fobj:
+        try:
+            fcntl.flock(fobj, operation)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fobj, fcntl.LOCK_UN)
+
+
 def get_arch_ext(archiver_name):
     """Return extension for the archiver"""
     return file_archive.Archivers.get_extension_by_name(archiver_name)
@@ -3,10 +3,15 @@ Run fs-uae with WHDLoad games
 
 It will use compressed base image and compressed directories.
 """
+import contextlib
 import logging
 import os
 
-from fs_uae_wrapper import base, utils
+from fs_uae_wrapper import base, cache, timing, utils
+
+# directories from the base image, which are assigned in startup-sequence
+# generated for shared base image
+SYSTEM_DIRS = ('c', 'l', 'libs', 'devs', 'fonts')
 
 
 class Wrapper(base.ArchiveBase):
@@ -17,6 +22,14 @@ class Wrapper(base.ArchiveBase):
     def __init__(self, conf_file, fsuae_options, configuration):
         super(Wrapper, self).__init__(conf_file, fsuae_options, configuration)
         self.archive_type = None
+        self.base_tree = None
+        self.slave = None
+        self._base_stack = contextlib.ExitStack()
+
+    def clean(self):
+        """Release shared base image and remove temporary directory"""
+        self._base_stack.close()
+        super(Wrapper, self).clean()
 
     def run(self):
         """
@@ -30,11 +43,13 @@ class Wrapper(base.ArchiveBase):
         if not super().run():
             return False
 
-        if not self._extract():
-            return False
+        with timing.span('extract'):
+            if not self._extract():
+                return False
 
-        if not self._copy_conf():
-            return False
+        with timing.span('copy_conf'):
+            if not self._copy_conf():
+                return False
 
         return self._run_emulator()
 
@@ -52,38 +67,250 @@ class Wrapper(base.ArchiveBase):
             return False
         return True
 
+    def _is_shared_base(self):
+        """Return True if base image is shared between sessions"""
+        return self.all_options.get('wrapper_whdload_shared_base',
+                                    '0') == '1'
+
+    def _get_archives(self):
+        archives = super()._get_archives()
+        if self._is_shared_base():
+            return archives
+        base_image = self.all_options['wrapper_whdload_base']
+        if base_image.startswith('$CONFIG'):
+            base_image = utils.interpolate_variables(base_image,
+                                                     self.conf_file)
+        archives.insert(0, os.path.abspath(os.path.expanduser(base_image)))
+        return archives
+
     def _extract(self):
-        """Extract base image and then WHDLoad archive"""
+        """
+        Extract base image and WHDLoad archive, and create startup script for
+        the slave found in the archive. Both are extracted into temporary
+        directory, so archive is extracted after base image, and its files
+        replace those from base image. Shared base image is attached
+        concurrently with extracting the archive.
+        """
         base_image = self.fsuae_options['wrapper_whdload_base']
         if not os.path.exists(base_image):
             logging.error("Base image `%s` does't exists in provided "
                           "location.", base_image)
             return False
 
-        curdir = os.path.abspath('.')
-        os.chdir(self.dir)
-        result = utils.extract_archive(base_image)
-        os.chdir(curdir)
-        if not result:
+        archive_requires = () if self._is_shared_base() else ('base',)
+        return self._run_stages({
+            'listing': (self._list_slave, ()),
+            'base': (self._extract_base, ()),
+            'archive': (super()._extract, archive_requires),
+            'slave': (self._install_slave, ('listing', 'base')),
+            'find_slave': (self._find_extracted_slave, ('slave', 'archive'))})
+
+    def _list_slave(self):
+        """
+        Find the slave in the archive listing, so that there is no need for
+        walking through extracted files
+        """
+        self.slave = self._get_slave()
+        return True
+
+    def _extract_base(self):
+        """Extract base image, or attach it, if it is shared"""
+        base_image = self.fsuae_options['wrapper_whdload_base']
+        if self._is_shared_base():
+            return self._attach_base(base_image)
+        return self._extract_archive(base_image)
+
+    def _install_slave(self):
+        """
+        Create S:whdload-startup script for the slave found in the archive
+        listing, which doesn't need to wait for the archive extraction. If
+        archive cannot be listed, slave is searched in extracted files later.
+        """
+        if self.slave is None:
+            return True
+        return self._write_startup(self.slave)
+
+    def _find_extracted_slave(self):
+        """
+        Search extracted files for the slave and create S:whdload-startup
+        script for it, if it wasn't found in the archive listing.
+        """
+        if self.slave is not None:
+            return True
+        if self._is_shared_base():
+            return self._write_startup(self._search_slave(self._walk()))
+        return self._find_slave()
+
+    def _write_startup(self, slave):
+        """Create S:whdload-startup script for provided slave"""
+        if not slave['slave']:
+            logging.error("Cannot find .slave file in archive.")
             return False
 
-        if not super()._extract():
+        if not slave['icon']:
+            logging.error("Cannot find .info file corresponding to %s in "
+                          "archive.", os.path.basename(slave['slave']))
             return False
 
-        return self._find_slave()
+        slave_path = os.path.dirname(slave['slave']) or '.'
+        base_dir = self.dir
+        if self._is_shared_base():
+            # game is placed on the second drive, and has its own S dir
+            slave_path = 'DH1:' + os.path.dirname(slave['slave'])
+            base_dir = self.base_tree
+            os.makedirs(os.path.join(self.dir, 'S'), exist_ok=True)
+
+        s_path = self._get_path('s', self.dir)
+        if s_path is None:
+            logging.error("Cannot find S directory in base image.")
+            return False
+
+        contents = self._get_startup(slave_path,
+                                     os.path.basename(slave['slave']),
+                                     os.path.basename(slave['icon']),
+                                     self._get_path('c/kgiconload', base_dir))
+        fname = os.path.join(self.dir, s_path, 'whdload-startup')
+        with open(fname, "w") as fobj:
+            fobj.write(contents)
+        return True
+
+    def _attach_base(self, base_image):
+        """
+        Extract base image into the cache (if needed), and attach it as the
+        read only first drive. Temporary directory with the game becomes the
+        second, bootable drive, with the startup-sequence which assigns
+        system directories to the base image, and executes its
+        startup-sequence.
+        """
+        arch_cache = cache.get_cache(dict(self.all_options, wrapper_cache='1'))
+        threads = utils.get_threads(self.all_options.get('wrapper_threads'))
+        tree = self._base_stack.enter_context(arch_cache.fetch(base_image,
+                                                               '', threads))
+        if tree is None:
+            return False
+
+        if not self._get_path('c/assign', tree):
+            logging.error("Base image `%s' lacks of C/Assign command, which "
+                          "is needed for using shared base image.",
+                          base_image)
+            return False
+
+        self.base_tree = tree
+        contents = ''
+        for name in sorted(os.listdir(tree)):
+            if name.lower() in SYSTEM_DIRS:
+                contents += f"DH0:C/Assign >NIL: {name}: DH0:{name}\n"
+            elif name.lower() == 's':
+                contents += (f"DH0:C/Assign >NIL: S: DH0:{name}\n"
+                             f"DH0:C/Assign >NIL: S: DH1:S ADD\n")
+        contents += ("DH0:C/Assign >NIL: SYS: DH0:\n"
+                     "Execute DH0:S/startup-sequence\n")
+
+        os.makedirs(os.path.join(self.dir, 'S'), exist_ok=True)
+        with open(os.path.join(self.dir, 'S', 'startup-sequence'),
+                  'w') as fobj:
+            fobj.write(contents)
+
+        self.fsuae_options.update({'hard_drive_0': tree,
+                                   'hard_drive_0_read_only': '1',
+                                   'hard_drive_0_priority': '0',
+                                   'hard_drive_1': self.dir,
+                                   'hard_drive_1_priority': '1'})
+        return True
+
+    def _walk(self):
+        """Return list of (name, size) tuples for files in temp directory"""
+        files = []
+        for root, _, fnames in os.walk(self.dir):
+            for fname in fnames:
+                files.append((os.path.relpath(os.path.join(root, fname),
+                                              self.dir), 0))
+        return files
+
+    def _search_slave(self, files):
+        """
+        Return dict with paths to the first found slave and its icon in
+        provided list of (name, size) tuples.
+        """
+        slave = {'slave': None, 'icon': None}
+        for name, _ in files:
+            if name.lower().endswith('.slave'):
+                slave['slave'] = os.path.normpath(name)
+                break
+
+        if slave['slave']:
+            icon = os.path.splitext(slave['slave'])[0].lower() + '.info'
+            for name, _ in files:
+                if os.path.normpath(name).lower() == icon:
+                    slave['icon'] = os.path.normpath(name)
+                    break
+        return slave
+
+    def _get_slave(self):
+        """
+        Return dict with paths to the slave and its icon found in the game
+        archive listing, or None if archive cannot be listed. Result is
+        stored next to the archive, and reused as long as archive is not
+        changed.
+        """
+        if not self.arch_filepath:
+            return None
+
+        cache_fname = self.arch_filepath + '.whdload.json'
+        try:
+            stat = os.stat(self.arch_filepath)
+        except OSError:
+            return None
+
+        slave = utils.read_json(cache_fname)
+        if (slave and slave.get('size') == stat.st_size and
+                slave.get('mtime') == stat.st_mtime_ns):
+            return slave
+
+        files = utils.list_archive(self.arch_filepath)
+        if files is None:
+            return None
+
+        slave = self._search_slave(files)
+        slave.update({'size': stat.st_size, 'mtime': stat.st_mtime_ns})
+
+        try:
+            utils.write_json(cache_fname, slave)
+        except OSError as exc:
+            logging.debug("Cannot store slave information in `%s': %s.",
+                          cache_fname, exc)
+        return slave
+
+    def _get_path(self, path, root=None):
+        """
+        Return path relative to the root (temporary directory by default),
+        for provided case insensitive path, or None if there is no such file.
+        """
+        root = root or self.dir
+        result = ''
+        for part in path.split('/'):
+            try:
+                names = os.listdir(os.path.join(root, result))
+            except OSError:
+                return None
+            for name in names:
+                if name.lower() == part:
+                    result = os.path.join(result, name)
+                    break
+            else:
+                return None
+        return result
 
     def _find_slave(self):
         """Find Slave file and create apropriate entry in S:whdload-startup"""
-        curdir = os.path.abspath('.')
-        os.chdir(self.dir)
-
         # find slave name
         slave_fname = None
         slave_path = None
         case_insensitvie_map = {}
 
         # build case insensitive map of paths and find the slave file
-        for root, dirnames, fnames in os.walk('.'):
+        for root, dirnames, fnames in os.walk(self.dir):
+            root = os.path.relpath(root, self.dir)
             for dirname in dirnames:
                 full_path = os.path.normpath(os.path.join(root, dirname))
                 case_insensitvie_map[full_path.lower()] = full_path
@@ -100,7 +327,7 @@ class Wrapper(base.ArchiveBase):
 
         # find corresponfing info (an icon) fname
         icon_fname = None
-        for fname in os.listdir(slave_path):
+        for fname in os.listdir(os.path.join(self.dir, slave_path)):
             if (fname.lower().endswith('.info') and
                os.path.splitext(slave_fname)[0].lower() ==
                os.path.splitext(fname)[0].lower()):
@@ -111,6 +338,18 @@ class Wrapper(base.ArchiveBase):
                           "archive.", slave_fname)
             return False
 
+        contents = self._get_startup(slave_path, slave_fname, icon_fname,
+                                     case_insensitvie_map.get('c/kgiconload'))
+
+        fname = os.path.join(self.dir, case_insensitvie_map.get('s'),
+                             'whdload-startup')
+        with open(fname, "w") as fobj:
+            fobj.write(contents)
+
+        return True
+
+    def _get_startup(self, slave_path, slave_fname, icon_fname, kgiconload):
+        """Return contents for the S:whdload-startup script"""
         # find proper way to handle slave
         # 1. check if there are user provided params
         contents = f"cd {slave_path}\n"
@@ -121,16 +360,10 @@ class Wrapper(base.ArchiveBase):
                         f"Slave={slave_fname}\n")
         else:
             # no params, find if kgiconload is available
-            if case_insensitvie_map.get('c/kgiconload'):
+            if kgiconload:
                 contents = f"{contents}C:kgiconload {icon_fname}\n"
             else:
                 # if not, just add common defaults
                 contents = (f"{contents}C:whdload Preload "
                             f"Slave={slave_fname}\n")
-
-        fname = os.path.join(case_insensitvie_map.get('s'), 'whdload-startup')
-        with open(fname, "w") as fobj:
-            fobj.write(contents)
-
-        os.chdir(curdir)
-        return True
+        return contents
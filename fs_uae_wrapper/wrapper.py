@@ -2,12 +2,15 @@
 Wrapper for FS-UAE to perform some actions before and or after running the
 emulator, if appropriate option is enabled.
 """
+import functools
 import importlib
 import logging
 import os
 import sys
+import time
 
-from fs_uae_wrapper import WRAPPER_KEY, utils
+from fs_uae_wrapper import WRAPPER_KEY, cachectl, history, index, metrics
+from fs_uae_wrapper import plan, predict, prefetch, process, timing, utils
 
 
 def setup_logger(options):
@@ -59,10 +62,41 @@ def parse_args():
     return fs_conf, options
 
 
+def write_report(fname, config_file, wrapper_module, result):
+    """
+    Write machine readable report of the run, with durations of the phases
+    and resource usage of the child processes.
+    """
+    report = {'config': os.path.abspath(config_file),
+              'wrapper': wrapper_module,
+              'result': bool(result),
+              'time': time.time(),
+              'phases': [{'name': event['name'],
+                          'start': event['ts'] / 1e6,
+                          'duration': event['dur'] / 1e6}
+                         for event in timing.TRACER.events],
+              'processes': process.USAGE}
+    try:
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        utils.write_json(fname, report)
+    except OSError as exc:
+        logging.error("Unable to write report `%s': %s.", fname, exc)
+        return False
+    logging.info("Report written to `%s'.", fname)
+    return True
+
+
 def usage():
     """Print help"""
-    sys.stdout.write("Usage: %s [conf-file] [-v] [-q] [fs-uae-option...]\n\n"
-                     % sys.argv[0])
+    sys.stdout.write("Usage: %s [conf-file] [-v] [-q] [fs-uae-option...]\n"
+                     "       %s --wrapper-stats [--wrapper-metrics=db-file]\n"
+                     "       %s --wrapper-index=dir "
+                     "[--wrapper-index-db=db-file]\n"
+                     "       %s --wrapper-prefetch=dir|list-file "
+                     "[--wrapper-cache-dir=dir]\n"
+                     "       %s --wrapper-cache=stats|pin|unpin|prune|verify "
+                     "[conf-file|archive]\n\n"
+                     % ((sys.argv[0],) * 5))
     sys.stdout.write("Config file is not required, if `Config.fs-uae' "
                      "exists in the current\ndirectory, although it might "
                      "depend on selected wrapper type. As for the\nfs-uae "
@@ -83,12 +117,44 @@ def run():
         usage()
         sys.exit(0)
 
+    if 'wrapper_stats' in fsuae_options:
+        db_path = metrics.get_db_path(fsuae_options.get('wrapper_metrics'))
+        sys.exit(0 if metrics.report(db_path) else 1)
+
+    if 'wrapper_index' in fsuae_options:
+        directory = fsuae_options['wrapper_index']
+        if directory == '1':
+            # directory might be passed as separate argument
+            directory = config_file if config_file and os.path.isdir(
+                config_file) else '.'
+        db_path = index.get_db_path(fsuae_options.get('wrapper_index_db'))
+        sys.exit(0 if index.update(db_path, directory) else 1)
+
+    if 'wrapper_prefetch' in fsuae_options:
+        source = fsuae_options['wrapper_prefetch']
+        if source == '1':
+            # directory or list might be passed as separate argument
+            source = config_file or '.'
+        sys.exit(0 if prefetch.run(source, fsuae_options) else 1)
+
+    if fsuae_options.get('wrapper_cache') in cachectl.COMMANDS:
+        sys.exit(0 if cachectl.run(fsuae_options['wrapper_cache'],
+                                   config_file, fsuae_options) else 1)
+
     if not config_file:
         logging.error('Error: Configuration file not found. See --help'
                       ' for usage')
         sys.exit(1)
 
-    configuration = utils.get_config_options(config_file)
+    if fsuae_options.get('wrapper_profile_python', '0') == '1':
+        timing.TRACER.start_profile()
+
+    with timing.span('load_config'):
+        launch_plan = plan.load(config_file, fsuae_options)
+        configuration = launch_plan.get(
+            'configuration',
+            functools.partial(utils.get_config_options, config_file),
+            [config_file])
 
     if configuration is None:
         logging.error('Error: Configuration file have syntax issues')
@@ -109,12 +175,42 @@ def run():
                           "exists.", wrapper_module)
             sys.exit(3)
 
+    options = utils.merge_all_options(configuration, fsuae_options)
+    if options.get('wrapper_profile_python', '0') == '1':
+        # option might be set only in configuration file
+        timing.TRACER.start_profile()
+
     runner = wrapper.Wrapper(config_file, fsuae_options, configuration)
+    runner.plan = launch_plan
+
+    if options.get('wrapper_history', '1') != '0':
+        history.record(config_file)
+    # command line options are passed before wrapper module modifies them
+    predict.spawn(config_file, fsuae_options, options)
 
+    exit_code = False
     try:
-        exit_code = runner.run()
+        with timing.span('run', wrapper=wrapper_module or 'plain'):
+            exit_code = runner.run()
     finally:
-        runner.clean()
+        with timing.span('clean'):
+            runner.clean()
+        launch_plan.save()
+        process.log_usage()
+        if options.get('wrapper_profile'):
+            timing.TRACER.save(timing.get_output_path(
+                options['wrapper_profile'], 'trace'))
+        if options.get('wrapper_report'):
+            write_report(timing.get_output_path(options['wrapper_report'],
+                                                'report'),
+                         config_file, wrapper_module or 'plain', exit_code)
+        if options.get('wrapper_metrics', '0') != '0':
+            metrics.record(metrics.get_db_path(options['wrapper_metrics']),
+                           metrics.get_record(
+                               config_file, wrapper_module or 'plain',
+                               getattr(runner, 'arch_filepath', None),
+                               exit_code, timing.TRACER.events,
+                               timing.TRACER.now()))
 
     if not exit_code:
         sys.exit(4)
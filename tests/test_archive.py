@@ -3,17 +3,21 @@ import shutil
 from tempfile import mkdtemp
 from unittest import TestCase, mock
 
-from fs_uae_wrapper import archive, utils
+from fs_uae_wrapper import archive, manifest, utils
 
 
 class TestArchive(TestCase):
 
     def setUp(self):
         self.dirname = mkdtemp()
+        self._env = mock.patch.dict(os.environ,
+                                    {'XDG_STATE_HOME': self.dirname})
+        self._env.start()
         self.curdir = os.path.abspath(os.curdir)
         os.chdir(self.dirname)
 
     def tearDown(self):
+        self._env.stop()
         os.chdir(self.curdir)
         try:
             shutil.rmtree(self.dirname)
@@ -90,13 +94,37 @@ class TestArchive(TestCase):
         make_arch.return_value = True
         self.assertTrue(arch.run())
 
+    @mock.patch('fs_uae_wrapper.base.ArchiveBase._copy_conf')
+    @mock.patch('fs_uae_wrapper.base.ArchiveBase._load_save')
+    @mock.patch('fs_uae_wrapper.base.ArchiveBase._extract')
+    def test_prepare(self, extract, load_save, copy_conf):
+        order = []
+        extract.side_effect = lambda: order.append('extract') or True
+        load_save.side_effect = lambda: order.append('load_save') or True
+        copy_conf.side_effect = lambda: order.append('copy_conf') or True
+
+        arch = archive.Wrapper('Config.fs-uae', utils.CmdOption(), {})
+        arch.dir = self.dirname
+        arch.all_options = {'wrapper_concurrent_stages': '0'}
+        self.assertEqual(list(arch._get_stages()),
+                         ['extract', 'load_save', 'copy_conf'])
+        self.assertTrue(arch._prepare())
+        self.assertEqual(order, ['extract', 'load_save', 'copy_conf'])
+        self.assertIsNone(arch.manifest)
+
+        # manifest is taken before save state is extracted
+        order.clear()
+        arch.all_options['wrapper_persist_data'] = '1'
+        arch.all_options['wrapper_concurrent_stages'] = '1'
+        self.assertTrue(arch._prepare())
+        self.assertEqual(order, ['extract', 'load_save', 'copy_conf'])
+        self.assertEqual(arch.manifest, {})
+
     @mock.patch('os.rename')
-    @mock.patch('os.unlink')
-    @mock.patch('shutil.rmtree')
     @mock.patch('fs_uae_wrapper.utils.create_archive')
     @mock.patch('fs_uae_wrapper.base.ArchiveBase._get_title')
     @mock.patch('fs_uae_wrapper.base.ArchiveBase._get_saves_dir')
-    def test_make_archive(self, sdir, title, carch, rmt, unlink, rename):
+    def test_make_archive(self, sdir, title, carch, rename):
 
         sdir.return_value = None
         title.return_value = ''
@@ -108,11 +136,144 @@ class TestArchive(TestCase):
         arch.all_options = {}
         self.assertTrue(arch._make_archive())
 
+        # nothing to archive
         arch.all_options['wrapper_persist_data'] = '1'
+        self.assertTrue(arch._make_archive())
+        carch.assert_not_called()
+
+        os.makedirs('data/saves')
+        for fname in ('Config.fs-uae', 'data/file', 'file'):
+            with open(fname, 'w') as fobj:
+                fobj.write('\n')
         self.assertFalse(arch._make_archive())
+        carch.assert_called_once_with(os.path.join(self.dirname, 'foo.tgz'),
+                                      '', ['data', 'file'], threads=mock.ANY,
+                                      cwd=self.dirname, digests=mock.ANY)
 
+        # save state and config are not archived
+        carch.reset_mock()
         carch.return_value = True
+        sdir.return_value = 'data/saves'
+        self.assertTrue(arch._make_archive(3))
+        carch.assert_called_once_with(os.path.join(self.dirname, 'foo.tgz'),
+                                      '', ['data/file', 'file'], threads=3,
+                                      cwd=self.dirname, digests=mock.ANY)
+        self.assertTrue(os.path.exists('data/saves'))
+        self.assertTrue(os.path.exists('Config.fs-uae'))
+
+    @mock.patch('fs_uae_wrapper.base.ArchiveBase._save_save')
+    @mock.patch('fs_uae_wrapper.base.ArchiveBase._get_saves_dir')
+    @mock.patch('os.cpu_count')
+    def test_get_persist_stages(self, cpu_count, sdir, save_save):
+        cpu_count.return_value = 4
+        sdir.return_value = None
+
+        arch = archive.Wrapper('Config.fs-uae', utils.CmdOption(), {})
+        arch.all_options = {'wrapper_persist_data': '1'}
+        graph = arch._get_persist_stages()
+        self.assertEqual(list(graph), ['data'])
+        self.assertEqual(graph['data'][0].args, (4,))
+
+        # one CPU is left for compressing save state
+        sdir.return_value = 'saves'
+        arch.all_options['wrapper_save_state'] = '1'
+        graph = arch._get_persist_stages()
+        self.assertEqual(list(graph), ['save_state', 'data'])
+        self.assertEqual(graph['data'][0].args, (3,))
+
+        arch.all_options['wrapper_concurrent_stages'] = '0'
+        graph = arch._get_persist_stages()
+        self.assertEqual(graph['data'][0].args, (4,))
+
+    @mock.patch('fs_uae_wrapper.utils.update_archive')
+    @mock.patch('fs_uae_wrapper.utils.create_archive')
+    @mock.patch('fs_uae_wrapper.base.ArchiveBase._get_title')
+    @mock.patch('fs_uae_wrapper.base.ArchiveBase._get_saves_dir')
+    def test_make_archive_incremental(self, sdir, title, carch, uarch):
+
+        sdir.side_effect = lambda: ('saves' if os.path.isdir('tmp/saves')
+                                    else None)
+        title.return_value = ''
+        uarch.return_value = True
+
+        def _create_archive(arch_name, title, params, threads, cwd=None,
+                            digests=None):
+            with open(arch_name, 'w') as fobj:
+                fobj.write('\n')
+            digests.archive = 'abcd'
+            return True
+
+        carch.side_effect = _create_archive
+
+        os.mkdir('tmp')
+        os.mkdir('tmp/C')
+        with open('tmp/C/Assign', 'w') as fobj:
+            fobj.write('\n')
+
+        arch = archive.Wrapper('Config.fs-uae', utils.CmdOption(), {})
+        arch.dir = os.path.join(self.dirname, 'tmp')
+        arch.arch_filepath = os.path.join(self.dirname, 'foo.7z')
+        arch.all_options = {'wrapper_persist_data': '1'}
+        arch.manifest = manifest.get_manifest(arch.dir)
+
+        # saves and config are not part of the data
+        os.mkdir('tmp/saves')
+        with open('tmp/Config.fs-uae', 'w') as fobj:
+            fobj.write('\n')
+
         self.assertTrue(arch._make_archive())
+        uarch.assert_not_called()
+        carch.assert_not_called()
+        self.assertEqual(os.path.abspath('.'), self.dirname)
+
+        with open('tmp/Config.fs-uae', 'w') as fobj:
+            fobj.write('\n')
+        with open('tmp/C/Assign', 'w') as fobj:
+            fobj.write('changed\n')
+        with open('tmp/new', 'w') as fobj:
+            fobj.write('\n')
 
-        sdir.return_value = '/some/path'
         self.assertTrue(arch._make_archive())
+        uarch.assert_called_once_with(arch.arch_filepath,
+                                      ['new', 'C/Assign'], ['C/Assign'], '',
+                                      mock.ANY, cwd=arch.dir)
+        carch.assert_not_called()
+
+        # update failed, fall back to recreate whole archive
+        uarch.reset_mock()
+        uarch.return_value = False
+        with open('tmp/Config.fs-uae', 'w') as fobj:
+            fobj.write('\n')
+        self.assertTrue(arch._make_archive())
+        uarch.assert_called_once()
+        carch.assert_called_once_with(os.path.join(arch.dir, 'foo.7z'), '',
+                                      ['C', 'new'], threads=mock.ANY,
+                                      cwd=arch.dir, digests=mock.ANY)
+        self.assertTrue(os.path.exists('tmp/saves'))
+        # digests of the new archive are stored for its final location
+        self.assertEqual(manifest.load_digests(arch.arch_filepath)['digest'],
+                         'abcd')
+        # as well as size of the archived files
+        with mock.patch('fs_uae_wrapper.utils.get_unpacked_size') as size:
+            self.assertEqual(manifest.get_unpacked_size(arch.arch_filepath),
+                             9)
+            size.assert_not_called()
+
+    @mock.patch('fs_uae_wrapper.utils.extract_archive')
+    @mock.patch('fs_uae_wrapper.cache.get_cache')
+    def test_extract_persist_data(self, get_cache, extract):
+        extract.return_value = True
+        arch = archive.Wrapper('Config.fs-uae', utils.CmdOption(), {})
+        arch.arch_filepath = os.path.join(self.dirname, 'foo.tar')
+        arch.dir = self.dirname
+        arch.all_options = {'wrapper_cache': '1',
+                            'wrapper_persist_data': '1'}
+
+        # archive written back after emulation bypasses the cache
+        self.assertTrue(arch._extract_archive(arch.arch_filepath))
+        get_cache.assert_not_called()
+        extract.assert_called_once()
+
+        self.assertFalse(arch._is_persisted('other.tar'))
+        arch.all_options['wrapper_persist_data'] = '0'
+        self.assertFalse(arch._is_persisted(arch.arch_filepath))
@@ -1,10 +1,11 @@
+import errno
 import os
 import shutil
 import sys
 from tempfile import mkdtemp, mkstemp
 from unittest import TestCase, mock
 
-from fs_uae_wrapper import base, utils
+from fs_uae_wrapper import base, plan, utils
 
 
 class TestBase(TestCase):
@@ -13,12 +14,16 @@ class TestBase(TestCase):
         fd, self.fname = mkstemp()
         self.dirname = mkdtemp()
         self.confdir = mkdtemp()
+        self._env = mock.patch.dict(os.environ,
+                                    {'XDG_STATE_HOME': self.dirname})
+        self._env.start()
         os.close(fd)
         self._argv = sys.argv[:]
         sys.argv = ['fs-uae-wrapper']
         self.curdir = os.path.abspath(os.curdir)
 
     def tearDown(self):
+        self._env.stop()
         os.chdir(self.curdir)
         try:
             shutil.rmtree(self.dirname)
@@ -115,6 +120,50 @@ class TestBase(TestCase):
         self.assertDictEqual(bobj.fsuae_options,
                              {'floppies_dir': '../some/path'})
 
+    def test_normalize_options_plan(self):
+        os.chdir(self.confdir)
+        conf = os.path.join(self.confdir, 'Config.fs-uae')
+        with open(conf, 'w') as fobj:
+            fobj.write('[config]\nfmv_rom = bar\n'
+                       'cdroms_dir = $CONFIG/cds\n')
+
+        def _launch():
+            bobj = base.Base(conf, utils.CmdOption(), {})
+            bobj.plan = plan.load(conf, utils.CmdOption())
+            bobj._normalize_options()
+            self.assertTrue(bobj.plan.save())
+            return bobj.fsuae_options
+
+        self.assertDictEqual(_launch(), {'fmv_rom': 'bar',
+                                         'cdroms_dir': '$CONFIG/cds'})
+        self.assertDictEqual(_launch(), {'fmv_rom': 'bar',
+                                         'cdroms_dir': '$CONFIG/cds'})
+
+        # assets created after the first launch invalidate stored plan
+        open('bar', 'w').close()
+        os.mkdir('cds')
+        self.assertDictEqual(_launch(),
+                             {'fmv_rom': os.path.join(self.confdir, 'bar'),
+                              'cdroms_dir': os.path.join(self.confdir,
+                                                         'cds')})
+
+    @mock.patch('fs_uae_wrapper.manifest.get_unpacked_size')
+    @mock.patch('fs_uae_wrapper.cache.Cache.get_size')
+    def test_get_unpacked_size_cached(self, get_size, unpacked_size):
+        unpacked_size.return_value = 100
+        get_size.return_value = None
+        bobj = base.Base('Config.fs-uae', utils.CmdOption(), {})
+        self.assertEqual(bobj._get_unpacked_size(self.fname), 100)
+        get_size.assert_not_called()
+
+        # archive already in the cache is not listed
+        bobj.all_options = {'wrapper_cache_dir': self.dirname}
+        self.assertEqual(bobj._get_unpacked_size(self.fname), 100)
+        get_size.return_value = 50
+        unpacked_size.reset_mock()
+        self.assertEqual(bobj._get_unpacked_size(self.fname), 50)
+        unpacked_size.assert_not_called()
+
     def test_set_assets_paths(self):
 
         bobj = base.Base('Config.fs-uae', utils.CmdOption(), {})
@@ -151,20 +200,100 @@ class TestBase(TestCase):
         bobj.dir = self.dirname
 
         self.assertTrue(bobj._run_emulator())
-        run.assert_called_once_with(['fs-uae'])
+        run.assert_called_once_with(['fs-uae'], cwd=self.dirname)
 
         # Errors from emulator are not fatal to wrappers
         run.reset_mock()
         run.return_value = False
         self.assertTrue(bobj._run_emulator())
-        run.assert_called_once_with(['fs-uae'])
+        run.assert_called_once_with(['fs-uae'], cwd=self.dirname)
 
         # pass the options
         bobj.fsuae_options = utils.CmdOption({'foo': '1'})
         run.reset_mock()
         run.return_value = False
         self.assertTrue(bobj._run_emulator())
-        run.assert_called_once_with(['fs-uae', '--foo'])
+        run.assert_called_once_with(['fs-uae', '--foo'],
+                                    cwd=self.dirname)
+
+    @mock.patch('fs_uae_wrapper.utils.extract_archive')
+    def test_extract_archive(self, utils_extract):
+
+        def _extract(arch_name, title='', params=None, threads=None,
+                     cwd=None, digests=None):
+            with open(os.path.join(cwd, 'file.iso'), 'w') as fobj:
+                fobj.write('\n')
+            return True
+
+        utils_extract.side_effect = _extract
+        os.chdir(self.confdir)
+        with open('arch.7z', 'w') as fobj:
+            fobj.write('\n')
+
+        bobj = base.Base('Config.fs-uae', utils.CmdOption(), {})
+        bobj.dir = self.dirname
+
+        self.assertTrue(bobj._extract_archive('arch.7z', 'title'))
+        utils_extract.assert_called_once_with('arch.7z', 'title',
+                                              params=None, threads=mock.ANY,
+                                              cwd=self.dirname)
+        self.assertTrue(os.path.exists(os.path.join(self.dirname,
+                                                    'file.iso')))
+        self.assertEqual(os.path.abspath('.'), self.confdir)
+
+        # with enabled cache, archive is extracted only once
+        os.unlink(os.path.join(self.dirname, 'file.iso'))
+        utils_extract.reset_mock()
+        bobj.all_options['wrapper_cache_dir'] = os.path.join(self.confdir,
+                                                             'cache')
+        for _ in range(2):
+            self.assertTrue(bobj._extract_archive('arch.7z'))
+            self.assertTrue(os.path.exists(os.path.join(self.dirname,
+                                                        'file.iso')))
+        utils_extract.assert_called_once()
+
+        utils_extract.side_effect = None
+        utils_extract.return_value = False
+        with open('other.7z', 'w') as fobj:
+            fobj.write('other')
+        self.assertFalse(bobj._extract_archive('other.7z'))
+
+    @mock.patch('fs_uae_wrapper.materialize.reflink')
+    @mock.patch('fs_uae_wrapper.utils.extract_archive')
+    def test_extract_archive_shared_cache(self, utils_extract, reflink):
+
+        def _extract(arch_name, title='', params=None, threads=None,
+                     cwd=None, digests=None):
+            for name, mode in (('file.iso', 0o644), ('ro.iso', 0o444)):
+                with open(os.path.join(cwd, name), 'w') as fobj:
+                    fobj.write(name)
+                os.chmod(os.path.join(cwd, name), mode)
+            return True
+
+        utils_extract.side_effect = _extract
+        reflink.side_effect = OSError(errno.EOPNOTSUPP, 'not supported')
+        os.chdir(self.confdir)
+        with open('arch.7z', 'w') as fobj:
+            fobj.write('\n')
+
+        bobj = base.Base('Config.fs-uae', utils.CmdOption(), {})
+        bobj.dir = self.dirname
+        bobj.all_options['wrapper_cache_dir'] = os.path.join(self.confdir,
+                                                             'cache')
+        self.assertTrue(bobj._extract_archive('arch.7z'))
+        ro_file = os.path.join(self.dirname, 'ro.iso')
+        # files of own cache entry are always copied
+        self.assertEqual(os.stat(ro_file).st_nlink, 1)
+
+        # cache shared with other user, who owns the entry files, has read
+        # only files hard linked
+        os.unlink(ro_file)
+        with mock.patch('os.geteuid', return_value=os.getuid() + 1):
+            self.assertTrue(bobj._extract_archive('arch.7z'))
+        self.assertEqual(os.stat(ro_file).st_nlink, 2)
+        self.assertEqual(os.stat(os.path.join(self.dirname,
+                                              'file.iso')).st_nlink, 1)
+        utils_extract.assert_called_once()
 
     @mock.patch('fs_uae_wrapper.base.Base._get_saves_dir')
     @mock.patch('fs_uae_wrapper.utils.create_archive')
@@ -219,13 +348,45 @@ class TestBase(TestCase):
             fobj.write('asd')
 
         self.assertTrue(bobj._load_save())
-        earch.assert_called_once_with(bobj.save_filename)
+        earch.assert_called_once_with(bobj.save_filename,
+                                      cwd=self.dirname)
 
         # failure in searching for archiver are also non fatal
         earch.reset_mock()
         earch.return_value = 1
         self.assertTrue(bobj._save_save())
 
+    @mock.patch('fs_uae_wrapper.persist.spawn')
+    @mock.patch('fs_uae_wrapper.base.Base._save_save')
+    @mock.patch('fs_uae_wrapper.base.Base._get_saves_dir')
+    def test_finish(self, saves_dir, save_save, spawn):
+        bobj = base.Base('Config.fs-uae', utils.CmdOption(), {})
+        bobj.dir = self.dirname
+        bobj.save_filename = 'foo_save.7z'
+        saves_dir.return_value = None
+        save_save.return_value = False
+
+        self.assertTrue(bobj._finish())
+        save_save.assert_not_called()
+
+        saves_dir.return_value = 'fs-uae-save'
+        self.assertFalse(bobj._finish())
+        spawn.assert_not_called()
+
+        bobj.all_options['wrapper_async_persist'] = '1'
+        self.assertFalse(bobj._finish())
+        spawn.assert_not_called()
+
+        bobj.all_options['wrapper_save_state'] = '1'
+        spawn.return_value = False
+        self.assertFalse(bobj._finish())
+        spawn.assert_called_once_with(bobj, ['foo_save.7z'])
+        self.assertEqual(bobj.dir, self.dirname)
+
+        spawn.return_value = True
+        self.assertTrue(bobj._finish())
+        self.assertIsNone(bobj.dir)
+
     def test_get_saves_dir(self):
 
         bobj = base.Base('Config.fs-uae', utils.CmdOption(), {})
@@ -317,6 +478,9 @@ class TestBase(TestCase):
         finally:
             bobj.clean()
 
+        bobj.all_options['wrapper_tmp_dirs'] = '/nonexistent'
+        self.assertFalse(bobj.run())
+
 
 class TestArchiveBase(TestCase):
 
@@ -342,6 +506,39 @@ class TestArchiveBase(TestCase):
         os.unlink(self.fname)
         sys.argv = self._argv[:]
 
+    @mock.patch('fs_uae_wrapper.manifest.get_unpacked_size')
+    def test_get_required_space(self, unpacked_size):
+        os.chdir(self.dirname)
+        open('foo.7z', 'w').close()
+        open('Config_save.7z', 'w').close()
+        unpacked_size.return_value = 100
+
+        bobj = base.ArchiveBase('Config.fs-uae', utils.CmdOption(), {})
+        bobj.all_options = {'wrapper_archive': 'foo.7z',
+                            'wrapper_archiver': '7z'}
+        bobj._set_assets_paths()
+        self.assertEqual(bobj._get_archives(),
+                         [os.path.join(self.dirname, 'foo.7z')])
+
+        # without candidate directories size is not needed, so archives are
+        # not listed in default configuration
+        with mock.patch('fs_uae_wrapper.utils.list_archive') as list_arch:
+            self.assertIsNone(bobj._get_required_space())
+            list_arch.assert_not_called()
+        unpacked_size.assert_not_called()
+
+        bobj.all_options['wrapper_tmp_dirs'] = self.dirname
+        self.assertEqual(bobj._get_required_space(), 100)
+
+        bobj.all_options['wrapper_save_state'] = '1'
+        self.assertEqual(bobj._get_required_space(), 200)
+
+        os.unlink('Config_save.7z')
+        self.assertEqual(bobj._get_required_space(), 100)
+
+        unpacked_size.return_value = None
+        self.assertIsNone(bobj._get_required_space())
+
     def test_set_assets_paths(self):
 
         bobj = base.ArchiveBase('Config.fs-uae', utils.CmdOption(), {})
@@ -361,33 +558,72 @@ class TestArchiveBase(TestCase):
         full_path = os.path.join(self.dirname, 'Config_save.7z')
         self.assertEqual(bobj.save_filename, full_path)
 
+    @mock.patch('os.cpu_count')
     @mock.patch('fs_uae_wrapper.utils.extract_archive')
-    def test_extract(self, utils_extract):
+    def test_extract(self, utils_extract, cpu_count):
 
         bobj = base.ArchiveBase('Config.fs-uae', utils.CmdOption(), {})
         bobj.arch_filepath = self.fname
         bobj.dir = self.dirname
 
         utils_extract.return_value = False
+        cpu_count.return_value = 4
 
         # message for the gui is taken from title in fs-uae conf or, if there
         # is no such entry, use archive name, which is mandatory to provide
         bobj.all_options = {'title': 'foo_game', 'wrapper_gui_msg': '1'}
         self.assertFalse(bobj._extract())
-        utils_extract.assert_called_once_with(self.fname, 'foo_game')
+        utils_extract.assert_called_once_with(self.fname, 'foo_game',
+                                              params=None, threads=4,
+                                              cwd=self.dirname)
 
         utils_extract.reset_mock()
         bobj.all_options = {'wrapper_archive': 'arch.tar',
                             'wrapper_gui_msg': '1'}
         self.assertFalse(bobj._extract())
-        utils_extract.assert_called_once_with(self.fname, 'arch.tar')
+        utils_extract.assert_called_once_with(self.fname, 'arch.tar',
+                                              params=None, threads=4,
+                                              cwd=self.dirname)
 
         # lets pretend, the extracting has failed
         utils_extract.reset_mock()
-        bobj.all_options = {'wrapper_gui_msg': '0'}
+        bobj.all_options = {'wrapper_gui_msg': '0', 'wrapper_threads': '2'}
         utils_extract.return_value = False
         self.assertFalse(bobj._extract())
-        utils_extract.assert_called_once_with(self.fname, '')
+        utils_extract.assert_called_once_with(self.fname, '', params=None,
+                                              threads=2,
+                                              cwd=self.dirname)
+
+    @mock.patch('fs_uae_wrapper.manifest.get_unpacked_size')
+    @mock.patch('fs_uae_wrapper.members.get_members')
+    @mock.patch('fs_uae_wrapper.utils.extract_archive')
+    def test_extract_members(self, utils_extract, get_members,
+                             unpacked_size):
+        bobj = base.ArchiveBase('Config.fs-uae', utils.CmdOption(), {})
+        bobj.arch_filepath = self.fname
+        bobj.dir = self.dirname
+        bobj.all_options = {'wrapper_threads': '1'}
+        utils_extract.return_value = True
+        unpacked_size.return_value = 100
+        get_members.return_value = [('b', 5), ('a', 10)]
+
+        self.assertEqual(bobj._get_unpacked_size(self.fname), 15)
+        self.assertEqual(bobj._get_unpacked_size('other.7z'), 100)
+        self.assertTrue(bobj._extract())
+        utils_extract.assert_called_once_with(self.fname, '',
+                                              params=['a', 'b'], threads=1,
+                                              cwd=self.dirname)
+        # selection is done only once
+        get_members.assert_called_once()
+
+        utils_extract.reset_mock()
+        bobj.members = {}
+        get_members.return_value = None
+        self.assertEqual(bobj._get_unpacked_size(self.fname), 100)
+        self.assertTrue(bobj._extract())
+        utils_extract.assert_called_once_with(self.fname, '', params=None,
+                                              threads=1,
+                                              cwd=self.dirname)
 
     @mock.patch('fs_uae_wrapper.base.ArchiveBase._get_wrapper_archive_name')
     def test_validate_options(self, get_wrapper_arch_name):
@@ -428,3 +664,13 @@ class TestArchiveBase(TestCase):
         bobj.all_options = {'wrapper': 'dummy'}
         self.assertEqual(bobj._get_wrapper_archive_name(),
                          'FooBar_1.24b_20202.7z')
+
+        os_listdir.return_value = 'Config.fs-uae Config.tar.zst'.split()
+        bobj = base.ArchiveBase('Config.fs-uae', utils.CmdOption(), {})
+        bobj.all_options = {'wrapper': 'dummy'}
+        self.assertEqual(bobj._get_wrapper_archive_name(), 'Config.tar.zst')
+
+        # archive found in the index
+        with mock.patch('fs_uae_wrapper.index.get_archive_name') as get_name:
+            get_name.return_value = 'Config.7z'
+            self.assertEqual(bobj._get_wrapper_archive_name(), 'Config.7z')
@@ -0,0 +1,354 @@
+import hashlib
+import io
+import os
+import shutil
+import tarfile
+from tempfile import mkdtemp
+from unittest import TestCase, mock
+
+from fs_uae_wrapper import cache, digest, manifest, utils
+
+
+def _fake_extract(arch_name, title='', params=None, threads=None, cwd=None,
+                  digests=None):
+    with open(os.path.join(cwd, 'file.iso'), 'w') as fobj:
+        fobj.write('contents of ' + os.path.basename(arch_name))
+    return True
+
+
+class TestCache(TestCase):
+
+    def setUp(self):
+        self.dirname = mkdtemp()
+        self.cachedir = os.path.join(self.dirname, 'cache')
+        self._env = mock.patch.dict(os.environ,
+                                    {'XDG_STATE_HOME': self.dirname})
+        self._env.start()
+        self.curdir = os.path.abspath(os.curdir)
+        os.chdir(self.dirname)
+        with open('game.7z', 'w') as fobj:
+            fobj.write('archive')
+
+    def tearDown(self):
+        self._env.stop()
+        os.chdir(self.curdir)
+        try:
+            shutil.rmtree(self.dirname)
+        except OSError:
+            pass
+
+    @mock.patch('os.getenv')
+    def test_get_cache_dir(self, getenv):
+        getenv.return_value = '/home/user/.cache'
+        self.assertIsNone(cache.get_cache_dir({}))
+        self.assertIsNone(cache.get_cache_dir({'wrapper_cache': '0'}))
+        self.assertEqual(cache.get_cache_dir({'wrapper_cache': '1'}),
+                         '/home/user/.cache/fs-uae-wrapper')
+        self.assertEqual(cache.get_cache_dir({'wrapper_cache_dir': '/foo'}),
+                         '/foo')
+
+    def test_get_cache(self):
+        self.assertIsNone(cache.get_cache({}))
+
+        arch_cache = cache.get_cache({'wrapper_cache_dir': self.cachedir,
+                                      'wrapper_cache_size': '1'})
+        self.assertEqual(arch_cache.size, 1024 * 1024)
+        self.assertTrue(os.path.isdir(arch_cache.entries_dir))
+
+        arch_cache = cache.get_cache({'wrapper_cache_dir': self.cachedir,
+                                      'wrapper_cache_size': 'lots'})
+        self.assertEqual(arch_cache.size, cache.DEFAULT_SIZE * 1024 * 1024)
+
+    @mock.patch('fs_uae_wrapper.cache.get_file_hash')
+    def test_get_key(self, get_hash):
+        get_hash.return_value = 'abcd'
+        arch_cache = cache.Cache(self.cachedir)
+
+        self.assertEqual(arch_cache.get_key('game.7z'), 'abcd')
+        self.assertEqual(arch_cache.get_key('game.7z'), 'abcd')
+        get_hash.assert_called_once()
+
+        # change of the archive will recalculate hash
+        with open('game.7z', 'w') as fobj:
+            fobj.write('changed archive')
+        get_hash.return_value = 'efgh'
+        self.assertEqual(arch_cache.get_key('game.7z'), 'efgh')
+
+    @mock.patch('fs_uae_wrapper.utils.extract_archive')
+    def test_fetch(self, extract):
+        extract.side_effect = _fake_extract
+        arch_cache = cache.Cache(self.cachedir)
+
+        with arch_cache.fetch('game.7z', 'Game') as tree:
+            self.assertTrue(os.path.exists(os.path.join(tree, 'file.iso')))
+        extract.assert_called_once_with(os.path.join(self.dirname,
+                                                     'game.7z'), 'Game',
+                                        params=None, threads=None,
+                                        cwd=mock.ANY, digests=mock.ANY)
+        self.assertEqual(os.path.abspath('.'), self.dirname)
+
+        # warm cache - no extraction at all
+        extract.reset_mock()
+        with arch_cache.fetch('game.7z', 'Game') as tree:
+            self.assertTrue(os.path.exists(os.path.join(tree, 'file.iso')))
+        extract.assert_not_called()
+
+        key = arch_cache.get_key('game.7z')
+        meta = utils.read_json(os.path.join(arch_cache.get_entry(key),
+                                            'meta.json'))
+        self.assertEqual(meta['hits'], 1)
+        self.assertEqual(meta['size'], len('contents of game.7z'))
+
+    @mock.patch('fs_uae_wrapper.utils.extract_archive')
+    def test_fetch_evicted(self, extract):
+        extract.side_effect = _fake_extract
+        arch_cache = cache.Cache(self.cachedir)
+        evicted = []
+
+        # other process evicts the entry right after it was stored
+        def _evict(keep=None):
+            if len(evicted) < limit:
+                evicted.append(keep)
+                arch_cache.remove(keep)
+
+        # entry is stored again
+        limit = 1
+        with mock.patch.object(arch_cache, 'evict', side_effect=_evict):
+            with arch_cache.fetch('game.7z') as tree:
+                self.assertTrue(os.path.exists(os.path.join(tree,
+                                                            'file.iso')))
+        self.assertEqual(extract.call_count, 2)
+
+        # but not forever, first attempt is a hit
+        evicted.clear()
+        limit = cache.FETCH_ATTEMPTS
+        with mock.patch.object(arch_cache, 'evict', side_effect=_evict):
+            with arch_cache.fetch('game.7z') as tree:
+                self.assertIsNone(tree)
+        self.assertEqual(extract.call_count, 1 + cache.FETCH_ATTEMPTS)
+
+    @mock.patch('fs_uae_wrapper.utils.extract_archive')
+    def test_fetch_failure(self, extract):
+        extract.return_value = False
+        arch_cache = cache.Cache(self.cachedir)
+
+        with arch_cache.fetch('game.7z') as tree:
+            self.assertIsNone(tree)
+        self.assertListEqual(os.listdir(arch_cache.entries_dir), [])
+        self.assertListEqual(os.listdir(arch_cache.tmp_dir), [])
+
+        with arch_cache.fetch('nonexistent.7z') as tree:
+            self.assertIsNone(tree)
+
+    @mock.patch('fs_uae_wrapper.utils.extract_archive')
+    def test_fetch_files(self, extract):
+        extract.side_effect = _fake_extract
+        arch_cache = cache.Cache(self.cachedir)
+
+        with arch_cache.fetch('game.7z') as tree:
+            full_tree = tree
+        with arch_cache.fetch('game.7z', files=['b', 'a']) as tree:
+            self.assertNotEqual(tree, full_tree)
+            partial_tree = tree
+        self.assertEqual(extract.call_count, 2)
+        extract.assert_called_with(os.path.join(self.dirname, 'game.7z'), '',
+                                   params=['b', 'a'], threads=None,
+                                   cwd=mock.ANY, digests=mock.ANY)
+
+        # order of the files doesn't matter
+        with arch_cache.fetch('game.7z', files=['a', 'b']) as tree:
+            self.assertEqual(tree, partial_tree)
+        self.assertEqual(extract.call_count, 2)
+
+    @mock.patch('fs_uae_wrapper.utils.extract_archive')
+    def test_store(self, extract):
+        extract.side_effect = _fake_extract
+        arch_cache = cache.Cache(self.cachedir)
+
+        meta = arch_cache.store('game.7z', files=['a'])
+        self.assertEqual(meta['hits'], 0)
+        self.assertEqual(meta['files'], 1)
+
+        # already stored entry is neither extracted nor marked as used
+        self.assertEqual(arch_cache.store('game.7z', files=['a']), meta)
+        self.assertEqual(extract.call_count, 1)
+
+        self.assertIsNone(arch_cache.store('nonexistent.7z'))
+        extract.return_value = False
+        extract.side_effect = None
+        self.assertIsNone(arch_cache.store('game.7z'))
+
+    @mock.patch('fs_uae_wrapper.utils.extract_archive')
+    def test_get_size(self, extract):
+        extract.side_effect = _fake_extract
+        arch_cache = cache.Cache(self.cachedir)
+        self.assertIsNone(arch_cache.get_size('nonexistent.7z'))
+        self.assertIsNone(arch_cache.get_size('game.7z'))
+
+        arch_cache.store('game.7z')
+        self.assertEqual(arch_cache.get_size('game.7z'),
+                         len('contents of game.7z'))
+        self.assertIsNone(arch_cache.get_size('game.7z', files=['a']))
+
+        arch_cache.remove(arch_cache.get_key('game.7z'))
+        self.assertIsNone(arch_cache.get_size('game.7z'))
+
+    @mock.patch('fs_uae_wrapper.utils.extract_archive')
+    def test_evict(self, extract):
+        extract.side_effect = _fake_extract
+        # budget of 0 MiB will keep only the last used entry
+        arch_cache = cache.Cache(self.cachedir, 0)
+
+        for fname in ('foo.7z', 'bar.7z'):
+            with open(fname, 'w') as fobj:
+                fobj.write(fname)
+
+        with arch_cache.fetch('foo.7z') as tree:
+            foo_tree = tree
+        with arch_cache.fetch('bar.7z') as tree:
+            bar_tree = tree
+            self.assertFalse(os.path.exists(foo_tree))
+            self.assertTrue(os.path.exists(bar_tree))
+
+            # entry in use cannot be evicted
+            with arch_cache.fetch('foo.7z') as tree:
+                self.assertTrue(os.path.exists(tree))
+                self.assertTrue(os.path.exists(bar_tree))
+
+        arch_cache.evict()
+        self.assertEqual(len(os.listdir(arch_cache.entries_dir)), 0)
+
+    @mock.patch('fs_uae_wrapper.utils.extract_archive')
+    def test_stats_pin(self, extract):
+        extract.side_effect = _fake_extract
+        arch_cache = cache.Cache(self.cachedir, 0)
+        with open('foo.7z', 'w') as fobj:
+            fobj.write('foo.7z')
+
+        with arch_cache.fetch('game.7z'):
+            pass
+        key = arch_cache.get_key('game.7z')
+        self.assertTrue(arch_cache.pin(key))
+        self.assertFalse(arch_cache.pin('nonexistent'))
+        with arch_cache.fetch('game.7z'):
+            pass
+        with arch_cache.fetch('foo.7z'):
+            pass
+
+        # pinned entry is kept, even if over the budget
+        arch_cache.evict()
+        self.assertEqual(list(arch_cache.get_entries()), [key])
+        self.assertEqual(arch_cache.get_stats(),
+                         {'hits': 1, 'misses': 2, 'evictions': 1,
+                          'evicted': len('contents of foo.7z')})
+
+        self.assertTrue(arch_cache.pin(key, False))
+        self.assertEqual(arch_cache.evict(), (1, len('contents of game.7z')))
+
+    @mock.patch('fs_uae_wrapper.utils.extract_archive')
+    def test_evict_targets(self, extract):
+        extract.side_effect = _fake_extract
+        arch_cache = cache.Cache(self.cachedir)
+        self.assertIsNotNone(arch_cache.store('game.7z'))
+
+        self.assertEqual(arch_cache.evict(max_age=60), (0, 0))
+        self.assertEqual(arch_cache.evict(size=0), (1, mock.ANY))
+        self.assertEqual(arch_cache.get_usage(), 0)
+
+        meta = arch_cache.store('game.7z')
+        key = arch_cache.get_key('game.7z')
+        meta['last_used'] -= 120
+        utils.write_json(os.path.join(arch_cache.get_entry(key),
+                                      'meta.json'), meta)
+        self.assertEqual(arch_cache.evict(max_age=60), (1, mock.ANY))
+
+    @mock.patch('fs_uae_wrapper.utils.list_archive')
+    @mock.patch('fs_uae_wrapper.utils.extract_archive')
+    def test_check(self, extract, list_archive):
+        extract.side_effect = _fake_extract
+        arch_cache = cache.Cache(self.cachedir)
+        meta = arch_cache.store('game.7z')
+        key = arch_cache.get_key('game.7z')
+
+        list_archive.return_value = None
+        self.assertEqual(arch_cache.check(key, meta), 'ok')
+        list_archive.return_value = [('./file.iso', 19)]
+        self.assertEqual(arch_cache.check(key, meta), 'ok')
+        list_archive.return_value = [('file.iso', 19), ('other', 1)]
+        self.assertEqual(arch_cache.check(key, meta), 'corrupt')
+        list_archive.return_value = [('file.iso', 20)]
+        self.assertEqual(arch_cache.check(key, meta), 'corrupt')
+
+        # symbolic links are not compared with the listing
+        os.symlink('file.iso', os.path.join(arch_cache.get_entry(key), 'tree',
+                                            'link.iso'))
+        list_archive.return_value = [('file.iso', 19)]
+        self.assertEqual(arch_cache.check(key, meta), 'ok')
+        list_archive.return_value = [('file.iso', 19), ('link.iso', 0)]
+        self.assertEqual(arch_cache.check(key, meta), 'ok')
+
+        with mock.patch('fs_uae_wrapper.cache.get_file_hash') as get_hash:
+            get_hash.return_value = key
+            os.utime('game.7z', ns=(0, 0))
+            list_archive.return_value = [('file.iso', 19)]
+            self.assertEqual(arch_cache.check(key, meta), 'ok')
+            get_hash.assert_called_once()
+
+            with open('game.7z', 'w') as fobj:
+                fobj.write('changed')
+            get_hash.return_value = 'other'
+            self.assertEqual(arch_cache.check(key, meta), 'stale')
+
+        os.unlink('game.7z')
+        self.assertEqual(arch_cache.check(key, meta), 'missing')
+
+    def test_fetch_digests(self):
+        with tarfile.open('game.tar', 'w') as tar:
+            info = tarfile.TarInfo('file.iso')
+            info.size = 4
+            tar.addfile(info, io.BytesIO(b'data'))
+        arch_cache = cache.Cache(self.cachedir)
+
+        # archive not seen before is digested during extraction
+        with mock.patch('fs_uae_wrapper.cache.get_file_hash') as get_hash:
+            with arch_cache.fetch('game.tar') as tree:
+                self.assertTrue(os.path.exists(os.path.join(tree,
+                                                            'file.iso')))
+            get_hash.assert_not_called()
+        key = digest.hash_file('game.tar')
+        self.assertEqual(arch_cache.get_key('game.tar', compute=False), key)
+        digests = manifest.load_digests('game.tar')
+        self.assertEqual(digests['digest'], key)
+        self.assertEqual(digests['files'],
+                         {'file.iso': hashlib.sha1(b'data').hexdigest()})
+        meta = arch_cache.get_entries()[key]
+        self.assertEqual(arch_cache.check(key, meta), 'ok')
+        self.assertEqual(arch_cache.check(key, meta, deep=True), 'ok')
+
+        # copy of the archive is recognized as the same contents, and its
+        # extraction is discarded
+        shutil.copy('game.tar', 'copy.tar')
+        with arch_cache.fetch('copy.tar') as tree:
+            self.assertEqual(tree, os.path.join(arch_cache.get_entry(key),
+                                                'tree'))
+        self.assertEqual(os.listdir(arch_cache.tmp_dir), [])
+        self.assertEqual(arch_cache.get_stats()['hits'], 1)
+
+        # key of the archive is taken from its digest manifest
+        shutil.rmtree(arch_cache.ids_dir)
+        os.mkdir(arch_cache.ids_dir)
+        with mock.patch('fs_uae_wrapper.cache.get_file_hash') as get_hash:
+            self.assertEqual(arch_cache.get_key('game.tar'), key)
+            get_hash.assert_not_called()
+
+        # extracted file differs from its digest, while size is the same,
+        # which is found only in deep mode
+        with open(os.path.join(tree, 'file.iso'), 'w') as fobj:
+            fobj.write('atad')
+        with mock.patch('fs_uae_wrapper.cache.get_file_hash') as get_hash:
+            self.assertEqual(arch_cache.check(key, meta), 'ok')
+            get_hash.assert_not_called()
+        with mock.patch('fs_uae_wrapper.utils.list_archive',
+                        return_value=None):
+            self.assertEqual(arch_cache.check(key, meta, deep=True),
+                             'corrupt')
@@ -0,0 +1,141 @@
+import io
+import os
+import shutil
+import tarfile
+from tempfile import mkdtemp
+from unittest import TestCase, mock
+
+from fs_uae_wrapper import cache, cachectl, utils
+
+
+class TestCacheCtl(TestCase):
+
+    def setUp(self):
+        self.dirname = mkdtemp()
+        self._env = mock.patch.dict(os.environ,
+                                    {'XDG_STATE_HOME': self.dirname})
+        self._env.start()
+        self.cachedir = os.path.join(self.dirname, 'cache')
+        self.options = utils.CmdOption({'wrapper_cache_dir': self.cachedir,
+                                        'wrapper_threads': '2'})
+        self.conf = os.path.join(self.dirname, 'Game.fs-uae')
+        with open(self.conf, 'w') as fobj:
+            fobj.write('[config]\nwrapper = archive\n')
+        self.arch = self._make_tar('Game.tar', b'data')
+
+    def tearDown(self):
+        self._env.stop()
+        shutil.rmtree(self.dirname)
+
+    def _make_tar(self, name, data):
+        fname = os.path.join(self.dirname, name)
+        with tarfile.open(fname, 'w') as tar:
+            info = tarfile.TarInfo('data.bin')
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        return fname
+
+    def _run(self, command, target=None, options=None):
+        out = io.StringIO()
+        result = cachectl.run(command, target, options or self.options, out)
+        return result, out.getvalue()
+
+    def test_stats(self):
+        result, out = self._run('stats')
+        self.assertTrue(result)
+        self.assertIn('0 entries', out)
+
+        arch_cache = cache.get_cache(self.options)
+        for _ in range(3):
+            with arch_cache.fetch(self.arch):
+                pass
+        result, out = self._run('stats')
+        self.assertIn('Hits: 2, misses: 1, hit ratio: 66.7%', out)
+        self.assertIn(' 66.7%        0.0        0.0  ', out)
+        self.assertIn(self.arch, out)
+
+    def test_pin(self):
+        self.assertFalse(self._run('pin')[0])
+        self.assertFalse(self._run('unpin', self.arch)[0])
+
+        result, out = self._run('pin', self.conf)
+        self.assertTrue(result)
+        self.assertEqual(out, f"Pinned `{self.arch}'.\n")
+        entries = cache.get_cache(self.options).get_entries()
+        self.assertEqual([meta['pinned'] for meta in entries.values()],
+                         [True])
+
+        result, out = self._run('unpin', self.arch)
+        self.assertTrue(result)
+        entries = cache.get_cache(self.options).get_entries()
+        self.assertEqual([meta['pinned'] for meta in entries.values()],
+                         [False])
+
+        self.assertFalse(self._run('pin', self.arch + '.missing')[0])
+
+    def test_prune(self):
+        self._run('pin', self.arch)
+        other = self._make_tar('Other.tar', b'other data')
+        arch_cache = cache.get_cache(self.options)
+        arch_cache.store(other)
+        leftover = os.path.join(arch_cache.tmp_dir, 'abcd-999999999')
+        os.mkdir(leftover)
+
+        result, out = self._run('prune', options=dict(
+            self.options, wrapper_prune_size='0'))
+        self.assertTrue(result)
+        self.assertIn('Removed 1 entries', out)
+        self.assertFalse(os.path.exists(leftover))
+        self.assertEqual([meta['archive'] for meta in
+                          arch_cache.get_entries().values()], [self.arch])
+
+        self.assertFalse(self._run('prune', options=dict(
+            self.options, wrapper_prune_age='old'))[0])
+
+    def test_verify(self):
+        result, out = self._run('verify')
+        self.assertTrue(result)
+        self.assertIn('Verified 0 entries', out)
+
+        arch_cache = cache.get_cache(self.options)
+        arch_cache.store(self.arch)
+        other = self._make_tar('Other.tar', b'other data')
+        arch_cache.store(other)
+        missing = self._make_tar('Missing.tar', b'missing')
+        arch_cache.store(missing)
+        result, out = self._run('verify')
+        self.assertTrue(result)
+        self.assertIn('3 ok', out)
+
+        os.unlink(missing)
+        self._make_tar('Other.tar', b'changed data')
+        key = arch_cache.get_key(self.arch)
+        with open(os.path.join(arch_cache.get_entry(key), 'tree',
+                               'data.bin'), 'a') as fobj:
+            fobj.write('garbage')
+
+        result, out = self._run('verify')
+        self.assertFalse(result)
+        self.assertIn(f'missing: {missing}\n', out)
+        self.assertIn(f'stale: {other}\n', out)
+        self.assertIn(f'corrupt: {self.arch}\n', out)
+        self.assertIn('0 ok, 1 with missing archive, 1 stale, 1 corrupt',
+                      out)
+        self.assertEqual(len(arch_cache.get_entries()), 1)
+
+    def test_verify_deep(self):
+        arch_cache = cache.get_cache(self.options)
+        arch_cache.store(self.arch)
+        key = arch_cache.get_key(self.arch)
+        with open(os.path.join(arch_cache.get_entry(key), 'tree',
+                               'data.bin'), 'w') as fobj:
+            fobj.write('atad')
+
+        # file of the same size is hashed only in deep mode
+        result, out = self._run('verify')
+        self.assertTrue(result)
+        self.assertIn('1 ok', out)
+        result, out = self._run('verify', options=utils.CmdOption(
+            self.options, wrapper_verify_deep='1'))
+        self.assertFalse(result)
+        self.assertIn(f'corrupt: {self.arch}\n', out)
@@ -0,0 +1,97 @@
+import hashlib
+import io
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase, mock
+
+from fs_uae_wrapper import digest
+
+
+class TestDigest(TestCase):
+
+    def setUp(self):
+        self.dirname = mkdtemp()
+        self.data = bytes(range(256)) * 64
+        self.fname = os.path.join(self.dirname, 'data.bin')
+        with open(self.fname, 'wb') as fobj:
+            fobj.write(self.data)
+        self.expected = hashlib.sha1(self.data).hexdigest()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_hash_file(self):
+        self.assertEqual(digest.hash_file(self.fname), self.expected)
+        # big files are memory mapped
+        with mock.patch('fs_uae_wrapper.digest.MMAP_SIZE', 1):
+            self.assertEqual(digest.hash_file(self.fname), self.expected)
+        self.assertRaises(OSError, digest.hash_file, self.fname + '.missing')
+
+    def test_reader(self):
+        # sequential reading
+        with open(self.fname, 'rb') as fobj:
+            reader = digest.Reader(fobj)
+            target = io.BytesIO()
+            reader.copy(target)
+            self.assertEqual(target.getvalue(), self.data)
+            self.assertEqual(reader.hexdigest(), self.expected)
+
+        # skipped and re-read parts are digested once, in order
+        with open(self.fname, 'rb') as fobj:
+            reader = digest.Reader(fobj)
+            reader.seek(1000)
+            # data after the gap is not digested until it's reached
+            with mock.patch('os.pread') as pread:
+                self.assertEqual(reader.read(100), self.data[1000:1100])
+                pread.assert_not_called()
+            self.assertEqual(reader.hashed, 0)
+            reader.seek(0)
+            reader.read(600)
+            reader.seek(500)
+            reader.read(1000)
+            self.assertEqual(reader.hashed, 1500)
+            reader.seek(-10, os.SEEK_END)
+            reader.read()
+            self.assertEqual(reader.tell(), len(self.data))
+            self.assertEqual(reader.hexdigest(), self.expected)
+
+        # not read remainder is digested on finish
+        with open(self.fname, 'rb') as fobj:
+            reader = digest.Reader(fobj)
+            reader.read(10)
+            self.assertEqual(reader.hexdigest(), self.expected)
+
+        # big remainder is memory mapped
+        with open(self.fname, 'rb') as fobj, \
+                mock.patch('fs_uae_wrapper.digest.MMAP_SIZE', 100), \
+                mock.patch('os.pread') as pread:
+            reader = digest.Reader(fobj)
+            reader.read(10)
+            self.assertEqual(reader.hexdigest(), self.expected)
+            pread.assert_not_called()
+
+    def test_writer(self):
+        target = io.BytesIO()
+        writer = digest.Writer(target)
+        writer.write(self.data[:100])
+        writer.write(self.data[100:])
+        self.assertEqual(writer.tell(), len(self.data))
+        self.assertEqual(target.getvalue(), self.data)
+        self.assertEqual(writer.hexdigest(), self.expected)
+
+    def test_stream(self):
+        digests = {}
+        with open(self.fname, 'rb') as fobj:
+            with digest.Stream(fobj, digests, 'data.bin') as stream:
+                target = io.BytesIO()
+                shutil.copyfileobj(stream, target, 1000)
+        self.assertEqual(target.getvalue(), self.data)
+        self.assertEqual(digests, {'data.bin': self.expected})
+
+        target = io.BytesIO()
+        stream = digest.Stream(target)
+        stream.write(self.data[:100])
+        stream.write(self.data[100:])
+        self.assertEqual(target.getvalue(), self.data)
+        self.assertEqual(stream.hexdigest(), self.expected)
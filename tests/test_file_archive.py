@@ -1,9 +1,13 @@
+import bz2
+import gzip
+import io
+import lzma
 import os
 import shutil
 from tempfile import mkdtemp
 from unittest import TestCase, mock
 
-from fs_uae_wrapper import file_archive
+from fs_uae_wrapper import digest, file_archive
 
 
 class TestArchive(TestCase):
@@ -20,6 +24,39 @@ class TestArchive(TestCase):
         except OSError:
             pass
 
+    def test_get_format(self):
+        self.assertEqual(file_archive.get_format('/a/foo.tar.xz'), 'tar.xz')
+        self.assertEqual(file_archive.get_format('foo.TGZ'), 'tgz')
+        self.assertEqual(file_archive.get_format('foo.lzh'), 'lha')
+        self.assertEqual(file_archive.get_format('foo.7z'), '7z')
+        self.assertIsNone(file_archive.get_format('foo.cab'))
+        self.assertIsNone(file_archive.get_format('foo'))
+
+    def test_get_stream_size(self):
+        data = os.urandom(1000)
+        with gzip.open('foo.tar.gz', 'wb') as fobj:
+            fobj.write(data)
+        self.assertEqual(file_archive.get_stream_size('foo.tar.gz'), 1000)
+
+        with bz2.open('foo.tar.bz2', 'wb') as fobj:
+            fobj.write(data)
+        self.assertIsNone(file_archive.get_stream_size('foo.tar.bz2'))
+        self.assertIsNone(file_archive.get_stream_size('missing.tgz'))
+
+        # gzip stores size modulo 4 GiB
+        with open('foo.tgz', 'wb') as fobj:
+            fobj.write(b'\0' * 100 + (10).to_bytes(4, 'little'))
+        self.assertEqual(file_archive._get_gzip_size('foo.tgz'), 2**32 + 10)
+
+        with lzma.open('foo.tar.xz', 'wb') as fobj:
+            fobj.write(data)
+        with mock.patch('fs_uae_wrapper.path.which') as which:
+            which.return_value = None
+            self.assertIsNone(file_archive.get_stream_size('foo.tar.xz'))
+        if shutil.which('xz'):
+            self.assertEqual(file_archive.get_stream_size('foo.tar.xz'),
+                             1000)
+
     def test_get_archiver(self):
         arch = file_archive.get_archiver('foobarbaz.cab')
         self.assertIsNone(arch)
@@ -28,25 +65,238 @@ class TestArchive(TestCase):
             fobj.write('\n')
 
         arch = file_archive.get_archiver('foobarbaz.tar')
-        self.assertIsInstance(arch, file_archive.TarArchive)
+        self.assertIsInstance(arch, file_archive.NativeTarArchive)
 
+        # in-process implementation doesn't need any executable
         file_archive.TarArchive.ARCH = 'blahblah'
         arch = file_archive.get_archiver('foobarbaz.tar')
-        self.assertIsNone(arch)
+        self.assertIsInstance(arch, file_archive.NativeTarArchive)
         file_archive.TarArchive.ARCH = 'tar'
 
+        file_archive.SevenZArchive.ARCH = 'blahblah'
+        arch = file_archive.get_archiver('foobarbaz.7z')
+        self.assertIsNone(arch)
+        file_archive.SevenZArchive.ARCH = '7z'
+
         with open('foobarbaz.tar.bz2', 'w') as fobj:
             fobj.write('\n')
         arch = file_archive.get_archiver('foobarbaz.tar.bz2')
-        self.assertIsInstance(arch, file_archive.TarBzip2Archive)
+        self.assertIsInstance(arch, file_archive.NativeTarBzip2Archive)
+
+        arch = file_archive.get_archiver('foobarbaz.zip')
+        self.assertIsInstance(arch, file_archive.NativeZipArchive)
+
+    def test_native(self):
+        os.makedirs('src/dir/subdir')
+        with open('src/file', 'w') as fobj:
+            fobj.write('file contents\n')
+        with open('src/dir/subdir/exe', 'w') as fobj:
+            fobj.write('#!/bin/sh\n')
+        os.chmod('src/dir/subdir/exe', 0o755)
+
+        for cls, ext in ((file_archive.NativeTarArchive, 'tar'),
+                         (file_archive.NativeTarGzipArchive, 'tgz'),
+                         (file_archive.NativeTarBzip2Archive, 'tar.bz2'),
+                         (file_archive.NativeTarXzArchive, 'tar.xz'),
+                         (file_archive.NativeZipArchive, 'zip')):
+            arch_name = os.path.join(self.dirname, 'arch.' + ext)
+            arch = cls()
+            self.assertEqual(arch.archiver, cls.ARCH)
+
+            os.chdir('src')
+            self.assertTrue(arch.create(arch_name))
+            os.chdir(self.dirname)
+
+            os.mkdir('dst')
+            os.chdir('dst')
+            self.assertTrue(arch.extract(arch_name))
+            with open('file') as fobj:
+                self.assertEqual(fobj.read(), 'file contents\n')
+            self.assertTrue(os.access('dir/subdir/exe', os.X_OK))
+            os.chdir(self.dirname)
+
+            shutil.rmtree('dst')
+            os.unlink(arch_name)
+
+        for arch in (file_archive.NativeTarArchive(),
+                     file_archive.NativeZipArchive()):
+            self.assertFalse(arch.extract('nonexistent'))
+            with open('broken', 'w') as fobj:
+                fobj.write('\n')
+            self.assertFalse(arch.extract('broken'))
+            self.assertFalse(arch.create('arch', ['nonexistent']))
 
-    @mock.patch('subprocess.call')
+    def test_native_zip_old_files(self):
+        with open('old', 'w') as fobj:
+            fobj.write('\n')
+        # default AmigaDOS date
+        os.utime('old', (252460800, 252460800))
+        arch = file_archive.NativeZipArchive()
+        self.assertTrue(arch.create('arch.zip', ['old']))
+        self.assertEqual(arch.list('arch.zip'), [('old', 1)])
+
+    def test_native_cwd(self):
+        os.makedirs('src/dir')
+        with open('src/dir/file', 'w') as fobj:
+            fobj.write('file contents\n')
+        os.mkdir('dst')
+
+        for name in ('arch.tar', 'arch.zip'):
+            arch = file_archive.get_archiver(name)
+            self.assertTrue(arch.create(name, cwd='src'))
+            self.assertTrue(os.path.exists(name))
+            self.assertTrue(arch.extract(name, cwd='dst'))
+            with open('dst/dir/file') as fobj:
+                self.assertEqual(fobj.read(), 'file contents\n')
+            self.assertEqual(os.path.abspath('.'), self.dirname)
+
+            with open('src/new', 'w') as fobj:
+                fobj.write('\n')
+            if arch.supports_update():
+                self.assertTrue(arch.update(name, ['new'], cwd='src'))
+                self.assertIn('new', [fname for fname, _ in arch.list(name)])
+            os.unlink('src/new')
+            shutil.rmtree('dst/dir')
+
+    def test_update_delete_dir(self):
+        os.makedirs('src/dir/sub')
+        for name in ('dir/file', 'dir/sub/file', 'file'):
+            with open(os.path.join('src', name), 'w') as fobj:
+                fobj.write('file contents\n')
+
+        for cls, name in ((file_archive.TarArchive, 'arch.tar'),
+                          (file_archive.SevenZArchive, 'arch.7z'),
+                          (file_archive.ZipArchive, 'arch.zip'),
+                          (file_archive.RarArchive, 'arch.rar')):
+            arch = cls()
+            if not arch.supports_update():
+                continue
+            self.assertTrue(arch.create(name, cwd='src'), cls.__name__)
+            # directory is deleted along with its contents
+            self.assertTrue(arch.update(name, deleted=['dir'], cwd='src'),
+                            cls.__name__)
+            self.assertEqual([os.path.normpath(fname)
+                              for fname, _ in arch.list(name)], ['file'],
+                             cls.__name__)
+            os.unlink(name)
+
+    @mock.patch('fs_uae_wrapper.process.call')
+    def test_update_not_deleted(self, call):
+        call.return_value = 0
+        with mock.patch('fs_uae_wrapper.path.which', return_value='tar'):
+            arch = file_archive.TarArchive()
+        open('arch.tar', 'w').close()
+
+        # archiver hasn't deleted the files, although it exited with success
+        with mock.patch.object(arch, 'list') as list_:
+            list_.return_value = [('dir/file', 1), ('other', 1)]
+            self.assertFalse(arch.update('arch.tar', deleted=['dir']))
+            list_.return_value = None
+            self.assertFalse(arch.update('arch.tar', deleted=['dir']))
+            list_.return_value = [('dirname', 1), ('other', 1)]
+            self.assertTrue(arch.update('arch.tar', deleted=['dir']))
+
+    def test_digests(self):
+        os.makedirs('src/dir')
+        with open('src/dir/file', 'w') as fobj:
+            fobj.write('file contents\n')
+        os.mkdir('dst')
+
+        classes = [file_archive.NativeTarArchive,
+                   file_archive.NativeTarGzipArchive,
+                   file_archive.NativeZipArchive]
+        if file_archive.TarArchive().archiver:
+            classes.append(file_archive.TarArchive)
+        # in-process archivers digest the files passing through them
+        files_digests = {'dir/file': digest.hash_file('src/dir/file')}
+        for cls in classes:
+            name = 'arch.' + ('zip' if 'Zip' in cls.__name__ else 'tar')
+            expected = files_digests if 'Native' in cls.__name__ else {}
+            arch = cls()
+            arch.digests = digest.Digests()
+            self.assertTrue(arch.create(name, cwd='src'))
+            self.assertEqual(arch.digests.archive, digest.hash_file(name),
+                             cls.__name__)
+            self.assertEqual(arch.digests.files, expected, cls.__name__)
+
+            for files in (None, ['dir/file']):
+                arch.digests = digest.Digests()
+                self.assertTrue(arch.extract(name, files, cwd='dst'))
+                self.assertEqual(arch.digests.archive,
+                                 digest.hash_file(name), cls.__name__)
+                self.assertEqual(arch.digests.files, expected, cls.__name__)
+                with open('dst/dir/file') as fobj:
+                    self.assertEqual(fobj.read(), 'file contents\n')
+                shutil.rmtree('dst/dir')
+            os.unlink(name)
+
+    def test_digests_compressed_tar(self):
+        os.mkdir('src')
+        with open('src/file', 'w') as fobj:
+            fobj.write('file contents\n')
+        os.mkdir('dst')
+
+        # compressed archive is piped to tar, which needs to be told which
+        # compressor to use
+        for cls, name in ((file_archive.TarGzipArchive, 'arch.tgz'),
+                          (file_archive.TarBzip2Archive, 'arch.tar.bz2'),
+                          (file_archive.TarXzArchive, 'arch.tar.xz'),
+                          (file_archive.TarZstdArchive, 'arch.tar.zst'),
+                          (file_archive.TarLz4Archive, 'arch.tar.lz4')):
+            arch = cls()
+            if not arch.archiver:
+                continue
+            self.assertTrue(arch.create(name, cwd='src'), cls.__name__)
+            arch.digests = digest.Digests()
+            self.assertTrue(arch.extract(name, cwd='dst'), cls.__name__)
+            self.assertEqual(arch.digests.archive, digest.hash_file(name),
+                             cls.__name__)
+            with open('dst/file') as fobj:
+                self.assertEqual(fobj.read(), 'file contents\n')
+            os.unlink('dst/file')
+
+    @mock.patch('fs_uae_wrapper.process.call')
+    def test_digests_external(self, call):
+        call.return_value = 0
+        with open('foo', 'w') as fobj:
+            fobj.write('archive')
+        expected = digest.hash_file('foo')
+
+        # archive is digested concurrently with the archiver
+        arch = file_archive.Archive()
+        arch.digests = digest.Digests()
+        self.assertTrue(arch.extract('foo'))
+        call.assert_called_once_with(['false', 'x', 'foo'], cwd=None)
+        self.assertEqual(arch.digests.archive, expected)
+
+        arch.digests = digest.Digests()
+        self.assertTrue(arch.create('foo'))
+        self.assertEqual(arch.digests.archive, expected)
+
+        # tar is fed with the archive through the pipe
+        def _call(cmd, cwd=None, feed=None):
+            target = io.BytesIO()
+            feed(target)
+            self.assertEqual(target.getvalue(), b'archive')
+            return 0
+
+        call.reset_mock()
+        call.side_effect = _call
+        with mock.patch('fs_uae_wrapper.path.which', return_value='tar'):
+            arch = file_archive.TarArchive()
+        arch.digests = digest.Digests()
+        self.assertTrue(arch.extract('foo', ['a']))
+        call.assert_called_once_with(['tar', 'xf', '-', 'a'], cwd=None,
+                                     feed=mock.ANY)
+        self.assertEqual(arch.digests.archive, expected)
+
+    @mock.patch('fs_uae_wrapper.process.call')
     def test_archive(self, call):
         arch = file_archive.Archive()
         call.return_value = 0
 
         self.assertTrue(arch.create('foo'))
-        call.assert_called_once_with(['false', 'a', 'foo', '.'])
+        call.assert_called_once_with(['false', 'a', 'foo', '.'], cwd=None)
 
         call.reset_mock()
         self.assertFalse(arch.extract('foo'))
@@ -58,15 +308,20 @@ class TestArchive(TestCase):
 
         call.reset_mock()
         self.assertFalse(arch.create('foo'))
-        call.assert_called_once_with(['false', 'a', 'foo', '.'])
+        call.assert_called_once_with(['false', 'a', 'foo', '.'], cwd=None)
 
         call.reset_mock()
         self.assertFalse(arch.extract('foo'))
-        call.assert_called_once_with(['false', 'x', 'foo'])
+        call.assert_called_once_with(['false', 'x', 'foo'], cwd=None)
+
+        call.reset_mock()
+        self.assertFalse(arch.extract('foo', ['a', 'b/c']))
+        call.assert_called_once_with(['false', 'x', 'foo', 'a', 'b/c'],
+                                     cwd=None)
 
     @mock.patch('os.path.exists')
     @mock.patch('fs_uae_wrapper.path.which')
-    @mock.patch('subprocess.call')
+    @mock.patch('fs_uae_wrapper.process.call')
     def test_tar(self, call, which, exists):
         with open('foo', 'w') as fobj:
             fobj.write('\n')
@@ -79,48 +334,51 @@ class TestArchive(TestCase):
         call.return_value = 0
 
         self.assertTrue(arch.create('foo.tar'))
-        call.assert_called_once_with(['tar', 'cf', 'foo.tar', 'foo'])
+        call.assert_called_once_with(['tar', 'cf', 'foo.tar', 'foo'], cwd=None)
 
         call.reset_mock()
         call.return_value = 1
         self.assertFalse(arch.extract('foo.tar'))
-        call.assert_called_once_with(['tar', 'xf', 'foo.tar'])
+        call.assert_called_once_with(['tar', 'xf', 'foo.tar'], cwd=None)
 
         call.reset_mock()
         arch = file_archive.TarGzipArchive()
         arch.archiver = 'tar'
         call.return_value = 0
         self.assertTrue(arch.create('foo.tgz'))
-        call.assert_called_once_with(['tar', 'zcf', 'foo.tgz', 'foo'])
+        call.assert_called_once_with(['tar', 'zcf', 'foo.tgz', 'foo'],
+                                     cwd=None)
 
         call.reset_mock()
         call.return_value = 1
         self.assertFalse(arch.extract('foo.tgz'))
-        call.assert_called_once_with(['tar', 'xf', 'foo.tgz'])
+        call.assert_called_once_with(['tar', 'zxf', 'foo.tgz'], cwd=None)
 
         call.reset_mock()
         arch = file_archive.TarBzip2Archive()
         arch.archiver = 'tar'
         call.return_value = 0
         self.assertTrue(arch.create('foo.tar.bz2'))
-        call.assert_called_once_with(['tar', 'jcf', 'foo.tar.bz2', 'foo'])
+        call.assert_called_once_with(['tar', 'jcf', 'foo.tar.bz2', 'foo'],
+                                     cwd=None)
 
         call.reset_mock()
         call.return_value = 1
         self.assertFalse(arch.extract('foo.tar.bz2'))
-        call.assert_called_once_with(['tar', 'xf', 'foo.tar.bz2'])
+        call.assert_called_once_with(['tar', 'jxf', 'foo.tar.bz2'], cwd=None)
 
         call.reset_mock()
         arch = file_archive.TarXzArchive()
         arch.archiver = 'tar'
         call.return_value = 0
         self.assertTrue(arch.create('foo.tar.xz'))
-        call.assert_called_once_with(['tar', 'Jcf', 'foo.tar.xz', 'foo'])
+        call.assert_called_once_with(['tar', 'Jcf', 'foo.tar.xz', 'foo'],
+                                     cwd=None)
 
         call.reset_mock()
         call.return_value = 1
         self.assertFalse(arch.extract('foo.tar.xz'))
-        call.assert_called_once_with(['tar', 'xf', 'foo.tar.xz'])
+        call.assert_called_once_with(['tar', 'Jxf', 'foo.tar.xz'], cwd=None)
 
         with open('bar', 'w') as fobj:
             fobj.write('\n')
@@ -130,16 +388,216 @@ class TestArchive(TestCase):
         arch.archiver = 'tar'
         call.return_value = 0
         self.assertTrue(arch.create('foo.tgz'))
-        call.assert_called_once_with(['tar', 'zcf', 'foo.tgz', 'bar', 'foo'])
+        call.assert_called_once_with(['tar', 'zcf', 'foo.tgz', 'bar', 'foo'],
+                                     cwd=None)
 
         call.reset_mock()
         call.return_value = 1
         arch = file_archive.TarArchive()
         self.assertFalse(arch.create('foo.tar'))
-        call.assert_called_once_with(['tar', 'cf', 'foo.tar', 'bar', 'foo'])
+        call.assert_called_once_with(['tar', 'cf', 'foo.tar', 'bar', 'foo'],
+                                     cwd=None)
+
+    @mock.patch('fs_uae_wrapper.path.which')
+    @mock.patch('fs_uae_wrapper.process.call')
+    def test_tar_threads(self, call, which):
+        call.return_value = 0
+        with open('foo', 'w') as fobj:
+            fobj.write('\n')
+
+        # no parallel compressors available
+        which.side_effect = lambda x: 'tar' if x == 'tar' else None
+        arch = file_archive.TarGzipArchive(4)
+        self.assertFalse(arch.is_parallel())
+        self.assertTrue(arch.create('foo.tgz'))
+        call.assert_called_once_with(['tar', 'zcf', 'foo.tgz', 'foo'],
+                                     cwd=None)
+
+        which.side_effect = lambda x: x
+        for cls, compressor in ((file_archive.TarGzipArchive, 'pigz -p 4'),
+                                (file_archive.TarBzip2Archive, 'pbzip2 -p4'),
+                                (file_archive.TarXzArchive, 'pixz -p 4')):
+            arch = cls(4)
+            self.assertTrue(arch.is_parallel())
+
+            call.reset_mock()
+            self.assertTrue(arch.create('foo.tar'))
+            call.assert_called_once_with(['tar', '-I', compressor, '-cf',
+                                          'foo.tar', 'foo'], cwd=None)
+
+            call.reset_mock()
+            self.assertTrue(arch.extract('foo'))
+            call.assert_called_once_with(['tar', '-I', compressor, '-xf',
+                                          'foo'], cwd=None)
+
+        which.side_effect = lambda x: None if x == 'pixz' else x
+        arch = file_archive.TarXzArchive(4)
+        call.reset_mock()
+        self.assertTrue(arch.create('foo.tar.xz'))
+        call.assert_called_once_with(['tar', '-I', 'xz -T4', '-cf',
+                                      'foo.tar.xz', 'foo'], cwd=None)
+
+        # plain tar, or single thread means no parallel compression
+        self.assertFalse(file_archive.TarArchive(4).is_parallel())
+        self.assertFalse(file_archive.TarXzArchive(1).is_parallel())
+
+    @mock.patch('fs_uae_wrapper.path.which')
+    @mock.patch('fs_uae_wrapper.process.call')
+    def test_7zip_threads(self, call, which):
+        call.return_value = 0
+        with open('foo', 'w') as fobj:
+            fobj.write('\n')
+        which.return_value = '7z'
+
+        arch = file_archive.SevenZArchive(8)
+        self.assertTrue(arch.is_parallel())
+        self.assertTrue(arch.create('foo.7z'))
+        call.assert_called_once_with(['7z', 'a', '-mmt=8', 'foo.7z', '.'],
+                                     cwd=None)
+
+        call.reset_mock()
+        self.assertTrue(arch.extract('foo'))
+        call.assert_called_once_with(['7z', 'x', '-mmt=8', 'foo'], cwd=None)
+
+        self.assertFalse(file_archive.SevenZArchive(1).is_parallel())
+
+        arch = file_archive.ZipArchive(8)
+        self.assertTrue(arch.is_parallel())
+        which.side_effect = ['zip', 'unzip']
+        arch = file_archive.ZipArchive(8)
+        self.assertFalse(arch.is_parallel())
+
+    @mock.patch('fs_uae_wrapper.path.which')
+    def test_get_archiver_threads(self, which):
+        which.side_effect = lambda x: x
+
+        self.assertIsInstance(file_archive.get_archiver('foo.tar.gz', 4),
+                              file_archive.TarGzipArchive)
+        self.assertIsInstance(file_archive.get_archiver('foo.tar.gz', 1),
+                              file_archive.NativeTarGzipArchive)
+        self.assertIsInstance(file_archive.get_archiver('foo.tar', 4),
+                              file_archive.NativeTarArchive)
+        self.assertIsInstance(file_archive.get_archiver('foo.zip', 4),
+                              file_archive.ZipArchive)
+        self.assertIsInstance(file_archive.get_archiver('foo.zip'),
+                              file_archive.NativeZipArchive)
+
+    @mock.patch('fs_uae_wrapper.path.which')
+    @mock.patch('fs_uae_wrapper.process.call')
+    def test_tar_zstd_lz4(self, call, which):
+        call.return_value = 0
+        with open('foo', 'w') as fobj:
+            fobj.write('\n')
+        which.side_effect = lambda x: x
+
+        arch = file_archive.TarZstdArchive()
+        self.assertTrue(arch.create('foo.tar.zst'))
+        call.assert_called_once_with(['tar', '-I', 'zstd', '-cf',
+                                      'foo.tar.zst', 'foo'], cwd=None)
+        call.reset_mock()
+        self.assertTrue(arch.extract('foo'))
+        call.assert_called_once_with(['tar', '-I', 'zstd', '-xf', 'foo'],
+                                     cwd=None)
+
+        arch = file_archive.TarZstdArchive(4)
+        call.reset_mock()
+        self.assertTrue(arch.create('foo.tar.zst'))
+        call.assert_called_once_with(['tar', '-I', 'zstd -T4', '-cf',
+                                      'foo.tar.zst', 'foo'], cwd=None)
+        call.reset_mock()
+        self.assertTrue(arch.extract('foo'))
+        call.assert_called_once_with(['tar', '-I', 'zstd', '-xf', 'foo'],
+                                     cwd=None)
 
+        arch = file_archive.TarLz4Archive(4)
+        call.reset_mock()
+        self.assertTrue(arch.create('foo.tar.lz4'))
+        call.assert_called_once_with(['tar', '-I', 'lz4', '-cf',
+                                      'foo.tar.lz4', 'foo'], cwd=None)
+        call.reset_mock()
+        self.assertTrue(arch.extract('foo'))
+        call.assert_called_once_with(['tar', '-I', 'lz4', '-xf', 'foo'],
+                                     cwd=None)
+
+        # no compressor, no archiver
+        which.side_effect = lambda x: x if x == 'tar' else None
+        self.assertIsNone(file_archive.TarZstdArchive().archiver)
+        self.assertIsNone(file_archive.TarLz4Archive().archiver)
+
+    @mock.patch('fs_uae_wrapper.file_archive.Archive._is_deleted',
+                return_value=True)
     @mock.patch('fs_uae_wrapper.path.which')
-    @mock.patch('subprocess.call')
+    @mock.patch('fs_uae_wrapper.process.call')
+    def test_update(self, call, which, _):
+        call.return_value = 0
+        which.side_effect = lambda x: x
+
+        arch = file_archive.SevenZArchive(2)
+        self.assertTrue(arch.supports_update())
+        self.assertTrue(arch.update('foo.7z', ['bar', 'baz'], ['baz', 'x']))
+        self.assertListEqual(call.call_args_list,
+                             [mock.call(['7z', 'd', 'foo.7z', 'baz', 'x'],
+                                        cwd=None),
+                              mock.call(['7z', 'u', '-mmt=2', 'foo.7z',
+                                         'bar', 'baz'], cwd=None)])
+
+        call.reset_mock()
+        arch = file_archive.TarArchive()
+        self.assertTrue(arch.update('foo.tar', ['bar'], []))
+        call.assert_called_once_with(['tar', 'rf', 'foo.tar', 'bar'], cwd=None)
+
+        call.reset_mock()
+        self.assertTrue(arch.update('foo.tar', [], ['bar']))
+        call.assert_called_once_with(['tar', '--delete', '-f', 'foo.tar',
+                                      'bar'], cwd=None)
+
+        call.reset_mock()
+        call.return_value = 1
+        self.assertFalse(arch.update('foo.tar', ['bar'], ['bar']))
+        call.assert_called_once_with(['tar', '--delete', '-f', 'foo.tar',
+                                      'bar'], cwd=None)
+
+        call.reset_mock()
+        self.assertFalse(arch.update('foo.tar', ['bar'], []))
+        call.assert_called_once_with(['tar', 'rf', 'foo.tar', 'bar'], cwd=None)
+
+        which.side_effect = ['zip', 'unzip']
+        call.reset_mock()
+        call.return_value = 0
+        arch = file_archive.ZipArchive()
+        self.assertTrue(arch.update('foo.zip', ['bar'], ['baz']))
+        self.assertListEqual(call.call_args_list,
+                             [mock.call(['zip', '-d', 'foo.zip', 'baz',
+                                         'baz/*'], cwd=None),
+                              mock.call(['zip', '-r', 'foo.zip', 'bar'],
+                                        cwd=None)])
+
+        which.side_effect = lambda x: x
+        call.reset_mock()
+        for arch in (file_archive.TarXzArchive(),
+                     file_archive.TarZstdArchive(),
+                     file_archive.LhaArchive(),
+                     file_archive.NativeZipArchive()):
+            self.assertFalse(arch.supports_update())
+            self.assertFalse(arch.update('foo', ['bar'], ['baz']))
+        call.assert_not_called()
+
+        arch = file_archive.RarArchive()
+        self.assertTrue(arch.supports_update())
+        arch.archiver = 'unrar'
+        self.assertFalse(arch.supports_update())
+
+        self.assertIsInstance(file_archive.get_archiver('foo.zip',
+                                                        update=True),
+                              file_archive.ZipArchive)
+        self.assertIsInstance(file_archive.get_archiver('foo.tar',
+                                                        update=True),
+                              file_archive.TarArchive)
+        self.assertIsNone(file_archive.get_archiver('foo.tar.gz',
+                                                    update=True))
+
+    @mock.patch('fs_uae_wrapper.path.which')
+    @mock.patch('fs_uae_wrapper.process.call')
     def test_lha(self, call, which):
         with open('foo', 'w') as fobj:
             fobj.write('\n')
@@ -151,15 +609,15 @@ class TestArchive(TestCase):
         call.return_value = 0
 
         self.assertTrue(arch.create('foo'))
-        call.assert_called_once_with(['lha', 'a', 'foo', '.'])
+        call.assert_called_once_with(['lha', 'a', 'foo', '.'], cwd=None)
 
         call.reset_mock()
         call.return_value = 1
         self.assertFalse(arch.extract('foo'))
-        call.assert_called_once_with(['lha', 'x', 'foo'])
+        call.assert_called_once_with(['lha', 'x', 'foo'], cwd=None)
 
     @mock.patch('fs_uae_wrapper.path.which')
-    @mock.patch('subprocess.call')
+    @mock.patch('fs_uae_wrapper.process.call')
     def test_lzx(self, call, which):
         with open('foo', 'w') as fobj:
             fobj.write('\n')
@@ -176,10 +634,10 @@ class TestArchive(TestCase):
         call.reset_mock()
         call.return_value = 1
         self.assertFalse(arch.extract('foo'))
-        call.assert_called_once_with(['unlzx', '-x', 'foo'])
+        call.assert_called_once_with(['unlzx', '-x', 'foo'], cwd=None)
 
     @mock.patch('fs_uae_wrapper.path.which')
-    @mock.patch('subprocess.call')
+    @mock.patch('fs_uae_wrapper.process.call')
     def test_7zip(self, call, which):
         with open('foo', 'w') as fobj:
             fobj.write('\n')
@@ -191,15 +649,15 @@ class TestArchive(TestCase):
         call.return_value = 0
 
         self.assertTrue(arch.create('foo'))
-        call.assert_called_once_with(['7z', 'a', 'foo', '.'])
+        call.assert_called_once_with(['7z', 'a', 'foo', '.'], cwd=None)
 
         call.reset_mock()
         call.return_value = 1
         self.assertFalse(arch.extract('foo'))
-        call.assert_called_once_with(['7z', 'x', 'foo'])
+        call.assert_called_once_with(['7z', 'x', 'foo'], cwd=None)
 
     @mock.patch('fs_uae_wrapper.path.which')
-    @mock.patch('subprocess.call')
+    @mock.patch('fs_uae_wrapper.process.call')
     def test_zip(self, call, which):
         with open('foo', 'w') as fobj:
             fobj.write('\n')
@@ -211,12 +669,13 @@ class TestArchive(TestCase):
         call.return_value = 0
 
         self.assertTrue(arch.create('foo'))
-        call.assert_called_once_with(['7z', 'a', '-tzip', 'foo', '.'])
+        call.assert_called_once_with(['7z', 'a', '-tzip', 'foo', '.'],
+                                     cwd=None)
 
         call.reset_mock()
         call.return_value = 1
         self.assertFalse(arch.extract('foo'))
-        call.assert_called_once_with(['7z', 'x', 'foo'])
+        call.assert_called_once_with(['7z', 'x', 'foo'], cwd=None)
 
         which.side_effect = ['zip', 'unzip']
         arch = file_archive.ZipArchive()
@@ -224,7 +683,7 @@ class TestArchive(TestCase):
         self.assertEqual(arch._decompress, 'unzip')
 
     @mock.patch('fs_uae_wrapper.path.which')
-    @mock.patch('subprocess.call')
+    @mock.patch('fs_uae_wrapper.process.call')
     def test_rar(self, call, which):
 
         which.return_value = 'rar'
@@ -234,7 +693,7 @@ class TestArchive(TestCase):
         call.return_value = 0
 
         self.assertTrue(arch.create('foo'))
-        call.assert_called_once_with(['rar', 'a', 'foo'])
+        call.assert_called_once_with(['rar', 'a', 'foo'], cwd=None)
 
         call.reset_mock()
         for fname in ('foo', 'bar', 'baz'):
@@ -245,20 +704,20 @@ class TestArchive(TestCase):
             fobj.write('\n')
         self.assertTrue(arch.create('foo.rar'))
         call.assert_called_once_with(['rar', 'a', 'foo.rar', 'bar', 'baz',
-                                      'directory', 'foo'])
+                                      'directory', 'foo'], cwd=None)
 
         call.return_value = 1
         call.reset_mock()
         self.assertFalse(arch.create('foo.rar'))
         call.assert_called_once_with(['rar', 'a', 'foo.rar', 'bar', 'baz',
-                                      'directory', 'foo'])
+                                      'directory', 'foo'], cwd=None)
 
         with open('foo', 'w') as fobj:
             fobj.write('\n')
 
         call.reset_mock()
         self.assertFalse(arch.extract('foo'))
-        call.assert_called_once_with(['rar', 'x', 'foo'])
+        call.assert_called_once_with(['rar', 'x', 'foo'], cwd=None)
 
         call.reset_mock()
         call.return_value = 0
@@ -270,7 +729,120 @@ class TestArchive(TestCase):
         call.reset_mock()
         call.return_value = 1
         self.assertFalse(arch.extract('foo'))
-        call.assert_called_once_with(['unrar', 'x', 'foo'])
+        call.assert_called_once_with(['unrar', 'x', 'foo'], cwd=None)
+
+
+    def test_list_native(self):
+        os.makedirs('dir/sub')
+        with open('dir/sub/file', 'w') as fobj:
+            fobj.write('12345')
+        with open('file2', 'w') as fobj:
+            fobj.write('123')
+
+        for name in ('arch.tar.gz', 'arch.zip'):
+            arch = file_archive.get_archiver(name)
+            self.assertTrue(arch.create(name, ['dir', 'file2']))
+            self.assertEqual(sorted(arch.list(name)),
+                             [('dir/sub/file', 5), ('file2', 3)])
+
+        self.assertIsNone(arch.list('nonexistent.zip'))
+        with open('broken.zip', 'w') as fobj:
+            fobj.write('foo')
+        self.assertIsNone(arch.list('broken.zip'))
+
+    def test_extract_files_native(self):
+        os.makedirs('dir/sub')
+        for fname in ('dir/sub/file', 'file2', 'file3'):
+            with open(fname, 'w') as fobj:
+                fobj.write(fname)
+
+        for name in ('arch.tar', 'arch.zip'):
+            arch = file_archive.get_archiver(name)
+            self.assertTrue(arch.create(name, ['dir', 'file2', 'file3']))
+            os.mkdir('out')
+            os.chdir('out')
+            self.assertTrue(arch.extract(os.path.join('..', name),
+                                         ['dir/sub/file', 'file3']))
+            self.assertEqual(sorted(os.listdir('.')), ['dir', 'file3'])
+            self.assertTrue(os.path.exists('dir/sub/file'))
+            self.assertFalse(arch.extract(os.path.join('..', name),
+                                          ['nonexistent']))
+            os.chdir('..')
+            shutil.rmtree('out')
+
+            self.assertEqual(arch.read(name, 'file2'), b'file2')
+            self.assertIsNone(arch.read(name, 'nonexistent'))
+
+    @mock.patch('fs_uae_wrapper.path.which')
+    @mock.patch('subprocess.run')
+    def test_read(self, run, which):
+        which.return_value = 'lzx'
+        arch = file_archive.LzxArchive()
+        self.assertIsNone(arch.read('arch', 'file'))
+        run.assert_not_called()
+
+        which.return_value = '7z'
+        arch = file_archive.SevenZArchive()
+        run.return_value.returncode = 0
+        run.return_value.stdout = b'contents'
+        self.assertEqual(arch.read('arch', 'dir/file'), b'contents')
+        run.assert_called_once_with(['7z', 'e', '-so', 'arch', 'dir/file'],
+                                    stdout=mock.ANY, stderr=mock.ANY)
+
+        run.return_value.returncode = 2
+        self.assertIsNone(arch.read('arch', 'dir/file'))
+
+    @mock.patch('fs_uae_wrapper.path.which')
+    @mock.patch('subprocess.run')
+    def test_list(self, run, which):
+        with open('arch', 'w') as fobj:
+            fobj.write('\n')
+
+        which.return_value = 'lzx'
+        arch = file_archive.LzxArchive()
+        self.assertIsNone(arch.list('arch'))
+        run.assert_not_called()
+
+        run.return_value.returncode = 1
+        which.return_value = 'tar'
+        arch = file_archive.TarArchive()
+        self.assertIsNone(arch.list('arch'))
+        run.assert_called_once_with(['tar', 'tvf', 'arch'],
+                                    stdout=mock.ANY, stderr=mock.ANY)
+
+        run.return_value.returncode = 0
+        run.return_value.stdout = (
+            b'drwxr-xr-x user/users     0 2020-01-01 12:00 dir/\n'
+            b'-rw-r--r-- user/users   123 2020-01-01 12:00 dir/a file\n'
+            b'lrwxrwxrwx user/users     0 2020-01-01 12:00 dir/l -> a\n')
+        self.assertEqual(arch.list('arch'), [('dir/a file', 123)])
+
+        which.return_value = '7z'
+        arch = file_archive.SevenZArchive()
+        run.return_value.stdout = (
+            b'Listing archive: arch\n\n--\nPath = arch\nType = 7z\n\n'
+            b'----------\nPath = dir\nSize = 0\nAttributes = D_ drwxr-xr-x'
+            b'\n\nPath = dir/file\nSize = 42\nAttributes = A_ -rw-r--r--'
+            b'\n\n')
+        self.assertEqual(arch.list('arch'), [('dir/file', 42)])
+
+        which.return_value = 'unrar'
+        arch = file_archive.RarArchive()
+        run.return_value.stdout = (
+            b'Archive: arch\nDetails: RAR 5\n\n'
+            b'        Name: dir/file\n        Type: File\n'
+            b'        Size: 7\n\n'
+            b'        Name: dir\n        Type: Directory\n\n')
+        self.assertEqual(arch.list('arch'), [('dir/file', 7)])
+
+        which.return_value = 'lha'
+        arch = file_archive.LhaArchive()
+        run.return_value.stdout = (
+            b'[generic]              1234  55.5% Jan 01  2020 dir/file\n'
+            b'-rw-r--r-- 1000/1000     99 100.0% Jan 01 12:00 file 2\n'
+            b'drwxr-xr-x 1000/1000      0 ****** Jan 01 12:00 dir/\n')
+        self.assertEqual(arch.list('arch'), [('dir/file', 1234),
+                                             ('file 2', 99)])
 
 
 class TestArchivers(TestCase):
@@ -286,6 +858,12 @@ class TestArchivers(TestCase):
                          file_archive.TarBzip2Archive)
         self.assertEqual(file_archive.Archivers.get('tar.xz'),
                          file_archive.TarXzArchive)
+        self.assertEqual(file_archive.Archivers.get('tar.zst'),
+                         file_archive.TarZstdArchive)
+        self.assertEqual(file_archive.Archivers.get('tzst'),
+                         file_archive.TarZstdArchive)
+        self.assertEqual(file_archive.Archivers.get('tar.lz4'),
+                         file_archive.TarLz4Archive)
         self.assertEqual(file_archive.Archivers.get('rar'),
                          file_archive.RarArchive)
         self.assertEqual(file_archive.Archivers.get('7z'),
@@ -298,6 +876,27 @@ class TestArchivers(TestCase):
                          file_archive.LzxArchive)
         self.assertIsNone(file_archive.Archivers.get('ace'))
 
+    def test_get_native(self):
+        self.assertEqual(file_archive.Archivers.get_native('tar'),
+                         file_archive.NativeTarArchive)
+        self.assertEqual(file_archive.Archivers.get_native('tgz'),
+                         file_archive.NativeTarGzipArchive)
+        self.assertEqual(file_archive.Archivers.get_native('zip'),
+                         file_archive.NativeZipArchive)
+        self.assertIsNone(file_archive.Archivers.get_native('7z'))
+        self.assertIsNone(file_archive.Archivers.get_native('ace'))
+
+    @mock.patch('fs_uae_wrapper.path.which')
+    def test_is_available(self, which):
+        which.return_value = None
+        self.assertTrue(file_archive.Archivers.is_available('tar.xz'))
+        self.assertTrue(file_archive.Archivers.is_available('zip'))
+        self.assertFalse(file_archive.Archivers.is_available('7z'))
+        self.assertFalse(file_archive.Archivers.is_available('ace'))
+
+        which.return_value = '7z'
+        self.assertTrue(file_archive.Archivers.is_available('7z'))
+
     def test_get_extension_by_name(self):
         archivers = file_archive.Archivers
         self.assertEqual(archivers.get_extension_by_name('tar'), '.tar')
@@ -305,6 +904,8 @@ class TestArchivers(TestCase):
         self.assertEqual(archivers.get_extension_by_name('tar.bz2'),
                          '.tar.bz2')
         self.assertEqual(archivers.get_extension_by_name('tar.xz'), '.tar.xz')
+        self.assertEqual(archivers.get_extension_by_name('zst'), '.tar.zst')
+        self.assertEqual(archivers.get_extension_by_name('lz4'), '.tar.lz4')
         self.assertEqual(archivers.get_extension_by_name('rar'), '.rar')
         self.assertEqual(archivers.get_extension_by_name('7z'), '.7z')
         self.assertEqual(archivers.get_extension_by_name('lha'), '.lha')
@@ -0,0 +1,72 @@
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase, mock
+
+from fs_uae_wrapper import history
+
+
+class TestHistory(TestCase):
+
+    def setUp(self):
+        self.dirname = mkdtemp()
+        self._env = mock.patch.dict(os.environ,
+                                    {'XDG_STATE_HOME': self.dirname})
+        self._env.start()
+        self.configs = {}
+        for name in ('A', 'B', 'C', 'D', 'E'):
+            self.configs[name] = os.path.join(self.dirname, name + '.fs-uae')
+            open(self.configs[name], 'w').close()
+
+    def tearDown(self):
+        self._env.stop()
+        shutil.rmtree(self.dirname)
+
+    def _history(self, names):
+        return [{'config': self.configs[name], 'time': 0} for name in names]
+
+    def test_record(self):
+        self.assertEqual(history.load(), [])
+        self.assertTrue(history.record(self.configs['A']))
+        self.assertTrue(history.record(self.configs['B']))
+        self.assertEqual([entry['config'] for entry in history.load()],
+                         [self.configs['A'], self.configs['B']])
+
+        with mock.patch('fs_uae_wrapper.history.MAX_ENTRIES', 1):
+            history.record(self.configs['C'])
+        self.assertEqual([entry['config'] for entry in history.load()],
+                         [self.configs['C']])
+
+    def test_get_playlist(self):
+        self.assertEqual(history.get_playlist(self.configs['A']),
+                         [self.configs[name] for name in 'ABCDE'])
+
+        playlist = os.path.join(self.dirname, 'playlist.txt')
+        with open(playlist, 'w') as fobj:
+            fobj.write('E.fs-uae\nA.fs-uae\n')
+        self.assertEqual(history.get_playlist(self.configs['A'], playlist),
+                         [self.configs['E'], self.configs['A']])
+        self.assertEqual(history.get_playlist(self.configs['A'],
+                                              playlist + '.missing'), [])
+
+    def test_get_candidates(self):
+        # playlist neighbours only, closer ones first
+        self.assertEqual(history.get_candidates(
+            self.configs['C'], [], list(self.configs.values()), 3),
+            [self.configs['B'], self.configs['D'], self.configs['A']])
+
+        # game which was launched after this one before wins
+        self.assertEqual(history.get_candidates(
+            self.configs['A'], self._history('AEDAEDD'), [], 2),
+            [self.configs['E'], self.configs['D']])
+
+        # recently launched games
+        self.assertEqual(history.get_candidates(
+            self.configs['A'], self._history('BC'), [], 5),
+            [self.configs['C'], self.configs['B']])
+
+        # configurations which don't exist anymore are skipped
+        os.unlink(self.configs['C'])
+        self.assertEqual(history.get_candidates(
+            self.configs['A'], self._history('BC'), [], 5),
+            [self.configs['B']])
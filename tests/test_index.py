@@ -0,0 +1,113 @@
+import io
+import os
+import shutil
+import sqlite3
+from tempfile import mkdtemp
+from unittest import TestCase, mock
+
+from fs_uae_wrapper import index
+
+
+class TestIndex(TestCase):
+
+    def setUp(self):
+        self.dirname = mkdtemp()
+        self.games = os.path.join(self.dirname, 'games')
+        self.db = os.path.join(self.dirname, 'state', 'index.sqlite')
+        os.makedirs(os.path.join(self.games, 'cd32'))
+        self._write('Turrican.fs-uae', '[config]\nwrapper = archive\n')
+        self._write('Turrican.tar.ZST', 'x' * 10)
+        self._write('Turrican_save.7z', '')
+        self._write('Other.fs-uae', '[config]\nwrapper = whdload\n'
+                    'wrapper_archive = foo/Other.lha\n')
+        self._write('Broken.fs-uae', 'foo\n')
+        self._write('cd32/Chaos.fs-uae', '[config]\nwrapper = cd32\n')
+        self._write('cd32/Chaos.7z', 'x')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def _write(self, name, contents):
+        with open(os.path.join(self.games, name), 'w') as fobj:
+            fobj.write(contents)
+
+    def _update(self):
+        out = io.StringIO()
+        self.assertTrue(index.update(self.db, self.games, out))
+        return out.getvalue()
+
+    def _get_rows(self):
+        conn = sqlite3.connect(self.db)
+        rows = {os.path.relpath(row[0], self.games): row[1:] for row in
+                conn.execute('SELECT path, wrapper, archive, format, size '
+                             'FROM configs')}
+        conn.close()
+        return rows
+
+    @mock.patch('fs_uae_wrapper.persist.get_state_dir')
+    def test_get_db_path(self, get_state_dir):
+        get_state_dir.return_value = '/state'
+        self.assertEqual(index.get_db_path(), '/state/index.sqlite')
+        self.assertEqual(index.get_db_path('/tmp/i.db'), '/tmp/i.db')
+
+    def test_find_archive(self):
+        names = index.get_names_map(['Game.fs-uae', 'game.zip', 'Game.ZIP',
+                                     'Game.7z', 'Game_save.7z'])
+        self.assertEqual(index.find_archive('Game', names), 'Game.7z')
+        self.assertEqual(index.find_archive('game', names), 'game.zip')
+        self.assertIsNone(index.find_archive('Foo', names))
+
+    def test_update(self):
+        self.assertIn('3 configurations', self._update())
+        self.assertEqual(self._get_rows(),
+                         {'Turrican.fs-uae': ('archive', 'Turrican.tar.ZST',
+                                              'zst', 10),
+                          'Other.fs-uae': ('whdload', 'foo/Other.lha', 'lha',
+                                           None),
+                          'cd32/Chaos.fs-uae': ('cd32', 'Chaos.7z', '7z',
+                                                1)})
+
+        # nothing has changed
+        self.assertIn('2 directories (0 scanned, 0 configurations read)',
+                      self._update())
+
+        # new archive in the directory, only configuration which couldn't
+        # be indexed is read again
+        os.unlink(os.path.join(self.games, 'Turrican.tar.ZST'))
+        self._write('Turrican.zip', 'xx')
+        self.assertIn('(1 scanned, 1 configurations read)', self._update())
+        self.assertEqual(self._get_rows()['Turrican.fs-uae'],
+                         ('archive', 'Turrican.zip', 'zip', 2))
+
+        # removed directory
+        shutil.rmtree(os.path.join(self.games, 'cd32'))
+        self.assertIn('2 configurations', self._update())
+        self.assertNotIn('cd32/Chaos.fs-uae', self._get_rows())
+
+        out = io.StringIO()
+        self.assertFalse(index.update(self.db, '/nonexistent', out))
+
+    def test_get_archive_name(self):
+        conf = os.path.join(self.games, 'Turrican.fs-uae')
+        self.assertIsNone(index.get_archive_name(conf, self.db))
+
+        self._update()
+        self.assertEqual(index.get_archive_name(conf, self.db),
+                         'Turrican.tar.ZST')
+        # explicitly set archive is not looked up
+        self.assertIsNone(index.get_archive_name(
+            os.path.join(self.games, 'Other.fs-uae'), self.db))
+
+        # archive with preferred extension was added
+        open(os.path.join(self.games, 'Turrican.7z'), 'w').close()
+        self.assertIsNone(index.get_archive_name(conf, self.db))
+        self._update()
+        self.assertEqual(index.get_archive_name(conf, self.db),
+                         'Turrican.7z')
+
+        os.unlink(os.path.join(self.games, 'Turrican.7z'))
+        self.assertIsNone(index.get_archive_name(conf, self.db))
+
+        with open(self.db, 'w') as fobj:
+            fobj.write('not a database')
+        self.assertIsNone(index.get_archive_name(conf, self.db))
@@ -0,0 +1,145 @@
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase, mock
+
+from fs_uae_wrapper import digest, manifest
+
+
+class TestManifest(TestCase):
+
+    def setUp(self):
+        self.dirname = mkdtemp()
+        self.curdir = os.path.abspath(os.curdir)
+        os.chdir(self.dirname)
+
+    def tearDown(self):
+        os.chdir(self.curdir)
+        try:
+            shutil.rmtree(self.dirname)
+        except OSError:
+            pass
+
+    def test_get_manifest(self):
+        self.assertDictEqual(manifest.get_manifest('.'), {})
+
+        os.makedirs('C/empty')
+        with open('C/Assign', 'w') as fobj:
+            fobj.write('foo')
+        os.symlink('Assign', 'C/link')
+        os.utime('C/Assign', ns=(1, 2))
+
+        self.assertDictEqual(manifest.get_manifest(self.dirname),
+                             {'C': None,
+                              'C/empty': None,
+                              'C/Assign': [3, 2],
+                              'C/link': ['link', 'Assign']})
+
+    def test_exclude(self):
+        os.makedirs('data/saves')
+        os.makedirs('C')
+        for fname in ('Config.fs-uae', 'data/file', 'data/saves/state',
+                      'C/Assign'):
+            with open(fname, 'w') as fobj:
+                fobj.write('foo')
+
+        exclude = ['Config.fs-uae', 'data/saves/']
+        self.assertEqual(sorted(manifest.get_manifest('.', exclude)),
+                         ['C', 'C/Assign', 'data', 'data/file'])
+        self.assertEqual(manifest.get_paths('.', exclude),
+                         ['C', 'data/file'])
+        self.assertEqual(manifest.get_paths('.'),
+                         ['C', 'Config.fs-uae', 'data'])
+
+    def test_diff(self):
+        old = {'C': None,
+               'C/Assign': [3, 2],
+               'S': None,
+               'S/startup-sequence': [10, 2],
+               'Prefs': None,
+               'Prefs/Env': None,
+               'Prefs/Env/foo': [1, 1]}
+        self.assertEqual(manifest.diff(old, old), ([], [], []))
+
+        new = {'C': None,
+               'C/Assign': [3, 3],
+               'S': None,
+               'S/user-startup': [1, 1],
+               'Work': None,
+               'Work/game': None,
+               'Work/game/game.exe': [1, 1]}
+        self.assertEqual(manifest.diff(old, new),
+                         (['S/user-startup', 'Work'],
+                          ['C/Assign'],
+                          ['Prefs', 'S/startup-sequence']))
+
+    def test_digests(self):
+        with open('arch.tar', 'w') as fobj:
+            fobj.write('archive')
+        digests = digest.Digests()
+        with mock.patch.dict(os.environ, {'XDG_STATE_HOME': self.dirname}):
+            self.assertIsNone(manifest.load_digests('arch.tar'))
+            self.assertFalse(manifest.store_digests('arch.tar', digests))
+
+            digests.archive = 'abcd'
+            digests.files = {'a': '1'}
+            self.assertTrue(manifest.store_digests('arch.tar', digests))
+            data = manifest.load_digests(os.path.abspath('arch.tar'))
+            self.assertEqual(data['archive'],
+                             os.path.join(self.dirname, 'arch.tar'))
+            self.assertEqual(data['digest'], 'abcd')
+            self.assertEqual(data['files'], {'a': '1'})
+
+            # file digests of the same archive contents are merged
+            digests.files = {'b': '2'}
+            self.assertTrue(manifest.store_digests('arch.tar', digests))
+            self.assertEqual(manifest.load_digests('arch.tar')['files'],
+                             {'a': '1', 'b': '2'})
+            digests.archive = 'efgh'
+            self.assertTrue(manifest.store_digests('arch.tar', digests))
+            self.assertEqual(manifest.load_digests('arch.tar')['files'],
+                             {'b': '2'})
+
+            # manifest is not valid for changed archive
+            with open('arch.tar', 'w') as fobj:
+                fobj.write('changed archive')
+            self.assertIsNone(manifest.load_digests('arch.tar'))
+            os.unlink('arch.tar')
+            self.assertIsNone(manifest.load_digests('arch.tar'))
+
+    @mock.patch('fs_uae_wrapper.utils.get_unpacked_size')
+    def test_get_unpacked_size(self, unpacked_size):
+        with open('arch.tar', 'w') as fobj:
+            fobj.write('archive')
+        unpacked_size.return_value = None
+        with mock.patch.dict(os.environ, {'XDG_STATE_HOME': self.dirname}):
+            self.assertIsNone(manifest.get_unpacked_size('missing.tar'))
+            self.assertIsNone(manifest.get_unpacked_size('arch.tar'))
+
+            # size is stored, and archive is not listed again
+            unpacked_size.return_value = 100
+            self.assertEqual(manifest.get_unpacked_size('arch.tar'), 100)
+            unpacked_size.return_value = 200
+            self.assertEqual(manifest.get_unpacked_size('arch.tar'), 100)
+            self.assertEqual(unpacked_size.call_count, 2)
+
+            # unless archive has changed
+            with open('arch.tar', 'w') as fobj:
+                fobj.write('changed archive')
+            self.assertEqual(manifest.get_unpacked_size('arch.tar'), 200)
+
+            # size stored after archive was written is used as well
+            self.assertTrue(manifest.store_unpacked_size('arch.tar', 300))
+            self.assertEqual(manifest.get_unpacked_size('arch.tar'), 300)
+            self.assertEqual(unpacked_size.call_count, 3)
+            self.assertFalse(manifest.store_unpacked_size('missing.tar', 1))
+
+    def test_get_tree_size(self):
+        os.makedirs('C/empty')
+        with open('C/Assign', 'w') as fobj:
+            fobj.write('foo')
+        with open('file', 'w') as fobj:
+            fobj.write('bar\n')
+        os.symlink('Assign', 'C/link')
+        self.assertEqual(manifest.get_tree_size(manifest.get_manifest('.')),
+                         7)
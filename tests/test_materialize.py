@@ -0,0 +1,96 @@
+import errno
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase, mock
+
+from fs_uae_wrapper import materialize
+
+
+class TestMaterialize(TestCase):
+
+    def setUp(self):
+        self.dirname = mkdtemp()
+        self.curdir = os.path.abspath(os.curdir)
+        os.chdir(self.dirname)
+        os.makedirs('src/dir/sub')
+        with open('src/file', 'w') as fobj:
+            fobj.write('file')
+        with open('src/dir/sub/ro', 'w') as fobj:
+            fobj.write('read only')
+        os.chmod('src/dir/sub/ro', 0o444)
+        os.symlink('file', 'src/link')
+
+    def tearDown(self):
+        os.chdir(self.curdir)
+        try:
+            shutil.rmtree(self.dirname)
+        except OSError:
+            pass
+
+    def _check_tree(self):
+        with open('dst/file') as fobj:
+            self.assertEqual(fobj.read(), 'file')
+        with open('dst/dir/sub/ro') as fobj:
+            self.assertEqual(fobj.read(), 'read only')
+        self.assertEqual(os.readlink('dst/link'), 'file')
+        self.assertEqual(os.stat('dst/dir/sub/ro').st_mode & 0o777, 0o444)
+        self.assertEqual(os.stat('dst/file').st_mtime,
+                         os.stat('src/file').st_mtime)
+
+    def test_materialize(self):
+        stats = materialize.materialize('src', 'dst')
+        self._check_tree()
+        self.assertEqual(sum(stats.values()), 2)
+
+    def test_existing(self):
+        os.makedirs('dst/dir/sub')
+        for fname in ('dst/file', 'dst/dir/sub/ro'):
+            with open(fname, 'w') as fobj:
+                fobj.write('old')
+        os.symlink('dir', 'dst/link')
+
+        materialize.materialize('src', 'dst')
+        self._check_tree()
+
+    def test_is_read_only(self):
+        # owner can always make the file writable
+        self.assertFalse(materialize.is_read_only('src/dir/sub/ro'))
+        with mock.patch('os.geteuid', return_value=os.getuid() + 1):
+            self.assertTrue(materialize.is_read_only('src/dir/sub/ro'))
+            self.assertFalse(materialize.is_read_only('src/file'))
+
+    @mock.patch('os.geteuid')
+    @mock.patch('fs_uae_wrapper.materialize.reflink')
+    def test_fallbacks(self, reflink, geteuid):
+        # files in the source tree belong to other user
+        geteuid.return_value = os.getuid() + 1
+        reflink.side_effect = OSError(errno.EOPNOTSUPP, 'not supported')
+        materializer = materialize.Materializer()
+        materializer.copy_tree('src', 'dst')
+        self._check_tree()
+
+        # reflink is tried only once
+        reflink.assert_called_once()
+        self.assertEqual(materializer.stats['reflink'], 0)
+        self.assertEqual(materializer.stats['hardlink'], 1)
+        self.assertEqual(os.stat('dst/dir/sub/ro').st_ino,
+                         os.stat('src/dir/sub/ro').st_ino)
+        self.assertNotEqual(os.stat('dst/file').st_ino,
+                            os.stat('src/file').st_ino)
+
+    @mock.patch('os.link')
+    @mock.patch('fs_uae_wrapper.materialize.copy_range')
+    @mock.patch('fs_uae_wrapper.materialize.reflink')
+    def test_copy(self, reflink, copy_range, link):
+        reflink.side_effect = OSError(errno.EXDEV, 'cross device')
+        copy_range.side_effect = OSError(errno.ENOSYS, 'no syscall')
+        link.side_effect = OSError(errno.EXDEV, 'cross device')
+
+        stats = materialize.materialize('src', 'dst')
+        self._check_tree()
+        self.assertEqual(stats['copy'], 2)
+
+        # other errors are not hidden
+        reflink.side_effect = OSError(errno.ENOSPC, 'no space')
+        self.assertRaises(OSError, materialize.materialize, 'src', 'dst2')
@@ -0,0 +1,104 @@
+import os
+import shutil
+import zipfile
+from tempfile import mkdtemp
+from unittest import TestCase, mock
+
+from fs_uae_wrapper import members
+
+
+class TestMembers(TestCase):
+
+    def setUp(self):
+        self.dirname = mkdtemp()
+        self.curdir = os.path.abspath(os.curdir)
+        os.chdir(self.dirname)
+
+    def tearDown(self):
+        os.chdir(self.curdir)
+        try:
+            shutil.rmtree(self.dirname)
+        except OSError:
+            pass
+
+    def test_get_globs(self):
+        self.assertEqual(members.get_globs(None), [])
+        self.assertEqual(members.get_globs(''), [])
+        self.assertEqual(members.get_globs('*.txt, docs/* ,'),
+                         ['*.txt', 'docs/*'])
+
+    def test_get_referenced(self):
+        options = {'cdrom_drive_0': '$WRAPPER/Game/game.cue',
+                   'floppy_image_1': '$WRAPPER/disk2.adf',
+                   'hard_drive_0': '$WRAPPER/',
+                   'hard_drive_1': '$CONFIG/hd',
+                   'cdrom_drive_count': '1',
+                   'title': '$WRAPPER/foo'}
+        self.assertEqual(sorted(members.get_referenced(options)),
+                         ['.', 'Game/game.cue', 'disk2.adf'])
+
+    def test_get_cue_tracks(self):
+        contents = ('FILE "Track 01.bin" BINARY\n'
+                    '  TRACK 01 MODE1/2352\n'
+                    'file track02.wav WAVE\n')
+        self.assertEqual(members.get_cue_tracks('cd/game.cue', contents),
+                         ['cd/Track 01.bin', 'cd/track02.wav'])
+        self.assertEqual(members.get_cue_tracks('game.cue', contents),
+                         ['Track 01.bin', 'track02.wav'])
+
+    def test_select(self):
+        files = [('Game/game.cue', 1), ('Game/Track01.bin', 2),
+                 ('Game/Manual.pdf', 3), ('HD/s/startup', 4),
+                 ('readme.txt', 5)]
+
+        self.assertEqual(members.select(files, ['game/GAME.cue']),
+                         [('Game/game.cue', 1)])
+        self.assertEqual(members.select(files, ['HD']), [('HD/s/startup', 4)])
+        self.assertEqual(members.select(files, ['HD/s/start']), [])
+        self.assertEqual(members.select(files, ['.']), files)
+        self.assertEqual(members.select(files, ['Game'], ['*.txt'],
+                                        ['*.pdf']),
+                         [('Game/game.cue', 1), ('Game/Track01.bin', 2),
+                          ('readme.txt', 5)])
+
+    def test_get_members(self):
+        with zipfile.ZipFile('game.zip', 'w') as zip_:
+            zip_.writestr('CD/Game.cue', 'FILE "Game.bin" BINARY\n'
+                          'FILE "Track 02.wav" WAVE\n')
+            zip_.writestr('CD/Game.bin', '1234')
+            zip_.writestr('CD/Track 02.wav', '12')
+            zip_.writestr('CD/Alternate.bin', '1234')
+            zip_.writestr('Scans/cover.jpg', '123')
+
+        options = {'cdrom_drive_0': '$WRAPPER/CD/Game.cue'}
+        self.assertIsNone(members.get_members('game.zip', options))
+
+        options['wrapper_extract_exclude'] = '*.jpg'
+        self.assertEqual(len(members.get_members('game.zip', options)), 4)
+
+        options['wrapper_selective_extract'] = '1'
+        self.assertEqual(members.get_members('game.zip', options),
+                         [('CD/Game.cue', 48), ('CD/Game.bin', 4),
+                          ('CD/Track 02.wav', 2)])
+
+        options['wrapper_extract_include'] = 'Scans/*'
+        options['wrapper_extract_exclude'] = ''
+        self.assertEqual(len(members.get_members('game.zip', options)), 4)
+
+        # all the files selected
+        options['wrapper_extract_include'] = '*'
+        self.assertIsNone(members.get_members('game.zip', options))
+
+        # nothing selected
+        options = {'wrapper_selective_extract': '1',
+                   'cdrom_drive_0': '$WRAPPER/foo.cue'}
+        self.assertIsNone(members.get_members('game.zip', options))
+
+        options['wrapper_persist_data'] = '1'
+        with mock.patch('fs_uae_wrapper.utils.list_archive') as list_archive:
+            self.assertIsNone(members.get_members('game.zip', options))
+            list_archive.assert_not_called()
+
+        self.assertIsNone(members.get_members('nonexistent.zip',
+                                              {'wrapper_selective_extract':
+                                               '1'}))
@@ -0,0 +1,97 @@
+import io
+import json
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase, mock
+
+from fs_uae_wrapper import metrics
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        self.dirname = mkdtemp()
+        self.db = os.path.join(self.dirname, 'state', 'metrics.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    @mock.patch('fs_uae_wrapper.persist.get_state_dir')
+    def test_get_db_path(self, get_state_dir):
+        get_state_dir.return_value = '/state'
+        self.assertEqual(metrics.get_db_path('1'), '/state/metrics.sqlite')
+        self.assertEqual(metrics.get_db_path(None), '/state/metrics.sqlite')
+        self.assertEqual(metrics.get_db_path('/tmp/m.db'), '/tmp/m.db')
+
+    def test_get_record(self):
+        arch = os.path.join(self.dirname, 'Game.tar.zst')
+        with open(arch, 'wb') as fobj:
+            fobj.write(b'x' * 10)
+
+        events = [{'name': 'extract_archive', 'ts': 100000, 'dur': 500000},
+                  {'name': 'extract_archive', 'ts': 100000, 'dur': 250000},
+                  {'name': 'emulator', 'ts': 1000000, 'dur': 30000000}]
+        record = metrics.get_record('Game.fs-uae', 'archive', arch, True,
+                                    events, 33000000)
+        self.assertEqual(record['config'], os.path.abspath('Game.fs-uae'))
+        self.assertEqual(record['format'], 'zst')
+        self.assertEqual(record['size'], 10)
+        self.assertEqual(record['result'], 1)
+        self.assertEqual(record['launch'], 1)
+        self.assertEqual(record['exit'], 2)
+        self.assertEqual(json.loads(record['phases']),
+                         {'extract_archive': 0.75, 'emulator': 30})
+
+        record = metrics.get_record('Game.fs-uae', 'plain', None, False,
+                                    [], 1000)
+        self.assertIsNone(record['format'])
+        self.assertIsNone(record['size'])
+        self.assertIsNone(record['launch'])
+        self.assertEqual(record['result'], 0)
+
+    def test_percentile(self):
+        self.assertIsNone(metrics.percentile([], 50))
+        self.assertEqual(metrics.percentile([3], 95), 3)
+        self.assertEqual(metrics.percentile([4, 1, 3, 2], 50), 2.5)
+        self.assertAlmostEqual(metrics.percentile(range(1, 101), 95), 95.05)
+
+    def test_get_title(self):
+        self.assertEqual(metrics.get_title('/games/Turrican.fs-uae'),
+                         'Turrican')
+        self.assertEqual(metrics.get_title('/games/Turrican/Config.fs-uae'),
+                         'Turrican')
+
+    def test_record_and_report(self):
+        out = io.StringIO()
+        self.assertFalse(metrics.report(self.db, out))
+
+        for config, arch_format, launch in (('/g/A.fs-uae', 'zip', 1),
+                                            ('/g/A.fs-uae', 'zip', 3),
+                                            ('/g/B.fs-uae', '7z', 10)):
+            self.assertTrue(metrics.record(self.db, {
+                'time': 0, 'config': config, 'wrapper': 'archive',
+                'format': arch_format, 'size': 1, 'result': 1,
+                'launch': launch, 'exit': 0.5, 'phases': '{}'}))
+        # failed and not launched runs are not part of the statistics
+        metrics.record(self.db, {'time': 0, 'config': '/g/C.fs-uae',
+                                 'wrapper': 'plain', 'format': None,
+                                 'size': None, 'result': 0, 'launch': None,
+                                 'exit': None, 'phases': '{}'})
+
+        conn = metrics.connect(self.db)
+        self.assertEqual(metrics.get_stats(conn, 'config'),
+                         [('/g/B.fs-uae', 1, 10, 10, 0.5, 0.5),
+                          ('/g/A.fs-uae', 2, 2, 2.9, 0.5, 0.5)])
+        self.assertEqual([item[0] for item in metrics.get_stats(conn,
+                                                                'format')],
+                         ['7z', 'zip'])
+        conn.close()
+
+        self.assertTrue(metrics.report(self.db, out))
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('game'))
+        self.assertTrue(lines[1].startswith('B '))
+        self.assertIn('format', lines[4])
+
+        self.assertFalse(metrics.record(os.path.join(self.db, 'foo'), {}))
@@ -1,4 +1,5 @@
-from unittest import TestCase
+import os
+from unittest import TestCase, mock
 
 from fs_uae_wrapper import path
 
@@ -10,3 +11,23 @@ class TestPath(TestCase):
         self.assertIsNone(path.which('blahblahexec'))
         self.assertEqual(path.which(['blahblahexec', 'pip', 'sh']),
                          'pip')
+        self.assertEqual(path.which(('blahblahexec', 'sh')), 'sh')
+
+    @mock.patch.dict(path._LOOKUPS, clear=True)
+    @mock.patch('fs_uae_wrapper.path._find')
+    def test_which_lookups(self, find):
+        find.return_value = True
+        self.assertEqual(path.which('sh'), 'sh')
+        self.assertEqual(path.which('sh'), 'sh')
+        find.assert_called_once_with('sh')
+        self.assertEqual(path.get_lookups(), {'sh': True})
+
+        path.add_lookups({'7z': False})
+        self.assertIsNone(path.which('7z'))
+        find.assert_called_once()
+
+        # lookups are made again for different PATH
+        with mock.patch.dict(os.environ, {'PATH': '/foo'}):
+            self.assertEqual(path.get_lookups(), {})
+            path.which('sh')
+        self.assertEqual(find.call_count, 2)
@@ -0,0 +1,122 @@
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase, mock
+
+from fs_uae_wrapper import persist, savestate, utils
+
+
+class TestPersist(TestCase):
+
+    def setUp(self):
+        self.dirname = mkdtemp()
+        self.curdir = os.path.abspath(os.curdir)
+        os.chdir(self.dirname)
+        self.env = mock.patch.dict(os.environ, {'XDG_STATE_HOME':
+                                                self.dirname})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        os.chdir(self.curdir)
+        try:
+            shutil.rmtree(self.dirname)
+        except OSError:
+            pass
+
+    def test_get_paths(self):
+        state_dir = os.path.join(self.dirname, 'fs-uae-wrapper')
+        self.assertEqual(persist.get_state_dir(), state_dir)
+
+        lock = persist.get_lock_path('foo.7z')
+        self.assertEqual(os.path.dirname(lock), state_dir)
+        self.assertTrue(lock.endswith('.lock'))
+        self.assertEqual(lock,
+                         persist.get_lock_path(os.path.abspath('foo.7z')))
+        self.assertNotEqual(lock, persist.get_lock_path('bar.7z'))
+        self.assertEqual(persist.get_status_path('foo.7z')[:-7], lock[:-5])
+
+    @mock.patch('logging.warning')
+    def test_wait_for(self, warning):
+        persist.wait_for('foo.7z')
+        warning.assert_not_called()
+
+        os.makedirs(persist.get_state_dir())
+        open(persist.get_lock_path('foo.7z'), 'w').close()
+        persist.set_status(['foo.7z'], 'done')
+        persist.wait_for('foo.7z')
+        warning.assert_not_called()
+
+        persist.set_status(['foo.7z'], 'failed', error='oops')
+        persist.wait_for('foo.7z')
+        warning.assert_called_once()
+
+    @mock.patch('subprocess.Popen')
+    def test_spawn(self, popen):
+        runner = savestate.Wrapper('Config.fs-uae', utils.CmdOption(), {})
+        runner.dir = mkdtemp(dir=self.dirname)
+
+        self.assertTrue(persist.spawn(runner, ['foo_save.7z']))
+        job = runner.dir + '.job'
+        self.assertEqual(popen.call_args[0][0][-1], job)
+        self.assertEqual(utils.read_json(job)['class'], 'Wrapper')
+        self.assertEqual(utils.read_json(job)['targets'], ['foo_save.7z'])
+        self.assertEqual(persist.get_status('foo_save.7z')['status'],
+                         'pending')
+
+        # lock was released in the parent process
+        with utils.lock_file(persist.get_lock_path('foo_save.7z'),
+                             blocking=False) as locked:
+            self.assertTrue(locked)
+
+        popen.side_effect = OSError('boom')
+        self.assertFalse(persist.spawn(runner, ['foo_save.7z']))
+        self.assertFalse(os.path.exists(job))
+        self.assertEqual(persist.get_status('foo_save.7z')['status'],
+                         'failed')
+
+        # locks are released, if job cannot be written
+        popen.reset_mock()
+        popen.side_effect = None
+        with mock.patch('fs_uae_wrapper.utils.write_json',
+                        side_effect=OSError('no space left')):
+            self.assertFalse(persist.spawn(runner, ['foo_save.7z']))
+        popen.assert_not_called()
+        self.assertTrue(os.path.isdir(runner.dir))
+        with utils.lock_file(persist.get_lock_path('foo_save.7z'),
+                             blocking=False) as locked:
+            self.assertTrue(locked)
+
+    @mock.patch('logging.basicConfig')
+    @mock.patch('fs_uae_wrapper.savestate.Wrapper._persist')
+    def test_main(self, persist_, basic_config):
+        os.makedirs(persist.get_state_dir())
+        self.assertEqual(persist.main('nonexistent.job'), 1)
+
+        runner = savestate.Wrapper('Config.fs-uae',
+                                   utils.CmdOption({'foo': 'bar'}), {})
+        runner.dir = mkdtemp(dir=self.dirname)
+        job = runner.dir + '.job'
+        utils.write_json(job, {'module': 'fs_uae_wrapper.savestate',
+                               'class': 'Wrapper',
+                               'state': persist.get_state(runner),
+                               'targets': ['foo_save.7z']})
+
+        persist_.return_value = True
+        self.assertEqual(persist.main(job), 0)
+        self.assertFalse(os.path.exists(job))
+        self.assertFalse(os.path.exists(runner.dir))
+        self.assertEqual(persist.get_status('foo_save.7z')['status'], 'done')
+
+        runner.dir = mkdtemp(dir=self.dirname)
+        job = runner.dir + '.job'
+        utils.write_json(job, {'module': 'fs_uae_wrapper.savestate',
+                               'class': 'Wrapper',
+                               'state': persist.get_state(runner),
+                               'targets': ['foo_save.7z']})
+        persist_.side_effect = OSError('disk full')
+        self.assertEqual(persist.main(job), 1)
+        self.assertFalse(os.path.exists(runner.dir))
+        status = persist.get_status('foo_save.7z')
+        self.assertEqual(status['status'], 'failed')
+        self.assertEqual(status['error'], 'disk full')
@@ -0,0 +1,106 @@
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase, mock
+
+from fs_uae_wrapper import path, plan, utils
+
+
+class TestPlan(TestCase):
+
+    def setUp(self):
+        self.dirname = mkdtemp()
+        self.curdir = os.path.abspath(os.curdir)
+        os.chdir(self.dirname)
+        self.conf = os.path.join(self.dirname, 'Game.fs-uae')
+        with open(self.conf, 'w') as fobj:
+            fobj.write('[config]\nwrapper = archive\n')
+        self._env = mock.patch.dict(os.environ,
+                                    {'XDG_STATE_HOME': self.dirname})
+        self._env.start()
+
+    def tearDown(self):
+        self._env.stop()
+        os.chdir(self.curdir)
+        shutil.rmtree(self.dirname)
+
+    def test_get(self):
+        func = mock.Mock(return_value={'foo': 'bar'})
+
+        # disabled plan always computes values
+        disabled = plan.Plan()
+        self.assertEqual(disabled.get('conf', func), {'foo': 'bar'})
+        self.assertEqual(disabled.get('conf', func), {'foo': 'bar'})
+        self.assertEqual(func.call_count, 2)
+        self.assertTrue(disabled.save())
+
+        launch_plan = plan.load(self.conf, utils.CmdOption())
+        self.assertEqual(launch_plan.get('conf', func, [self.conf]),
+                         {'foo': 'bar'})
+        self.assertEqual(launch_plan.get('conf', func), {'foo': 'bar'})
+        self.assertEqual(func.call_count, 3)
+
+        # None is not stored
+        func.return_value = None
+        self.assertIsNone(launch_plan.get('archive', func))
+        self.assertIsNone(launch_plan.get('archive', func))
+        self.assertEqual(func.call_count, 5)
+
+        # inputs may be extended by the function
+        inputs = []
+        launch_plan.get('options', lambda: inputs.append('foo') or {},
+                        inputs)
+        self.assertEqual(launch_plan.inputs, {self.conf: mock.ANY,
+                                              'foo': None})
+
+    def test_load_save(self):
+        options = utils.CmdOption({'fullscreen': '1'})
+        launch_plan = plan.load(self.conf, options)
+        self.assertEqual(launch_plan.data, {})
+        launch_plan.get('conf', lambda: {'foo': 'bar'}, [self.conf])
+        self.assertTrue(launch_plan.save())
+        self.assertTrue(os.path.exists(launch_plan.fname))
+
+        launch_plan = plan.load(self.conf, options)
+        self.assertEqual(launch_plan.data['conf'], {'foo': 'bar'})
+        self.assertIn('executables', launch_plan.data)
+        self.assertFalse(launch_plan.changed)
+
+        # different command line options
+        launch_plan = plan.load(self.conf, utils.CmdOption())
+        self.assertEqual(launch_plan.data, {})
+
+        # changed input file
+        os.utime(self.conf, ns=(0, 0))
+        launch_plan = plan.load(self.conf, options)
+        self.assertEqual(launch_plan.data, {})
+
+        # disabled by option
+        launch_plan = plan.load(self.conf, utils.CmdOption(
+            {'wrapper_plan_cache': '0'}))
+        self.assertIsNone(launch_plan.fname)
+
+        launch_plan = plan.Plan(os.path.join(self.conf, 'plan.json'), {})
+        launch_plan.changed = True
+        self.assertFalse(launch_plan.save())
+
+    def test_executables(self):
+        launch_plan = plan.load(self.conf, utils.CmdOption())
+        path.which('sh')
+        launch_plan.save()
+
+        with mock.patch.dict(path._LOOKUPS, clear=True):
+            launch_plan = plan.load(self.conf, utils.CmdOption())
+            self.assertTrue(path.get_lookups()['sh'])
+            with mock.patch('fs_uae_wrapper.path._find') as find:
+                self.assertEqual(path.which('sh'), 'sh')
+                find.assert_not_called()
+
+    def test_get_key(self):
+        with mock.patch.dict(os.environ, {'PATH': self.dirname + ':/foo'}):
+            key = plan.get_key('Game.fs-uae', {'foo': 'bar'})
+        self.assertEqual(key['config'], self.conf)
+        self.assertEqual(key['options'], {'foo': 'bar'})
+        self.assertEqual(key['path'],
+                         [[self.dirname, plan.get_mtime(self.dirname)],
+                          ['/foo', None]])
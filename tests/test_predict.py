@@ -0,0 +1,165 @@
+import os
+import shutil
+import signal
+import subprocess
+import sys
+from tempfile import mkdtemp
+from unittest import TestCase, mock
+
+from fs_uae_wrapper import cache, predict, utils
+
+
+class TestPredict(TestCase):
+
+    def setUp(self):
+        self.dirname = mkdtemp()
+        self._env = mock.patch.dict(os.environ,
+                                    {'XDG_STATE_HOME': self.dirname})
+        self._env.start()
+        self.job = {'config': os.path.join(self.dirname, 'A.fs-uae'),
+                    'options': {},
+                    'pid': os.getpid(),
+                    'count': 2,
+                    'size': 1,
+                    'io': 1,
+                    'pressure': 1,
+                    'threads': 1,
+                    'playlist': None}
+
+    def tearDown(self):
+        self._env.stop()
+        shutil.rmtree(self.dirname)
+
+    def test_get_number(self):
+        self.assertEqual(predict.get_number({}, 'wrapper_predict'), 0)
+        self.assertEqual(predict.get_number({'wrapper_predict': '3'},
+                                            'wrapper_predict'), 3)
+        self.assertEqual(predict.get_number({'wrapper_predict': '-3'},
+                                            'wrapper_predict'), 0)
+        self.assertEqual(predict.get_number({'wrapper_predict_io': 'lots'},
+                                            'wrapper_predict_io'), 8)
+
+    def test_processes(self):
+        stat = predict.get_proc_stat(os.getpid())
+        self.assertEqual(stat['ppid'], os.getppid())
+        self.assertIsNone(predict.get_proc_stat('nonexistent'))
+        self.assertTrue(predict.is_running(os.getpid()))
+
+        self.assertIsNone(predict.find_emulator(os.getpid()))
+        # emulator run by an interpreter
+        script = os.path.join(self.dirname, 'fs-uae')
+        with open(script, 'w') as fobj:
+            fobj.write('import sys\nsys.stdin.read()\n')
+        with subprocess.Popen([sys.executable, script],
+                              stdin=subprocess.PIPE) as proc:
+            self.assertIn(proc.pid, predict.get_processes(ppid=os.getpid()))
+            self.assertEqual(predict.find_emulator(os.getpid()), proc.pid)
+            proc.stdin.close()
+        self.assertFalse(predict.is_running(proc.pid))
+
+    @mock.patch('fs_uae_wrapper.predict.get_proc_stat')
+    @mock.patch('fs_uae_wrapper.process.read_io')
+    def test_io_sampler(self, read_io, get_proc_stat):
+        read_io.return_value = {'read_bytes': 100, 'write_bytes': 0}
+        get_proc_stat.return_value = {'blkio': 1}
+        sampler = predict.IOSampler()
+        self.assertEqual(sampler.sample([1, 2]), (0, 0))
+
+        read_io.return_value = {'read_bytes': 1000, 'write_bytes': 100}
+        get_proc_stat.return_value = {'blkio': 3}
+        sampler.time -= 1
+        rate, ticks = sampler.sample([1, 2])
+        self.assertGreater(rate, 1000)
+        self.assertEqual(ticks, 4)
+
+    @mock.patch('subprocess.Popen')
+    def test_spawn(self, popen):
+        options = {'wrapper_cache_dir': self.dirname}
+        self.assertFalse(predict.spawn('A.fs-uae', {}, options))
+        self.assertFalse(predict.spawn('A.fs-uae', {},
+                                       {'wrapper_predict': '2'}))
+        popen.assert_not_called()
+
+        self.assertTrue(predict.spawn('A.fs-uae', {'foo': 'bar'},
+                                      dict(options, wrapper_predict='2')))
+        job_file = popen.call_args[0][0][-1]
+        job = utils.read_json(job_file)
+        self.assertEqual(job['count'], 2)
+        self.assertEqual(job['options'], {'foo': 'bar'})
+        self.assertEqual(job['pid'], os.getpid())
+
+        popen.side_effect = OSError('oops')
+        self.assertFalse(predict.spawn('A.fs-uae', {},
+                                       dict(options, wrapper_predict='2')))
+
+    @mock.patch('multiprocessing.Process')
+    @mock.patch('fs_uae_wrapper.manifest.get_unpacked_size')
+    def test_prefetch_budget(self, get_unpacked_size, process):
+        arch_cache = cache.Cache(os.path.join(self.dirname, 'cache'), 2)
+        predictor = predict.Predictor(self.job)
+
+        get_unpacked_size.return_value = 2 * 1024 * 1024
+        self.assertFalse(predictor._prefetch(arch_cache, 'A.7z', None))
+
+        get_unpacked_size.return_value = 1024
+        with mock.patch.object(arch_cache, 'get_usage',
+                               return_value=2 * 1024 * 1024):
+            self.assertFalse(predictor._prefetch(arch_cache, 'A.7z', None))
+        process.assert_not_called()
+
+        process.return_value.is_alive.return_value = False
+        process.return_value.exitcode = 0
+        self.assertTrue(predictor._prefetch(arch_cache, 'A.7z', ('a',)))
+        self.assertEqual(process.call_args[1]['args'],
+                         (arch_cache.directory, 2, 'A.7z', ('a',), 1))
+
+    @mock.patch('fs_uae_wrapper.predict.is_running')
+    @mock.patch('fs_uae_wrapper.predict._signal')
+    @mock.patch('fs_uae_wrapper.predict.IOSampler.sample')
+    def test_watch(self, sample, send_signal, is_running):
+        is_running.return_value = True
+        extractor = mock.Mock(pid=42)
+        extractor.is_alive.side_effect = [True, True, True, False]
+        # emulator and extractor samples for every iteration
+        sample.side_effect = [(0, 0), (0, 0),
+                              (0, 1), (0, 0),
+                              (0, 0), (0, 0)]
+        predictor = predict.Predictor(self.job)
+        predictor.emulator = 1
+        predictor._watch(extractor)
+        self.assertEqual(send_signal.call_args_list,
+                         [mock.call(42, signal.SIGSTOP),
+                          mock.call(42, signal.SIGCONT)])
+        self.assertEqual(predictor.paused, predict.INTERVAL)
+
+        # over own I/O budget, extractor is continued at the end
+        send_signal.reset_mock()
+        extractor.is_alive.side_effect = [True, False]
+        sample.side_effect = [(0, 0), (10 * 1024 * 1024, 0)]
+        predictor._watch(extractor)
+        self.assertEqual(send_signal.call_args_list,
+                         [mock.call(42, signal.SIGSTOP),
+                          mock.call(42, signal.SIGCONT)])
+
+    @mock.patch('fs_uae_wrapper.predict.Predictor._prefetch')
+    @mock.patch('fs_uae_wrapper.predict.is_running')
+    @mock.patch('fs_uae_wrapper.predict.find_emulator')
+    @mock.patch('fs_uae_wrapper.history.get_candidates')
+    def test_run(self, get_candidates, find_emulator, is_running, prefetch):
+        is_running.return_value = True
+        find_emulator.return_value = None
+        with mock.patch('fs_uae_wrapper.predict.START_TIMEOUT', 0):
+            self.assertTrue(predict.Predictor(self.job).run())
+        get_candidates.assert_not_called()
+
+        find_emulator.return_value = 1
+        conf = os.path.join(self.dirname, 'B.fs-uae')
+        with open(conf, 'w') as fobj:
+            fobj.write('[config]\nwrapper = archive\n')
+        open(os.path.join(self.dirname, 'B.zip'), 'w').close()
+        get_candidates.return_value = [conf]
+        self.assertTrue(predict.Predictor(
+            dict(self.job, options={'wrapper_cache_dir': self.dirname}))
+            .run())
+        prefetch.assert_called_once_with(
+            mock.ANY, os.path.join(self.dirname, 'B.zip'), None)
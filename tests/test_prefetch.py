@@ -0,0 +1,147 @@
+import io
+import os
+import shutil
+import tarfile
+from tempfile import mkdtemp
+from unittest import TestCase, mock
+
+from fs_uae_wrapper import cache, prefetch, utils
+
+
+class TestPrefetch(TestCase):
+
+    def setUp(self):
+        self.dirname = mkdtemp()
+        self._env = mock.patch.dict(os.environ,
+                                    {'XDG_STATE_HOME': self.dirname})
+        self._env.start()
+        self.games = os.path.join(self.dirname, 'games')
+        self.cachedir = os.path.join(self.dirname, 'cache')
+        self.options = utils.CmdOption({'wrapper_cache_dir': self.cachedir,
+                                        'wrapper_prefetch_cpu_jobs': '1'})
+        os.makedirs(os.path.join(self.games, 'whdload'))
+        self._write('Turrican.fs-uae', '[config]\nwrapper = archive\n')
+        self._make_tar('Turrican.tar')
+        self._write('whdload/Chaos.fs-uae',
+                    '[config]\nwrapper = whdload\n'
+                    'wrapper_archive = Chaos.tar.xz\n'
+                    'wrapper_whdload_base = $CONFIG/../base.tar\n')
+        self._make_tar('whdload/Chaos.tar.xz')
+        self._make_tar('base.tar')
+        self._write('Plain.fs-uae', '[config]\n')
+
+    def tearDown(self):
+        self._env.stop()
+        shutil.rmtree(self.dirname)
+
+    def _write(self, name, contents):
+        with open(os.path.join(self.games, name), 'w') as fobj:
+            fobj.write(contents)
+
+    def _make_tar(self, name):
+        mode = 'w:xz' if name.endswith('.xz') else 'w'
+        data = name.encode('utf-8')
+        with tarfile.open(os.path.join(self.games, name), mode) as tar:
+            info = tarfile.TarInfo('data.bin')
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+    def test_get_configs(self):
+        configs = [os.path.join(self.games, name)
+                   for name in ('Plain.fs-uae', 'Turrican.fs-uae',
+                                'whdload/Chaos.fs-uae')]
+        self.assertEqual(prefetch.get_configs(self.games), configs)
+        self.assertEqual(prefetch.get_configs(configs[0]), [configs[0]])
+
+        list_file = os.path.join(self.games, 'list.txt')
+        with open(list_file, 'w') as fobj:
+            fobj.write('# favourites\nTurrican.fs-uae\n\n'
+                       f'{configs[2]}\n')
+        self.assertEqual(prefetch.get_configs(list_file), configs[1:])
+
+        self.assertRaises(OSError, prefetch.get_configs,
+                          os.path.join(self.games, 'nonexistent'))
+
+    def test_get_kind(self):
+        self.assertEqual(prefetch.get_kind('Game.tar.xz'), 'cpu')
+        self.assertEqual(prefetch.get_kind('Game.7Z'), 'cpu')
+        self.assertEqual(prefetch.get_kind('Game.zip'), 'io')
+        self.assertEqual(prefetch.get_kind('Game.tar'), 'io')
+
+    def test_collection(self):
+        collection = prefetch.Collection(self.options)
+        for conf_file in prefetch.get_configs(self.games):
+            self.assertTrue(collection.add(conf_file))
+        self.assertEqual(collection.configs, 2)
+        self.assertEqual(
+            sorted(os.path.relpath(arch_name, self.games)
+                   for _, arch_name, _ in collection.jobs),
+            ['Turrican.tar', 'base.tar', 'whdload/Chaos.tar.xz'])
+
+        os.unlink(os.path.join(self.games, 'Turrican.tar'))
+        self.assertFalse(collection.add(os.path.join(self.games,
+                                                     'Turrican.fs-uae')))
+        self._write('Broken.fs-uae', 'foo\n')
+        self.assertFalse(collection.add(os.path.join(self.games,
+                                                     'Broken.fs-uae')))
+
+    def test_collection_persist_data(self):
+        # archives written back after emulation are not prefetched
+        self._write('Turrican.fs-uae', '[config]\nwrapper = archive\n'
+                    'wrapper_persist_data = 1\n')
+        collection = prefetch.Collection(self.options)
+        self.assertTrue(collection.add(os.path.join(self.games,
+                                                    'Turrican.fs-uae')))
+        self.assertEqual(collection.jobs, {})
+
+    @mock.patch('fs_uae_wrapper.members.get_members')
+    def test_collection_members(self, get_members):
+        get_members.return_value = [('b', 1), ('a', 1)]
+        collection = prefetch.Collection(self.options)
+        collection.add(os.path.join(self.games, 'Turrican.fs-uae'))
+        self.assertEqual([files for _, _, files in collection.jobs],
+                         [('a', 'b')])
+
+    def test_run(self):
+        out = io.StringIO()
+        self.assertTrue(prefetch.run(self.games, self.options, out))
+        self.assertIn('Prefetched 3 archives for 2 configurations',
+                      out.getvalue())
+        self.assertIn('cpu bound (1 jobs): 1 extracted', out.getvalue())
+        self.assertIn('io bound (2 jobs): 2 extracted', out.getvalue())
+
+        arch_cache = cache.Cache(self.cachedir)
+        key = arch_cache.get_key(os.path.join(self.games, 'Turrican.tar'))
+        tree = os.path.join(arch_cache.get_entry(key), 'tree')
+        with open(os.path.join(tree, 'data.bin')) as fobj:
+            self.assertEqual(fobj.read(), 'Turrican.tar')
+
+        # everything is already in the cache
+        out = io.StringIO()
+        self.assertTrue(prefetch.run(self.games, self.options, out))
+        self.assertIn('io bound (2 jobs): 0 extracted, 2 already cached',
+                      out.getvalue())
+
+        out = io.StringIO()
+        self.assertFalse(prefetch.run(os.path.join(self.games, 'list.txt'),
+                                      self.options, out))
+
+    def test_run_budget(self):
+        out = io.StringIO()
+        options = dict(self.options, wrapper_cache_size='0',
+                       wrapper_prefetch_io_jobs='1')
+        with mock.patch.object(prefetch.Prefetcher, 'run',
+                               autospec=True) as run:
+            self.assertTrue(prefetch.run(self.games, options, out))
+        jobs = run.call_args[0][1]
+        self.assertEqual(set(jobs.values()), {0})
+
+        prefetcher = prefetch.Prefetcher(1, 1)
+        future = mock.Mock()
+        future.result.return_value = (True, 10)
+        queues = {'cpu': [(self.cachedir, 0, 'foo.7z', None)],
+                  'io': [('/other', 0, 'foo.zip', None)]}
+        prefetcher._done('io', (self.cachedir, 0, 'bar.zip', None), future,
+                         queues)
+        self.assertEqual(queues, {'cpu': [],
+                                  'io': [('/other', 0, 'foo.zip', None)]})
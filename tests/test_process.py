@@ -0,0 +1,89 @@
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase, mock
+
+from fs_uae_wrapper import process
+
+
+class TestProcess(TestCase):
+
+    def setUp(self):
+        self.dirname = mkdtemp()
+        process.USAGE.clear()
+
+    def tearDown(self):
+        process.USAGE.clear()
+        shutil.rmtree(self.dirname)
+
+    def test_call(self):
+        self.assertEqual(process.call(['sh', '-c', 'head -c 1048576 '
+                                       '/dev/zero > out'], cwd=self.dirname),
+                         0)
+        self.assertEqual(os.path.getsize(os.path.join(self.dirname, 'out')),
+                         1048576)
+
+        usage = process.USAGE[0]
+        self.assertTrue(usage['command'].startswith('sh -c'))
+        self.assertEqual(usage['returncode'], 0)
+        self.assertGreater(usage['wall'], 0)
+        self.assertGreater(usage['max_rss'], 0)
+        self.assertGreaterEqual(usage['user'], 0)
+        if usage.get('wchar') is not None:
+            # bytes written by the grandchild are accounted as well
+            self.assertGreaterEqual(usage['wchar'], 1048576)
+        self.assertIn('sh', process.get_summary(usage))
+        if process.read_peak_rss(os.getpid()) is not None:
+            # peak of the small child comes from the wrapper memory
+            self.assertFalse(usage['max_rss_exact'])
+            self.assertIn('at most', process.get_summary(usage))
+
+        self.assertEqual(process.call(['sh', '-c', 'exit 3']), 3)
+        self.assertEqual(process.call(['sh', '-c', 'kill -9 $$']), -9)
+        self.assertEqual([usage['returncode'] for usage in process.USAGE],
+                         [0, 3, -9])
+
+        self.assertRaises(OSError, process.call, ['nonexistent-command'])
+        self.assertEqual(len(process.USAGE), 3)
+
+    def test_call_feed(self):
+        def _feed(stdin):
+            for _ in range(64):
+                stdin.write(b'x' * 65536)
+
+        self.assertEqual(process.call(['sh', '-c', 'cat > out'],
+                                      cwd=self.dirname, feed=_feed), 0)
+        self.assertEqual(os.path.getsize(os.path.join(self.dirname, 'out')),
+                         64 * 65536)
+
+        # process may not read the whole input
+        self.assertEqual(process.call(['sh', '-c', 'head -c 1 > out'],
+                                      cwd=self.dirname, feed=_feed), 0)
+
+    @mock.patch('os.waitid', create=True)
+    def test_call_reaped(self, waitid):
+        waitid.side_effect = ChildProcessError()
+        self.assertEqual(process.call(['true']), 0)
+        self.assertNotIn('max_rss', process.USAGE[0])
+        process.get_summary(process.USAGE[0])
+
+    @mock.patch('fs_uae_wrapper.process.read_peak_rss')
+    def test_call_peak_rss(self, read_peak_rss):
+        read_peak_rss.return_value = 0
+        self.assertEqual(process.call(['true']), 0)
+        self.assertTrue(process.USAGE[0]['max_rss_exact'])
+        self.assertNotIn('at most', process.get_summary(process.USAGE[0]))
+
+        read_peak_rss.return_value = None
+        self.assertEqual(process.call(['true']), 0)
+        self.assertFalse(process.USAGE[1]['max_rss_exact'])
+
+    def test_read_peak_rss(self):
+        self.assertIsNone(process.read_peak_rss(-1))
+        if os.path.exists('/proc/self/status'):
+            self.assertGreater(process.read_peak_rss(os.getpid()), 0)
+
+    def test_read_io(self):
+        self.assertIsNone(process.read_io(-1))
+        if os.path.exists('/proc/self/io'):
+            self.assertIn('read_bytes', process.read_io(os.getpid()))
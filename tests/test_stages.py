@@ -0,0 +1,67 @@
+import threading
+from unittest import TestCase
+
+from fs_uae_wrapper import stages
+
+
+class TestScheduler(TestCase):
+
+    def test_order(self):
+        order = []
+
+        def _stage(name, result=True):
+            def _run():
+                order.append(name)
+                return result
+            return _run
+
+        scheduler = stages.Scheduler(1)
+        scheduler.add('conf', _stage('conf'), ('extract', 'save'))
+        scheduler.add('extract', _stage('extract'))
+        scheduler.add('save', _stage('save'))
+        self.assertTrue(scheduler.run())
+        self.assertEqual(order, ['extract', 'save', 'conf'])
+        self.assertEqual(sorted(scheduler.durations),
+                         ['conf', 'extract', 'save'])
+
+        # stages which require failed one are not run
+        order.clear()
+        scheduler = stages.Scheduler(1)
+        scheduler.add('extract', _stage('extract', False))
+        scheduler.add('save', _stage('save'))
+        scheduler.add('conf', _stage('conf'), ('extract', 'save'))
+        self.assertFalse(scheduler.run())
+        self.assertEqual(order, ['extract', 'save'])
+
+    def test_concurrent(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        def _wait():
+            # fails with BrokenBarrierError, if the other stage is not
+            # running at the same time
+            barrier.wait()
+            return True
+
+        scheduler = stages.Scheduler()
+        scheduler.add('base', _wait)
+        scheduler.add('extract', _wait)
+        scheduler.add('slave', lambda: True, ('base', 'extract'))
+        self.assertTrue(scheduler.run())
+        self.assertGreaterEqual(scheduler.get_saved_time(), 0)
+
+    def test_errors(self):
+        scheduler = stages.Scheduler()
+        scheduler.add('conf', lambda: True, ('nonexistent',))
+        self.assertRaises(ValueError, scheduler.run)
+
+        scheduler = stages.Scheduler()
+        scheduler.add('a', lambda: True, ('b',))
+        scheduler.add('b', lambda: True, ('a',))
+        self.assertRaises(ValueError, scheduler.run)
+
+        def _raise():
+            raise OSError('foo')
+
+        scheduler = stages.Scheduler()
+        scheduler.add('extract', _raise)
+        self.assertRaises(OSError, scheduler.run)
@@ -0,0 +1,74 @@
+import json
+import os
+import pstats
+import shutil
+import threading
+from tempfile import mkdtemp
+from unittest import TestCase, mock
+
+from fs_uae_wrapper import timing
+
+
+class TestTracer(TestCase):
+
+    def setUp(self):
+        self.dirname = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_span(self):
+        tracer = timing.Tracer()
+        with tracer.span('extract', archive='game.7z'):
+            with tracer.span('materialize'):
+                pass
+
+        self.assertEqual([event['name'] for event in tracer.events],
+                         ['materialize', 'extract'])
+        extract = tracer.events[1]
+        self.assertEqual(extract['ph'], 'X')
+        self.assertEqual(extract['args'], {'archive': 'game.7z'})
+        self.assertGreaterEqual(extract['dur'], tracer.events[0]['dur'])
+
+        # span is recorded also on failure
+        with self.assertRaises(OSError):
+            with tracer.span('copy_conf'):
+                raise OSError()
+        self.assertEqual(tracer.events[-1]['name'], 'copy_conf')
+
+    def test_save(self):
+        tracer = timing.Tracer()
+        tracer.start_profile()
+
+        def _stage():
+            with tracer.span('stage'), tracer.profiled():
+                sorted(range(10))
+
+        thread = threading.Thread(target=_stage, name='worker')
+        thread.start()
+        thread.join()
+
+        fname = os.path.join(self.dirname, 'trace', 'trace.json')
+        self.assertTrue(tracer.save(fname))
+        with open(fname) as fobj:
+            trace = json.load(fobj)
+        names = {event['args']['name'] for event in trace['traceEvents']
+                 if event['ph'] == 'M'}
+        self.assertEqual(names, {'worker'})
+        self.assertEqual(trace['traceEvents'][-1]['name'], 'stage')
+
+        # profile of the main thread and the worker thread
+        self.assertEqual(len(tracer.profiles), 2)
+        stats = pstats.Stats(fname + '.prof')
+        self.assertIn('sorted', ' '.join(func[2] for func in stats.stats))
+
+        self.assertFalse(tracer.save(os.path.join(self.dirname, 'trace',
+                                                  'trace.json', 'foo')))
+
+    @mock.patch('fs_uae_wrapper.persist.get_state_dir')
+    def test_get_output_path(self, get_state_dir):
+        get_state_dir.return_value = '/state'
+        self.assertEqual(timing.get_output_path('/tmp/trace.json', 'trace'),
+                         '/tmp/trace.json')
+        self.assertTrue(timing.get_output_path('1', 'trace')
+                        .startswith('/state/trace-'))
@@ -0,0 +1,87 @@
+import os
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase, mock
+
+from fs_uae_wrapper import tmpdir
+
+
+class TestTmpDir(TestCase):
+
+    def setUp(self):
+        self.dirname = mkdtemp()
+        self.curdir = os.path.abspath(os.curdir)
+        os.chdir(self.dirname)
+
+    def tearDown(self):
+        os.chdir(self.curdir)
+        try:
+            shutil.rmtree(self.dirname)
+        except OSError:
+            pass
+
+    @mock.patch('tempfile.gettempdir')
+    def test_get_candidates(self, gettempdir):
+        gettempdir.return_value = '/tmp'
+        self.assertEqual(tmpdir.get_candidates({}), ['/tmp'])
+        self.assertEqual(tmpdir.get_candidates({'wrapper_tmp_dirs': ''}),
+                         ['/tmp'])
+        self.assertEqual(tmpdir.get_candidates(
+            {'wrapper_tmp_dirs': '/dev/shm::/mnt/scratch'}),
+            ['/dev/shm', '/mnt/scratch'])
+        self.assertEqual(tmpdir.get_candidates({'wrapper_tmp_dirs': '~/tmp'}),
+                         [os.path.expanduser('~/tmp')])
+
+    def test_get_fs_type(self):
+        mounts = ('/dev/sda1 / ext4 rw 0 0\n'
+                  'tmpfs /dev/shm tmpfs rw 0 0\n'
+                  '/dev/sdb1 /mnt/my\\040disk xfs rw 0 0\n')
+        with mock.patch('builtins.open', mock.mock_open(read_data=mounts)):
+            self.assertEqual(tmpdir.get_fs_type('/dev/shm/foo'), 'tmpfs')
+            self.assertEqual(tmpdir.get_fs_type('/dev/shmem'), 'ext4')
+            self.assertEqual(tmpdir.get_fs_type('/mnt/my disk/tmp'), 'xfs')
+
+        with mock.patch('builtins.open', side_effect=OSError):
+            self.assertIsNone(tmpdir.get_fs_type('/tmp'))
+
+    @mock.patch('fs_uae_wrapper.tmpdir.get_available_memory')
+    @mock.patch('fs_uae_wrapper.tmpdir.get_fs_type')
+    @mock.patch('shutil.disk_usage')
+    def test_get_free_space(self, disk_usage, fs_type, memory):
+        disk_usage.return_value.free = 1000
+        fs_type.return_value = 'ext4'
+        memory.return_value = 100
+        self.assertEqual(tmpdir.get_free_space('/tmp'), 1000)
+
+        fs_type.return_value = 'tmpfs'
+        self.assertEqual(tmpdir.get_free_space('/tmp'), 100)
+
+        memory.return_value = None
+        self.assertEqual(tmpdir.get_free_space('/tmp'), 1000)
+
+    @mock.patch('fs_uae_wrapper.tmpdir.get_free_space')
+    def test_choose(self, free_space):
+        os.mkdir('ram')
+        os.mkdir('disk')
+        candidates = ['nonexistent', 'ram', 'disk']
+        free_space.side_effect = lambda x: {'ram': 100, 'disk': 1000}[x]
+
+        self.assertEqual(tmpdir.choose(candidates, None), 'ram')
+        self.assertEqual(tmpdir.choose(candidates, 50), 'ram')
+        self.assertEqual(tmpdir.choose(candidates, 100), 'disk')
+        self.assertEqual(tmpdir.choose(candidates, 900), 'disk')
+        self.assertIsNone(tmpdir.choose(candidates, 1000))
+        self.assertIsNone(tmpdir.choose(['nonexistent'], None))
+
+    @mock.patch('fs_uae_wrapper.tmpdir.get_free_space')
+    def test_make_temp_dir(self, free_space):
+        free_space.return_value = 1000
+        options = {'wrapper_tmp_dirs': self.dirname}
+
+        directory = tmpdir.make_temp_dir(options, 10)
+        self.assertTrue(os.path.isdir(directory))
+        self.assertEqual(os.path.dirname(directory), self.dirname)
+
+        self.assertIsNone(tmpdir.make_temp_dir(options, 1000))
+        self.assertIsNone(tmpdir.make_temp_dir({'wrapper_tmp_dirs': 'foo'},
+                                               None))
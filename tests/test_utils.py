@@ -116,7 +116,8 @@ class TestUtils(TestCase):
 
         operate.return_value = True
         self.assertTrue(utils.extract_archive('arch.7z'))
-        operate.assert_called_once_with('arch.7z', 'extract', '', None)
+        operate.assert_called_once_with('arch.7z', 'extract', '', None, None,
+                                        None, None)
 
         operate.reset_mock()
         operate.return_value = False
@@ -124,13 +125,20 @@ class TestUtils(TestCase):
                                                ['foo', 'bar']))
         operate.assert_called_once_with('arch.7z', 'extract',
                                         "Extracting files for `MyFoo'. Please"
-                                        " be patient", ['foo', 'bar'])
+                                        " be patient", ['foo', 'bar'], None,
+                                        None, None)
+
+        operate.reset_mock()
+        utils.extract_archive('arch.7z', threads=4)
+        operate.assert_called_once_with('arch.7z', 'extract', '', None, 4,
+                                        None, None)
 
     @mock.patch('fs_uae_wrapper.utils.operate_archive')
     def test_create_archive(self, operate):
         operate.return_value = True
         self.assertTrue(utils.create_archive('arch.7z'))
-        operate.assert_called_once_with('arch.7z', 'create', '', None)
+        operate.assert_called_once_with('arch.7z', 'create', '', None, None,
+                                        None, None)
 
         operate.reset_mock()
         operate.return_value = False
@@ -138,7 +146,13 @@ class TestUtils(TestCase):
                                               ['foo', 'bar']))
         operate.assert_called_once_with('arch.7z', 'create',
                                         "Creating archive for `MyFoo'. Please"
-                                        " be patient", ['foo', 'bar'])
+                                        " be patient", ['foo', 'bar'], None,
+                                        None, None)
+
+        operate.reset_mock()
+        utils.create_archive('arch.7z', threads=4)
+        operate.assert_called_once_with('arch.7z', 'create', '', None, 4,
+                                        None, None)
 
     @mock.patch('fs_uae_wrapper.path.which')
     @mock.patch('fs_uae_wrapper.file_archive.Archive.extract')
@@ -152,7 +166,74 @@ class TestUtils(TestCase):
         with open(arch_name, 'w') as fobj:
             fobj.write("\n")
         self.assertTrue(utils.extract_archive(arch_name))
-        arch_extract.assert_called_once_with(arch_name)
+        arch_extract.assert_called_once_with(arch_name, None, None)
+
+    @mock.patch('fs_uae_wrapper.file_archive.get_archiver')
+    def test_update_archive(self, get_archiver):
+        get_archiver.return_value = None
+        self.assertFalse(utils.update_archive('foo.tar', ['a'], []))
+
+        os.chdir(self.dirname)
+        with open('foo.tar', 'w') as fobj:
+            fobj.write('archive')
+        archiver = get_archiver.return_value = mock.Mock()
+
+        # update is applied on the copy, which replaces the archive
+        def _update(arch_name, files, deleted, cwd=None):
+            self.assertTrue(arch_name.endswith('-foo.tar'))
+            with open(arch_name, 'a') as fobj:
+                fobj.write(' updated')
+            return True
+
+        archiver.update.side_effect = _update
+        self.assertTrue(utils.update_archive('foo.tar', ['a'], [], cwd='x'))
+        archiver.update.assert_called_once_with(mock.ANY, ['a'], [], 'x')
+        with open('foo.tar') as fobj:
+            self.assertEqual(fobj.read(), 'archive updated')
+        self.assertEqual(os.listdir('.'), ['foo.tar'])
+
+        # failed update leaves archive intact
+        archiver.update.side_effect = None
+        archiver.update.return_value = False
+        self.assertFalse(utils.update_archive('foo.tar', ['a'], []))
+        with open('foo.tar') as fobj:
+            self.assertEqual(fobj.read(), 'archive updated')
+        self.assertEqual(os.listdir('.'), ['foo.tar'])
+
+    @mock.patch('fs_uae_wrapper.file_archive.get_archiver')
+    def test_get_unpacked_size(self, get_archiver):
+        get_archiver.return_value = None
+        self.assertIsNone(utils.list_archive('foo.7z'))
+        self.assertIsNone(utils.get_unpacked_size('foo.7z'))
+
+        get_archiver.return_value = mock.Mock()
+        get_archiver.return_value.list.return_value = [('a', 10), ('b', 5)]
+        self.assertEqual(utils.get_unpacked_size('foo.7z'), 15)
+
+        get_archiver.return_value.list.return_value = None
+        self.assertIsNone(utils.get_unpacked_size('foo.7z'))
+
+        # compressed tar archives are not listed
+        get_archiver.reset_mock()
+        with mock.patch('fs_uae_wrapper.file_archive.get_stream_size') as size:
+            size.return_value = 20
+            self.assertEqual(utils.get_unpacked_size('foo.tar.gz'), 20)
+            size.assert_called_once_with('foo.tar.gz')
+        get_archiver.assert_not_called()
+
+    @mock.patch('os.cpu_count')
+    def test_get_threads(self, cpu_count):
+        cpu_count.return_value = 8
+        self.assertEqual(utils.get_threads(None), 8)
+        self.assertEqual(utils.get_threads('2'), 2)
+        self.assertEqual(utils.get_threads('16'), 8)
+        self.assertEqual(utils.get_threads('0'), 8)
+        self.assertEqual(utils.get_threads('-1'), 8)
+        self.assertEqual(utils.get_threads('1'), 1)
+        self.assertEqual(utils.get_threads('all'), 8)
+
+        cpu_count.return_value = None
+        self.assertEqual(utils.get_threads(None), 1)
 
     def test_merge_all_options(self):
 
@@ -165,24 +246,24 @@ class TestUtils(TestCase):
         self.assertDictEqual(conf, {'foo': '1', 'bar': 'zip'})
         self.assertDictEqual(other, {'foo': '2', 'baz': '3'})
 
-    @mock.patch('subprocess.call')
+    @mock.patch('fs_uae_wrapper.process.call')
     def test_run_command(self, call):
         call.return_value = 0
         self.assertTrue(utils.run_command(['ls']))
-        call.assert_called_once_with(['ls'])
+        call.assert_called_once_with(['ls'], cwd=None)
 
         call.reset_mock()
         self.assertTrue(utils.run_command('ls -l'))
-        call.assert_called_once_with(['ls', '-l'])
+        call.assert_called_once_with(['ls', '-l'], cwd=None)
 
         call.return_value = 1
         call.reset_mock()
         self.assertFalse(utils.run_command(['ls', '-l']))
-        call.assert_called_once_with(['ls', '-l'])
+        call.assert_called_once_with(['ls', '-l'], cwd=None)
 
         call.reset_mock()
         self.assertFalse(utils.run_command('ls'))
-        call.assert_called_once_with(['ls'])
+        call.assert_called_once_with(['ls'], cwd=None)
 
     @mock.patch('os.path.exists')
     def test_get_config(self, exists):
@@ -196,6 +277,27 @@ class TestUtils(TestCase):
         self.assertDictEqual(utils.get_config('conf.fs-uae'),
                              {'wrapper': 'foo'})
 
+        inputs = []
+        utils.get_config('conf.fs-uae', inputs)
+        self.assertEqual(inputs[0], 'conf.fs-uae')
+        self.assertEqual(len(inputs), 4)
+        self.assertTrue(inputs[-1].endswith('Default.fs-uae'))
+
+    def test_lock_file(self):
+        lock = os.path.join(self.dirname, 'lock')
+
+        with utils.lock_file(lock) as locked:
+            self.assertTrue(locked)
+            with utils.lock_file(lock, blocking=False) as other:
+                self.assertFalse(other)
+
+        with utils.lock_file(lock, shared=True) as locked:
+            self.assertTrue(locked)
+            with utils.lock_file(lock, shared=True, blocking=False) as other:
+                self.assertTrue(other)
+            with utils.lock_file(lock, blocking=False) as other:
+                self.assertFalse(other)
+
 
 class TestCmdOptions(TestCase):
 
@@ -210,6 +312,12 @@ class TestCmdOptions(TestCase):
         cmd.add('--fade_out_duration=0')
         self.assertEqual(cmd['fade_out_duration'], '0')
 
+        # dashes are allowed in wrapper options
+        cmd.add('--wrapper-stats')
+        self.assertEqual(cmd['wrapper_stats'], '1')
+        cmd.add('--wrapper-metrics=/tmp/m.db')
+        self.assertEqual(cmd['wrapper_metrics'], '/tmp/m.db')
+
         # pass the wrong parameter to fs-uae
         self.assertRaises(AttributeError, cmd.add, '-typo=0')
 
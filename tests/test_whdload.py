@@ -1,19 +1,24 @@
 import os
 import shutil
+import zipfile
 from tempfile import mkdtemp
 from unittest import TestCase, mock
 
-from fs_uae_wrapper import utils, whdload
+from fs_uae_wrapper import timing, utils, whdload
 
 
 class TestWHDLoad(TestCase):
 
     def setUp(self):
         self.dirname = mkdtemp()
+        self._env = mock.patch.dict(os.environ,
+                                    {'XDG_STATE_HOME': self.dirname})
+        self._env.start()
         self.curdir = os.path.abspath(os.curdir)
         os.chdir(self.dirname)
 
     def tearDown(self):
+        self._env.stop()
         os.chdir(self.curdir)
         try:
             shutil.rmtree(self.dirname)
@@ -96,7 +101,10 @@ class TestWHDLoad(TestCase):
         copy_conf.return_value = True
         run_emulator.return_value = True
         wrapper = whdload.Wrapper('Config.fs-uae', utils.CmdOption(), {})
-        self.assertTrue(wrapper.run())
+        with mock.patch.object(timing, 'TRACER', timing.Tracer()) as tracer:
+            self.assertTrue(wrapper.run())
+        self.assertEqual([event['name'] for event in tracer.events],
+                         ['extract', 'copy_conf'])
 
     @mock.patch('os.path.exists')
     def test_extract_nonexistent_image(self, exists):
@@ -105,19 +113,19 @@ class TestWHDLoad(TestCase):
         wrapper.fsuae_options['wrapper_whdload_base'] = 'fakefilename'
         self.assertFalse(wrapper._extract())
 
-    @mock.patch('os.chdir')
+    @mock.patch('fs_uae_wrapper.base.ArchiveBase._extract')
     @mock.patch('os.path.exists')
-    def test_extract_extraction_failed(self, exists, chdir):
+    def test_extract_extraction_failed(self, exists, arch_extract):
         exists.return_value = True
+        arch_extract.return_value = True
         wrapper = whdload.Wrapper('Config.fs-uae', utils.CmdOption(), {})
         wrapper.fsuae_options['wrapper_whdload_base'] = 'fakefilename.7z'
         self.assertFalse(wrapper._extract())
 
     @mock.patch('fs_uae_wrapper.base.ArchiveBase._extract')
     @mock.patch('fs_uae_wrapper.utils.extract_archive')
-    @mock.patch('os.chdir')
     @mock.patch('os.path.exists')
-    def test_extract_extraction_of_whdload_arch_failed(self, exists, chdir,
+    def test_extract_extraction_of_whdload_arch_failed(self, exists,
                                                        image_extract,
                                                        arch_extract):
         exists.return_value = True
@@ -130,10 +138,9 @@ class TestWHDLoad(TestCase):
     @mock.patch('fs_uae_wrapper.whdload.Wrapper._find_slave')
     @mock.patch('fs_uae_wrapper.base.ArchiveBase._extract')
     @mock.patch('fs_uae_wrapper.utils.extract_archive')
-    @mock.patch('os.chdir')
     @mock.patch('os.path.exists')
-    def test_extract_slave_not_found(self, exists, chdir, image_extract,
-                                     arch_extract, find_slave):
+    def test_extract_slave_not_found(self, exists, image_extract, arch_extract,
+                                     find_slave):
         exists.return_value = True
         image_extract.return_value = True
         arch_extract.return_value = True
@@ -145,9 +152,8 @@ class TestWHDLoad(TestCase):
     @mock.patch('fs_uae_wrapper.whdload.Wrapper._find_slave')
     @mock.patch('fs_uae_wrapper.base.ArchiveBase._extract')
     @mock.patch('fs_uae_wrapper.utils.extract_archive')
-    @mock.patch('os.chdir')
     @mock.patch('os.path.exists')
-    def test_extract_success(self, exists, chdir, image_extract, arch_extract,
+    def test_extract_success(self, exists, image_extract, arch_extract,
                              find_slave):
         exists.return_value = True
         image_extract.return_value = True
@@ -158,28 +164,27 @@ class TestWHDLoad(TestCase):
         self.assertTrue(wrapper._extract())
 
     @mock.patch('os.walk')
-    @mock.patch('os.chdir')
-    def test_find_slave_no_slave_file(self, chdir, walk):
+    def test_find_slave_no_slave_file(self, walk):
         walk.return_value = [(".", ('game'), ()),
                              ('./game', (), ('foo', 'bar', 'baz'))]
         wrapper = whdload.Wrapper('Config.fs-uae', utils.CmdOption(), {})
+        wrapper.dir = '.'
         self.assertFalse(wrapper._find_slave())
 
     @mock.patch('os.listdir')
     @mock.patch('os.walk')
-    @mock.patch('os.chdir')
-    def test_find_slave_no_corresponding_icon(self, chdir, walk, listdir):
+    def test_find_slave_no_corresponding_icon(self, walk, listdir):
         contents = ('foo', 'bar', 'baz.slave')
         walk.return_value = [(".", ('game'), ()),
                              ('./game', (), contents)]
         listdir.return_value = contents
         wrapper = whdload.Wrapper('Config.fs-uae', utils.CmdOption(), {})
+        wrapper.dir = '.'
         self.assertFalse(wrapper._find_slave())
 
     @mock.patch('os.listdir')
     @mock.patch('os.walk')
-    @mock.patch('os.chdir')
-    def test_find_slave_success(self, chdir, walk, listdir):
+    def test_find_slave_success(self, walk, listdir):
         contents = ('foo', 'bar', 'baz.slave', 'baz.info')
         _open = mock.mock_open()
         walk.return_value = [(".", ('C', 'S', 'game'), ()),
@@ -188,6 +193,7 @@ class TestWHDLoad(TestCase):
                              ('./game', (), contents)]
         listdir.return_value = contents
         wrapper = whdload.Wrapper('Config.fs-uae', utils.CmdOption(), {})
+        wrapper.dir = '.'
         with mock.patch('builtins.open', _open):
             self.assertTrue(wrapper._find_slave())
         handle = _open()
@@ -196,8 +202,7 @@ class TestWHDLoad(TestCase):
 
     @mock.patch('os.listdir')
     @mock.patch('os.walk')
-    @mock.patch('os.chdir')
-    def test_find_slave_minial(self, chdir, walk, listdir):
+    def test_find_slave_minial(self, walk, listdir):
         contents = ('foo', 'bar', 'baz.slave', 'baz.info')
         _open = mock.mock_open()
         walk.return_value = [(".", ('C', 'S', 'game'), ()),
@@ -206,6 +211,7 @@ class TestWHDLoad(TestCase):
                              ('./game', (), contents)]
         listdir.return_value = contents
         wrapper = whdload.Wrapper('Config.fs-uae', utils.CmdOption(), {})
+        wrapper.dir = '.'
         with mock.patch('builtins.open', _open):
             self.assertTrue(wrapper._find_slave())
         handle = _open()
@@ -214,8 +220,7 @@ class TestWHDLoad(TestCase):
 
     @mock.patch('os.listdir')
     @mock.patch('os.walk')
-    @mock.patch('os.chdir')
-    def test_find_custom_options(self, chdir, walk, listdir):
+    def test_find_custom_options(self, walk, listdir):
         contents = ('foo', 'bar', 'baz.slave', 'baz.info')
         _open = mock.mock_open()
         walk.return_value = [(".", ('C', 'S', 'game'), ()),
@@ -224,6 +229,7 @@ class TestWHDLoad(TestCase):
                              ('./game', (), contents)]
         listdir.return_value = contents
         wrapper = whdload.Wrapper('Config.fs-uae', utils.CmdOption(), {})
+        wrapper.dir = '.'
         whdl_opts = 'Preload SplashDelay=0 MMU PAL'
         wrapper.all_options['wrapper_whdload_options'] = whdl_opts
         with mock.patch('builtins.open', _open):
@@ -231,3 +237,166 @@ class TestWHDLoad(TestCase):
         handle = _open()
         handle.write.assert_called_once_with(f'cd game\nC:whdload {whdl_opts} '
                                              'Slave=baz.slave\n')
+
+    @mock.patch('fs_uae_wrapper.utils.list_archive')
+    def test_get_slave(self, list_archive):
+        wrapper = whdload.Wrapper('Config.fs-uae', utils.CmdOption(), {})
+        self.assertIsNone(wrapper._get_slave())
+
+        wrapper.arch_filepath = os.path.join(self.dirname, 'game.lha')
+        self.assertIsNone(wrapper._get_slave())
+
+        with open('game.lha', 'w') as fobj:
+            fobj.write('\n')
+        list_archive.return_value = None
+        self.assertIsNone(wrapper._get_slave())
+
+        list_archive.return_value = [('Game/readme', 1),
+                                     ('./Game/Game.Slave', 2),
+                                     ('Game/Other.slave', 2),
+                                     ('Game/game.INFO', 3)]
+        slave = wrapper._get_slave()
+        self.assertEqual(slave['slave'], 'Game/Game.Slave')
+        self.assertEqual(slave['icon'], 'Game/game.INFO')
+        self.assertTrue(os.path.exists('game.lha.whdload.json'))
+
+        # result is taken from the file stored next to the archive
+        list_archive.reset_mock()
+        self.assertEqual(wrapper._get_slave(), slave)
+        list_archive.assert_not_called()
+
+        # until archive is changed
+        with open('game.lha', 'w') as fobj:
+            fobj.write('changed\n')
+        list_archive.return_value = [('Game/Game.slave', 2)]
+        slave = wrapper._get_slave()
+        self.assertEqual(slave['slave'], 'Game/Game.slave')
+        self.assertIsNone(slave['icon'])
+        list_archive.assert_called_once()
+
+    def test_get_path(self):
+        wrapper = whdload.Wrapper('Config.fs-uae', utils.CmdOption(), {})
+        wrapper.dir = self.dirname
+        os.makedirs('C')
+        os.makedirs('s')
+        open('C/KGIconLoad', 'w').close()
+
+        self.assertEqual(wrapper._get_path('c/kgiconload'), 'C/KGIconLoad')
+        self.assertEqual(wrapper._get_path('s'), 's')
+        self.assertIsNone(wrapper._get_path('c/whdload'))
+        self.assertIsNone(wrapper._get_path('libs/foo'))
+
+    def test_extract_listing(self):
+        with zipfile.ZipFile('base.zip', 'w') as zip_:
+            zip_.writestr('S/Startup-Sequence', '')
+            zip_.writestr('C/kgiconload', '')
+            zip_.writestr('Devs/foo.prefs', 'base')
+        with zipfile.ZipFile('game.zip', 'w') as zip_:
+            zip_.writestr('Game/Game.slave', '')
+            zip_.writestr('Game/Game.info', '')
+            zip_.writestr('Devs/foo.prefs', 'game')
+
+        wrapper = whdload.Wrapper('Config.fs-uae', utils.CmdOption(), {})
+        wrapper.dir = mkdtemp(dir=self.dirname)
+        wrapper.arch_filepath = os.path.join(self.dirname, 'game.zip')
+        wrapper.fsuae_options['wrapper_whdload_base'] = os.path.join(
+            self.dirname, 'base.zip')
+
+        with mock.patch('os.walk') as walk:
+            self.assertTrue(wrapper._extract())
+            walk.assert_not_called()
+
+        with open(os.path.join(wrapper.dir, 'S', 'whdload-startup')) as fobj:
+            self.assertEqual(fobj.read(), 'cd Game\nC:kgiconload Game.info\n')
+        # files from the game archive replace the ones from base image
+        with open(os.path.join(wrapper.dir, 'Devs', 'foo.prefs')) as fobj:
+            self.assertEqual(fobj.read(), 'game')
+
+    @mock.patch('fs_uae_wrapper.base.Base._run_stages')
+    def test_extract_stages(self, run_stages):
+        open('base.zip', 'w').close()
+        wrapper = whdload.Wrapper('Config.fs-uae', utils.CmdOption(), {})
+        wrapper.fsuae_options['wrapper_whdload_base'] = 'base.zip'
+        wrapper._extract()
+        graph = run_stages.call_args[0][0]
+        self.assertEqual(graph['archive'][1], ('base',))
+        # slave found in the listing doesn't wait for the archive
+        self.assertEqual(graph['slave'][1], ('listing', 'base'))
+        self.assertEqual(graph['find_slave'][1], ('slave', 'archive'))
+
+        wrapper.all_options['wrapper_whdload_shared_base'] = '1'
+        wrapper._extract()
+        graph = run_stages.call_args[0][0]
+        self.assertEqual(graph['archive'][1], ())
+
+    @mock.patch('fs_uae_wrapper.whdload.Wrapper._find_slave')
+    @mock.patch('fs_uae_wrapper.whdload.Wrapper._write_startup')
+    def test_find_extracted_slave(self, write_startup, find_slave):
+        wrapper = whdload.Wrapper('Config.fs-uae', utils.CmdOption(), {})
+        wrapper.slave = {'slave': 'Game.slave', 'icon': 'Game.info'}
+        write_startup.return_value = True
+        find_slave.return_value = True
+
+        # slave was already installed out of the listing
+        self.assertTrue(wrapper._find_extracted_slave())
+        find_slave.assert_not_called()
+
+        wrapper.slave = None
+        self.assertTrue(wrapper._install_slave())
+        write_startup.assert_not_called()
+        self.assertTrue(wrapper._find_extracted_slave())
+        find_slave.assert_called_once()
+
+    def test_extract_shared_base(self):
+        with zipfile.ZipFile('base.zip', 'w') as zip_:
+            zip_.writestr('S/Startup-Sequence', '')
+            zip_.writestr('C/kgiconload', '')
+            zip_.writestr('Libs/foo.library', '')
+        with zipfile.ZipFile('game.zip', 'w') as zip_:
+            zip_.writestr('Game/Game.slave', '')
+            zip_.writestr('Game/Game.info', '')
+
+        wrapper = whdload.Wrapper('Config.fs-uae', utils.CmdOption(), {})
+        wrapper.dir = mkdtemp(dir=self.dirname)
+        wrapper.arch_filepath = os.path.join(self.dirname, 'game.zip')
+        wrapper.fsuae_options['wrapper_whdload_base'] = os.path.join(
+            self.dirname, 'base.zip')
+        wrapper.all_options['wrapper_whdload_shared_base'] = '1'
+        wrapper.all_options['wrapper_cache_dir'] = os.path.join(self.dirname,
+                                                                'cache')
+        self.assertEqual(wrapper._get_archives(),
+                         [wrapper.arch_filepath])
+
+        # there is no Assign command in base image
+        self.assertFalse(wrapper._extract())
+        wrapper.clean()
+
+        with zipfile.ZipFile('base.zip', 'a') as zip_:
+            zip_.writestr('C/Assign', '')
+
+        wrapper.dir = mkdtemp(dir=self.dirname)
+        try:
+            self.assertTrue(wrapper._extract())
+            self.assertEqual(sorted(os.listdir(wrapper.dir)), ['Game', 'S'])
+            tree = wrapper.fsuae_options['hard_drive_0']
+            self.assertTrue(os.path.exists(os.path.join(tree, 'C/Assign')))
+            self.assertEqual(wrapper.fsuae_options['hard_drive_0_read_only'],
+                             '1')
+            self.assertEqual(wrapper.fsuae_options['hard_drive_1'],
+                             wrapper.dir)
+
+            with open(os.path.join(wrapper.dir, 'S',
+                                   'whdload-startup')) as fobj:
+                self.assertEqual(fobj.read(), 'cd DH1:Game\n'
+                                 'C:kgiconload Game.info\n')
+            with open(os.path.join(wrapper.dir, 'S',
+                                   'startup-sequence')) as fobj:
+                self.assertEqual(fobj.read(),
+                                 'DH0:C/Assign >NIL: C: DH0:C\n'
+                                 'DH0:C/Assign >NIL: Libs: DH0:Libs\n'
+                                 'DH0:C/Assign >NIL: S: DH0:S\n'
+                                 'DH0:C/Assign >NIL: S: DH1:S ADD\n'
+                                 'DH0:C/Assign >NIL: SYS: DH0:\n'
+                                 'Execute DH0:S/startup-sequence\n')
+        finally:
+            wrapper.clean()
@@ -1,10 +1,11 @@
+import json
 import os
 import shutil
 import sys
 from tempfile import mkdtemp, mkstemp
 from unittest import TestCase, mock
 
-from fs_uae_wrapper import wrapper
+from fs_uae_wrapper import metrics, utils, wrapper
 
 
 class TestWrapper(TestCase):
@@ -16,8 +17,13 @@ class TestWrapper(TestCase):
         self._argv = sys.argv[:]
         sys.argv = ['fs-uae-wrapper']
         self.curdir = os.path.abspath(os.curdir)
+        # keep launch plans away from user state directory
+        self._env = mock.patch.dict(os.environ,
+                                    {'XDG_STATE_HOME': self.dirname})
+        self._env.start()
 
     def tearDown(self):
+        self._env.stop()
         os.chdir(self.curdir)
         shutil.rmtree(self.dirname)
         os.unlink(self.fname)
@@ -48,6 +54,134 @@ class TestWrapper(TestCase):
         sys.argv.append('--wrapper=dummy_wrapper')
         self.assertRaises(SystemExit, wrapper.run)
 
+    @mock.patch('fs_uae_wrapper.plain.Wrapper.run')
+    def test_run_profile(self, mock_plain_run):
+        os.chdir(self.dirname)
+        with open('Config.fs-uae', 'w') as fobj:
+            fobj.write('[config]\nwrapper_profile = trace.json\n'
+                       'wrapper_report = report.json\n')
+
+        wrapper.run()
+        with open('trace.json') as fobj:
+            trace = json.load(fobj)
+        names = [event['name'] for event in trace['traceEvents']]
+        self.assertIn('load_config', names)
+        self.assertIn('run', names)
+        self.assertIn('clean', names)
+
+        with open('report.json') as fobj:
+            report = json.load(fobj)
+        self.assertEqual(report['wrapper'], 'plain')
+        self.assertIn('run', [phase['name'] for phase in report['phases']])
+        self.assertIsInstance(report['processes'], list)
+
+    @mock.patch('fs_uae_wrapper.plain.Wrapper.run')
+    def test_run_metrics(self, mock_plain_run):
+        os.chdir(self.dirname)
+        with open('Config.fs-uae', 'w') as fobj:
+            fobj.write('[config]\nwrapper_metrics = metrics.sqlite\n')
+
+        wrapper.run()
+        wrapper.run()
+        conn = metrics.connect('metrics.sqlite')
+        self.assertEqual(conn.execute('SELECT config, wrapper, result FROM '
+                                      'launches').fetchall(),
+                         [(os.path.abspath('Config.fs-uae'), 'plain', 1)] * 2)
+        conn.close()
+
+        sys.argv.extend(['--wrapper-stats',
+                         '--wrapper-metrics=metrics.sqlite'])
+        with mock.patch('fs_uae_wrapper.metrics.report') as report:
+            report.return_value = True
+            with self.assertRaises(SystemExit) as exc:
+                wrapper.run()
+            self.assertEqual(exc.exception.code, 0)
+            report.assert_called_once_with(os.path.abspath('metrics.sqlite'))
+
+    @mock.patch('fs_uae_wrapper.plain.Wrapper.run')
+    def test_run_plan(self, mock_plain_run):
+        os.chdir(self.dirname)
+        with open('Config.fs-uae', 'w') as fobj:
+            fobj.write('[config]\nfoo = bar\n')
+
+        with mock.patch('fs_uae_wrapper.utils.get_config_options',
+                        wraps=utils.get_config_options) as get_conf:
+            wrapper.run()
+            wrapper.run()
+            # second launch uses stored plan
+            get_conf.assert_called_once()
+
+            # which is outdated, when configuration is changed
+            with open('Config.fs-uae', 'w') as fobj:
+                fobj.write('[config]\nfoo = baz\n')
+            os.utime('Config.fs-uae', ns=(0, 0))
+            wrapper.run()
+            self.assertEqual(get_conf.call_count, 2)
+            self.assertEqual(mock_plain_run.call_count, 3)
+
+            # or not used at all, when disabled
+            sys.argv.append('--wrapper_plan_cache=0')
+            wrapper.run()
+            self.assertEqual(get_conf.call_count, 3)
+
+    @mock.patch('fs_uae_wrapper.index.update')
+    def test_run_index(self, update):
+        update.return_value = True
+        os.chdir(self.dirname)
+        os.mkdir('games')
+        db_path = os.path.join(self.dirname, 'fs-uae-wrapper', 'index.sqlite')
+
+        sys.argv.extend(['--wrapper-index', 'games'])
+        with self.assertRaises(SystemExit) as exc:
+            wrapper.run()
+        self.assertEqual(exc.exception.code, 0)
+        update.assert_called_once_with(db_path, 'games')
+
+        update.return_value = False
+        sys.argv[1:] = ['--wrapper-index=other', '--wrapper-index-db=i.db']
+        with self.assertRaises(SystemExit) as exc:
+            wrapper.run()
+        self.assertEqual(exc.exception.code, 1)
+        update.assert_called_with(os.path.abspath('i.db'), 'other')
+
+    @mock.patch('fs_uae_wrapper.prefetch.run')
+    def test_run_prefetch(self, prefetch_run):
+        prefetch_run.return_value = True
+        os.chdir(self.dirname)
+        os.mkdir('games')
+
+        sys.argv.extend(['--wrapper-prefetch', 'games'])
+        with self.assertRaises(SystemExit) as exc:
+            wrapper.run()
+        self.assertEqual(exc.exception.code, 0)
+        prefetch_run.assert_called_once_with('games', mock.ANY)
+
+        prefetch_run.return_value = False
+        sys.argv[1:] = ['--wrapper-prefetch=list.txt']
+        with self.assertRaises(SystemExit) as exc:
+            wrapper.run()
+        self.assertEqual(exc.exception.code, 1)
+        prefetch_run.assert_called_with('list.txt', mock.ANY)
+
+    @mock.patch('fs_uae_wrapper.cachectl.run')
+    def test_run_cache_command(self, cachectl_run):
+        cachectl_run.return_value = True
+        os.chdir(self.dirname)
+        with open('Game.fs-uae', 'w') as fobj:
+            fobj.write('[config]\n')
+
+        sys.argv.extend(['--wrapper-cache=pin', 'Game.fs-uae'])
+        with self.assertRaises(SystemExit) as exc:
+            wrapper.run()
+        self.assertEqual(exc.exception.code, 0)
+        cachectl_run.assert_called_once_with('pin', 'Game.fs-uae', mock.ANY)
+
+        cachectl_run.return_value = False
+        sys.argv[1:] = ['--wrapper-cache=verify']
+        with self.assertRaises(SystemExit) as exc:
+            wrapper.run()
+        self.assertEqual(exc.exception.code, 1)
+
     def test_run_wrong_conf(self):
 
         os.chdir(self.dirname)